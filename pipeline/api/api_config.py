@@ -1,2 +1,33 @@
+from typing import Dict
+
 MODELVERSION = "20230227-0606"
 MODELDIR = "/app/mlflow"
+CACHEDIR = "/app/mlflow/cache"
+# more versions in MODELDIR that are live next to MODELVERSION, with their share
+# of the requests that do not ask for a version, eg {"20230301-1200": 0.1}.
+# MODELVERSION gets the rest, a version with 0 only serves requests that ask for it
+MODELVERSIONS: Dict[str, float] = {}
+# every live version also decides the sentences the others serve, to compare them
+# on the same traffic. Versions with the same encoder share its pass, but a
+# version with its own encoder, eg a model pickled whole, adds a full encoder
+# pass to every request, see versions.py
+SHADOW = False
+# precision of the frozen encoder on cpu: "fp32", "int8" or "bf16", see precision.py.
+# This overrides the precision the model was trained with
+PRECISION = "fp32"
+# requests that arrive within BATCH_WINDOW_MS of each other share one forward pass
+BATCH_WINDOW_MS = 5
+MAX_BATCH_SIZE = 32
+# seconds between checks of MODELDIR and the processed mappings for a new version
+RELOAD_INTERVAL = 10
+# cached decisions per normalized sentence, entries expire after CACHE_TTL seconds
+CACHE_SIZE = 100_000
+CACHE_TTL = 24 * 3600
+# second tier, keyed by an abbreviation and CONTEXT_WINDOW words on either side.
+# It reuses decisions made with the full sentence, set CONTEXT_CACHE_SIZE to 0 to
+# disable it
+CONTEXT_WINDOW = 5
+CONTEXT_CACHE_SIZE = 0
+# /expand_stream: sentences in flight per stream, and the longest accepted document
+STREAM_MAX_PENDING = 256
+MAX_DOCUMENT_BYTES = 1_000_000
@@ -0,0 +1,302 @@
+"""Trained models stored as a small head and a shared, memory mapped encoder.
+
+The roberta encoder is frozen, so a model saved whole carries its own copy of
+the same weights. An artifact holds only the rest of the model (the reducer),
+the settings it was built with, and the name of an encoder directory next to it:
+
+    mlflow/
+        20230227-0606trainedmodel.pt        the head, about a MB
+        encoders/MedRoBERTa.nl-1a2b3c4d5e6f/
+            encoder.safetensors             the roberta weights
+            config.json, vocab.json, ...    the roberta config and the tokenizer
+
+The encoder name ends in a hash of its weights, so every version trained on the
+same encoder refers to the same directory. The weights are written in the
+safetensors layout and memory mapped when loaded: they are only read from disk
+when used, the uvicorn workers share the pages, and all models in a process that
+refer to the same encoder share one instance of it.
+
+Models that were saved whole with torch.save still load, and `convert` turns
+them into artifacts:
+    python pipeline/api/artifacts.py artefacts/mlflow/20230227-0606trainedmodel.pt
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Type
+
+import numpy as np
+import torch
+from layers import AbbrvtExpander
+from loguru import logger
+from settings import Settings, modelsettings
+from torch import nn
+from transformers import RobertaConfig, RobertaModel, RobertaTokenizer
+
+# bump when the content of an artifact changes
+ARTIFACT_FORMAT = 1
+ENCODERS = "encoders"
+WEIGHTS = "encoder.safetensors"
+
+# the safetensors names of the torch dtypes
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+# per encoder directory and precision, see load_encoder
+_encoders: Dict[Tuple[str, str], Tuple[RobertaModel, RobertaTokenizer]] = {}
+_lock = threading.Lock()
+
+
+def save_safetensors(tensors: Dict[str, torch.Tensor], path: Path) -> None:
+    """writes tensors in the safetensors layout: the length of a json header,
+    the header with the dtype, shape and byte range of every tensor, the data"""
+    # the largest elements first, so every tensor starts at a multiple of its
+    # element size and can be viewed in place when memory mapped
+    names = sorted(tensors, key=lambda n: -tensors[n].element_size())
+    header: Dict[str, Dict] = {}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    raw = json.dumps(header, separators=(",", ":")).encode()
+    raw += b" " * (-len(raw) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(raw)))
+        f.write(raw)
+        for name in names:
+            flat = tensors[name].detach().contiguous().reshape(-1)
+            f.write(flat.view(torch.uint8).numpy().tobytes())
+
+
+def load_safetensors(path: Path) -> Dict[str, torch.Tensor]:
+    """memory maps a safetensors file, the tensors are views on the file.
+
+    The map is copy-on-write: pages are read from disk when a tensor is used,
+    and a tensor that is changed gets a private copy, the file stays unchanged.
+    """
+    with open(path, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    header.pop("__metadata__", None)
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + length)
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        flat = torch.from_numpy(data[start:end]).view(DTYPES[info["dtype"]])
+        tensors[name] = flat.reshape(info["shape"])
+    return tensors
+
+
+@contextmanager
+def empty_parameters() -> Iterator[None]:
+    """modules built in this block get their parameters on the meta device, so
+    they take no memory and initialising them costs nothing"""
+    register = nn.Module.register_parameter
+
+    def register_empty(
+        module: nn.Module, name: str, param: Optional[nn.Parameter]
+    ) -> None:
+        register(module, name, param)
+        if param is not None:
+            empty = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+            module._parameters[name] = empty
+
+    nn.Module.register_parameter = register_empty  # type: ignore
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register  # type: ignore
+
+
+def encoder_name(model: AbbrvtExpander) -> str:
+    """the name of the encoder and a hash of its weights"""
+    digest = hashlib.sha256()
+    for name, tensor in model.roberta.state_dict().items():
+        digest.update(name.encode())
+        flat = tensor.detach().contiguous().reshape(-1)
+        digest.update(flat.view(torch.uint8).numpy().tobytes())
+    return f"{Path(model.model_path).name}-{digest.hexdigest()[:12]}"
+
+
+def save_encoder(model: AbbrvtExpander, encoderdir: Path) -> Path:
+    """writes the encoder and tokenizer of model to encoderdir/<encoder_name>,
+    unless an earlier model already did"""
+    path = Path(encoderdir) / encoder_name(model)
+    if (path / WEIGHTS).exists():
+        return path
+    # written next to the final directory and renamed, so a crash never leaves
+    # half an encoder behind
+    tmp = path.with_name(f".{path.name}-{os.getpid()}")
+    tmp.mkdir(parents=True, exist_ok=True)
+    model.roberta.config.save_pretrained(tmp)
+    model.tokenizer.save_pretrained(tmp)
+    save_safetensors(model.roberta.state_dict(), tmp / WEIGHTS)
+    try:
+        tmp.rename(path)
+        logger.info(f"Saved the encoder to {path}")
+    except OSError:
+        # another process saved the same encoder first
+        shutil.rmtree(tmp)
+    return path
+
+
+def load_encoder(
+    path: Path, precision: str = "fp32"
+) -> Tuple[RobertaModel, RobertaTokenizer]:
+    """the encoder and tokenizer in path, loaded once per process.
+
+    The encoder is built with empty parameters, which are then replaced by the
+    memory mapped tensors of the weights file. There is an instance per
+    precision, because apply_precision (see precision.py) converts the encoder
+    of a model in place. The first model to get an instance converts it, for
+    the other models it is already converted.
+    """
+    key = (str(Path(path).resolve()), precision)
+    with _lock:
+        if key not in _encoders:
+            config = RobertaConfig.from_pretrained(path)
+            # only this thread builds modules while the lock is held
+            with empty_parameters():
+                roberta = RobertaModel(config)
+            state = load_safetensors(Path(path) / WEIGHTS)
+            expected = set(roberta.state_dict())
+            assert set(state) == expected, (
+                f"The weights in {path} do not fit the encoder config, "
+                f"missing {expected - set(state)}, unexpected {set(state) - expected}"
+            )
+            for name, tensor in state.items():
+                module_name, _, attr = name.rpartition(".")
+                module = roberta.get_submodule(module_name)
+                if attr in module._parameters:
+                    module._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+                else:
+                    module._buffers[attr] = tensor
+            roberta.eval()
+            tokenizer = RobertaTokenizer.from_pretrained(path)
+            _encoders[key] = (roberta, tokenizer)
+            logger.info(f"Memory mapped the encoder in {path} ({precision})")
+        return _encoders[key]
+
+
+def architecture(model: AbbrvtExpander) -> Dict:
+    """the settings that determine the shapes and the forward pass of model"""
+    return {
+        "modelpath": model.model_path,
+        "vectordim": model.vectordim,
+        "hidden": model.hidden,
+        "aggtype": model.aggtype,
+        "nonlinear": model.nonlinear,
+        "buckets": model.buckets,
+        "precision": model.precision,
+    }
+
+
+def save_model(model: AbbrvtExpander, modelpath: Path, settings: Settings) -> None:
+    """saves the head of model to modelpath, and its encoder to the encoders
+    directory next to it
+
+    Args:
+        settings (Settings): the other settings, eg of the training run, the
+            architecture is read from model
+    """
+    settings = settings.copy(update=architecture(model))
+    encoder = save_encoder(model, Path(modelpath).parent / ENCODERS)
+    head = {
+        name: tensor
+        for name, tensor in model.state_dict().items()
+        if not name.startswith("roberta.")
+    }
+    artifact = {
+        "format": ARTIFACT_FORMAT,
+        "settings": json.loads(settings.json()),
+        "encoder": f"{ENCODERS}/{encoder.name}",
+        "state": head,
+    }
+    torch.save(artifact, modelpath)
+
+
+def load_model(modelpath: Path, precision: str = "fp32") -> Type[AbbrvtExpander]:
+    """loads an artifact with its shared encoder, or a model saved whole
+
+    Args:
+        precision (str): the precision the encoder will be converted to, models
+            with the same encoder and precision share the encoder
+    """
+    artifact = torch.load(modelpath, map_location=torch.device("cpu"))
+    if isinstance(artifact, nn.Module):
+        logger.warning(f"{modelpath} holds a whole model, see artifacts.convert")
+        return artifact  # type: ignore
+    assert artifact["format"] <= ARTIFACT_FORMAT, (
+        f"{modelpath} has artifact format {artifact['format']}, "
+        f"this code reads up to {ARTIFACT_FORMAT}"
+    )
+    roberta, tokenizer = load_encoder(
+        Path(modelpath).parent / artifact["encoder"], precision
+    )
+    settings = Settings(**artifact["settings"])
+    model = AbbrvtExpander(settings, roberta=roberta, tokenizer=tokenizer)
+    # only the head is loaded, the shared encoder may already be converted to
+    # another precision and has a state of its own, eg int8 scales
+    prefix = "reducer."
+    head = {
+        name.removeprefix(prefix): tensor
+        for name, tensor in artifact["state"].items()
+        if name.startswith(prefix)
+    }
+    unexpected = [name for name in artifact["state"] if not name.startswith(prefix)]
+    assert len(unexpected) == 0, f"{modelpath} does not fit the model: {unexpected}"
+    model.reducer.load_state_dict(head)
+    return model  # type: ignore
+
+
+def convert(modelpath: Path) -> None:
+    """replaces a model saved whole by an artifact, the old file is kept with a
+    .legacy suffix"""
+    model = torch.load(modelpath, map_location=torch.device("cpu"))
+    if not isinstance(model, nn.Module):
+        logger.info(f"{modelpath} is already an artifact")
+        return
+    legacy = modelpath.with_name(modelpath.name + ".legacy")
+    modelpath.rename(legacy)
+    save_model(model, modelpath, modelsettings)  # type: ignore
+    before, after = legacy.stat().st_size, modelpath.stat().st_size
+    logger.success(
+        f"Converted {modelpath}: {before / 2**20:.1f} MB to {after / 2**20:.2f} MB, "
+        f"the whole model is kept in {legacy}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modelpaths", type=Path, nargs="+")
+    args = parser.parse_args()
+    for modelpath in args.modelpaths:
+        convert(modelpath)
+
+
+if __name__ == "__main__":
+    main()
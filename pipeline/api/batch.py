@@ -0,0 +1,273 @@
+"""Expands a corpus offline, without the api.
+
+The input is read in chunks of lines, every chunk is expanded by one of a pool of
+worker processes that each load the model once, and written to its own parquet
+file in the output directory. Finished chunks are recorded in a checkpoint, so
+running the same command again after the job was killed continues where it
+stopped.
+
+Run from the root of the repository, eg:
+    python pipeline/api/batch.py assets/raw/corpus.txt artefacts/expanded --workers 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import api_config as cfg
+import polars as pl
+import torch
+from data import FileHandler
+from embeddings import index_path
+from inference import check_model, disambiguate_batch
+from loguru import logger
+from precision import PRECISIONS, effective_precision
+from registry import Deployment, load_deployment
+from settings import filesettings
+
+CHECKPOINT = "_checkpoint.json"
+# explicit, so parts where no abbreviation was found have the same schema
+SCHEMA: Dict[str, Any] = {
+    "line": pl.Int64,
+    "text": pl.Utf8,
+    "expanded": pl.Utf8,
+    "abbreviations": pl.List(pl.Utf8),
+    "expansions": pl.List(pl.Utf8),
+    "scores": pl.List(pl.Float64),
+    "starts": pl.List(pl.Int64),
+    "ends": pl.List(pl.Int64),
+}
+
+# every worker process loads its own deployment once, in init_worker
+_deployment: Optional[Deployment] = None
+
+
+def read_chunks(
+    path: Path, chunksize: int, column: str
+) -> Iterator[Tuple[int, int, List[str]]]:
+    """yields (chunk number, offset of the first line, lines) without reading
+    more than one chunk into memory"""
+    if path.suffix in [".parq", ".parquet"]:
+        chunk = 0
+        while True:
+            frame = pl.scan_parquet(path).slice(chunk * chunksize, chunksize).collect()
+            if len(frame) == 0:
+                return
+            yield chunk, chunk * chunksize, frame[column].to_list()
+            chunk += 1
+    else:
+        with open(path, "r") as f:
+            chunk = 0
+            while True:
+                lines = [line.rstrip("\n") for line in islice(f, chunksize)]
+                if len(lines) == 0:
+                    return
+                yield chunk, chunk * chunksize, lines
+                chunk += 1
+
+
+def load_checkpoint(outdir: Path, source: Path, chunksize: int) -> Set[int]:
+    path = outdir / CHECKPOINT
+    if not path.exists():
+        return set()
+    with open(path, "r") as f:
+        state = json.load(f)
+    if state["input"] != str(source) or state["chunksize"] != chunksize:
+        raise ValueError(
+            f"{path} belongs to input {state['input']} with chunksize "
+            f"{state['chunksize']}, use another output directory"
+        )
+    return set(state["done"])
+
+
+def save_checkpoint(outdir: Path, source: Path, chunksize: int, done: Set) -> None:
+    path = outdir / CHECKPOINT
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(
+            {"input": str(source), "chunksize": chunksize, "done": sorted(done)}, f
+        )
+    tmp.replace(path)
+
+
+def init_worker(
+    modelpath: Path, mappath: Path, cachedir: Path, precision: str, threads: int
+) -> None:
+    global _deployment
+    torch.set_num_threads(threads)
+    _deployment = load_deployment(modelpath, mappath, cachedir, precision)
+
+
+def expand_chunk(
+    chunk: int, offset: int, lines: List[str], outdir: Path, batchsize: int
+) -> Tuple[int, int, int, float]:
+    """expands the lines of one chunk and writes them to a parquet part
+
+    Returns:
+        Tuple[int, int, int, float]: chunk number, worker pid, lines, seconds
+    """
+    tic = time.perf_counter()
+    deployment: Deployment = _deployment  # type: ignore
+    results = []
+    for start in range(0, len(lines), batchsize):
+        end = start + batchsize
+        results.extend(
+            disambiguate_batch(
+                lines[start:end],
+                deployment.inverted_dict,
+                deployment.model,
+                deployment.index,
+                deployment.detector,
+            )
+        )
+
+    frame = pl.DataFrame(
+        {
+            "line": list(range(offset, offset + len(lines))),
+            "text": lines,
+            "expanded": [r.expanded_sentence for r in results],
+            "abbreviations": [
+                [o.abbreviation for o in r.abbreviations] for r in results
+            ],
+            "expansions": [[o.expansion for o in r.abbreviations] for r in results],
+            "scores": [[o.score for o in r.abbreviations] for r in results],
+            "starts": [[o.start for o in r.abbreviations] for r in results],
+            "ends": [[o.end for o in r.abbreviations] for r in results],
+        },
+        schema=SCHEMA,
+    )
+    path = outdir / f"part-{chunk:06d}.parq"
+    tmp = path.with_suffix(".tmp")
+    frame.write_parquet(tmp, compression="zstd")
+    tmp.replace(path)
+    return chunk, os.getpid(), len(lines), time.perf_counter() - tic
+
+
+def run(
+    source: Path,
+    outdir: Path,
+    workers: int,
+    threads: int,
+    chunksize: int,
+    batchsize: int,
+    column: str,
+    modelpath: Path,
+    mappath: Path,
+    cachedir: Path,
+    precision: str,
+) -> None:
+    precision = effective_precision(precision)
+    outdir.mkdir(parents=True, exist_ok=True)
+    done = load_checkpoint(outdir, source, chunksize)
+    if len(done) > 0:
+        logger.info(f"Resuming, {len(done)} chunks were already expanded")
+
+    # the workers start at the same time, they should only read the index
+    path, _ = index_path(modelpath, mappath, cachedir, precision)
+    if not path.exists():
+        logger.info("Building the expansion index before starting the workers")
+        load_deployment(modelpath, mappath, cachedir, precision)
+
+    lines: Dict[int, int] = defaultdict(int)
+    seconds: Dict[int, float] = defaultdict(float)
+    tic = time.perf_counter()
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(modelpath, mappath, cachedir, precision, threads),
+    ) as pool:
+        pending: Set[Future] = set()
+
+        def collect(return_when: str) -> None:
+            finished, rest = wait(pending, return_when=return_when)
+            pending.intersection_update(rest)
+            for future in finished:
+                chunk, pid, n, sec = future.result()
+                lines[pid] += n
+                seconds[pid] += sec
+                done.add(chunk)
+                save_checkpoint(outdir, source, chunksize, done)
+                logger.info(
+                    f"chunk {chunk} done by worker {pid} at {n / sec:.1f} lines/sec"
+                )
+
+        for chunk, offset, items in read_chunks(source, chunksize, column):
+            if chunk in done:
+                continue
+            # keep at most two chunks per worker in memory
+            if len(pending) >= 2 * workers:
+                collect(FIRST_COMPLETED)
+            pending.add(
+                pool.submit(expand_chunk, chunk, offset, items, outdir, batchsize)
+            )
+        if pending:
+            collect(ALL_COMPLETED)
+
+    for pid in sorted(lines):
+        logger.info(
+            f"worker {pid}: {lines[pid]} lines, "
+            f"{lines[pid] / seconds[pid]:.1f} lines/sec"
+        )
+    total = sum(lines.values())
+    logger.success(
+        f"Expanded {total} lines into {outdir} "
+        f"({total / (time.perf_counter() - tic):.1f} lines/sec overall)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input", type=Path, help="a text file or a parquet file")
+    parser.add_argument("outdir", type=Path, help="directory for the parquet parts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=1, help="torch threads/worker")
+    parser.add_argument("--chunksize", type=int, default=10_000)
+    parser.add_argument("--batchsize", type=int, default=cfg.MAX_BATCH_SIZE)
+    parser.add_argument("--column", default="txt", help="text column in parquet")
+    parser.add_argument("--model", type=Path, default=None)
+    parser.add_argument("--mapping", type=Path, default=None)
+    parser.add_argument("--cachedir", type=Path, default=Path(cfg.CACHEDIR))
+    parser.add_argument("--precision", choices=PRECISIONS, default=cfg.PRECISION)
+    args = parser.parse_args()
+
+    modelpath = args.model
+    if modelpath is None:
+        modelpath = check_model(
+            Path(f"{cfg.MODELDIR}/{cfg.MODELVERSION}trainedmodel.pt")
+        )
+    mappath = args.mapping
+    if mappath is None:
+        mappath = FileHandler(filesettings).latest_mapping()
+
+    run(
+        source=args.input,
+        outdir=args.outdir,
+        workers=args.workers,
+        threads=args.threads,
+        chunksize=args.chunksize,
+        batchsize=args.batchsize,
+        column=args.column,
+        modelpath=modelpath.resolve(),
+        mappath=mappath.resolve(),
+        cachedir=args.cachedir,
+        precision=args.precision,
+    )
+
+
+if __name__ == "__main__":
+    main()
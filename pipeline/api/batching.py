@@ -0,0 +1,128 @@
+import asyncio
+from typing import Callable, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+from loguru import logger
+
+Item = TypeVar("Item")
+Result = TypeVar("Result")
+
+
+class MicroBatcher(Generic[Item, Result]):
+    """Merges concurrent requests into batches for a single model call.
+
+    Items are put on an asyncio queue. A background task takes the first item,
+    then keeps collecting items until the batching window closes or the batch is
+    full. The handler runs in the default executor, so the event loop keeps
+    accepting requests while the model computes, and every caller gets the result
+    at its own position in the batch. When the handler fails on a batch, its items
+    are retried one by one, so only the callers of the bad items get an error.
+
+    Args:
+        handler (Callable): maps a list of items to a list of results of equal length
+        max_batch_size (int): the maximum amount of items passed to the handler
+        window (float): seconds to wait for more items after the first one arrived
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Item]], List[Result]],
+        max_batch_size: int,
+        window: float,
+    ) -> None:
+        assert max_batch_size > 0, "max_batch_size should be at least 1"
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"MicroBatcher(max_batch_size={self.max_batch_size}, "
+            f"window={self.window})"
+        )
+
+    def start(self) -> None:
+        """starts the background task, this needs a running event loop"""
+        if self._worker is None:
+            self.queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, item: Item) -> Result:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))  # type: ignore
+        return await future
+
+    async def submit_many(self, items: Sequence[Item]) -> List[Result]:
+        return list(await asyncio.gather(*[self.submit(item) for item in items]))
+
+    async def _collect(self) -> List[Tuple[Item, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]  # type: ignore
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(
+                    await asyncio.wait_for(self.queue.get(), timeout)  # type: ignore
+                )
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # callers that disconnected while waiting do not need a result
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if len(batch) == 0:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.handler, items)
+            except Exception as e:
+                if len(batch) == 1:
+                    logger.exception("Batch of 1 item failed")
+                    self._fail(batch, e)
+                    continue
+                # retry the items one by one, so only the bad ones fail
+                logger.warning(f"Batch of {len(items)} items failed, retrying each")
+                for pair in batch:
+                    await self._retry(pair)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _retry(self, pair: Tuple[Item, asyncio.Future]) -> None:
+        item, future = pair
+        if future.done():
+            return
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, self.handler, [item]
+            )
+        except Exception as e:
+            logger.exception("Item of a failed batch failed on its own")
+            self._fail([pair], e)
+            return
+        if not future.done():
+            future.set_result(results[0])
+
+    def _fail(self, batch: List[Tuple[Item, asyncio.Future]], error: Exception) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,476 @@
+"""Benchmarks for the inference hot paths.
+
+Run from the root of the repository, eg:
+    python pipeline/api/benchmark.py detection --sizes 100 1000 10000
+    python pipeline/api/benchmark.py precision --model artefacts/mlflow/x.pt
+    python pipeline/api/benchmark.py suite --output bench.json --baseline old.json
+
+The suite runs offline: a small randomly initialized roberta with a byte-level
+tokenizer stands in for MedRoBERTa, so it measures the code around the encoder
+and the scaling, not the latency of the real model. Its results are written to a
+json file, and compared with the results of an earlier run when given.
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import string
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Type
+
+import polars as pl
+import torch
+from artifacts import load_model
+from data import FileHandler
+from detector import AbbreviationDetector
+from embeddings import build_index
+from inference import disambiguate_batch, expand_abbreviation, get_invert_mapping
+from layers import AbbrvtExpander
+from loguru import logger
+from precision import PRECISIONS, apply_precision, effective_precision
+from settings import filesettings, modelsettings
+from transformers import RobertaConfig, RobertaModel
+from transformers.models.roberta.tokenization_roberta import bytes_to_unicode
+
+# the fields that identify a row of results, see row_id
+CONFIG = ["acronyms", "tokens", "batchsize", "precision"]
+
+
+def timeit(func: Callable, repeat: int) -> float:
+    """best wall time of repeat calls, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def rss_mb() -> float:
+    """resident memory of this process"""
+    with open("/proc/self/statm", "r") as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def random_acronyms(n: int, seed: int = 42) -> List[str]:
+    rng = random.Random(seed)
+    acronyms: Dict[str, None] = {}
+    while len(acronyms) < n:
+        size = rng.randint(2, 6)
+        acronyms["".join(rng.choices(string.ascii_uppercase, k=size))] = None
+    return list(acronyms)
+
+
+def load_sentences(path: Path) -> List[str]:
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def bench_detection(
+    sentences: Sequence[str], sizes: Sequence[int], repeat: int = 3
+) -> List[Dict]:
+    """compares the linear substring scan with the AbbreviationDetector
+
+    Every sentence gets one of the random acronyms inserted, so both methods have
+    something to find.
+    """
+    results = []
+    for size in sizes:
+        acronyms = random_acronyms(size)
+        rng = random.Random(size)
+        texts = [f"{s} {rng.choice(acronyms)} 20 /min" for s in sentences]
+
+        def scan() -> None:
+            for text in texts:
+                [key for key in acronyms if key in text]
+
+        tic = time.perf_counter()
+        detector = AbbreviationDetector(acronyms)
+        build = time.perf_counter() - tic
+
+        def detect() -> None:
+            for text in texts:
+                detector.find(text)
+
+        t_scan = timeit(scan, repeat) / len(texts)
+        t_detect = timeit(detect, repeat) / len(texts)
+        result = {
+            "acronyms": size,
+            "scan_us": t_scan * 1e6,
+            "detector_us": t_detect * 1e6,
+            "speedup": t_scan / t_detect,
+            "build_ms": build * 1e3,
+        }
+        logger.info(
+            f"{size:>6} acronyms: scan {result['scan_us']:9.1f} us/sentence, "
+            f"detector {result['detector_us']:7.1f} us/sentence "
+            f"({result['speedup']:.1f}x), build {result['build_ms']:.1f} ms"
+        )
+        results.append(result)
+    return results
+
+
+def run_precision(
+    modelpath: Path, mappath: Path, testfile: Path, precision: str, batchsize: int
+) -> Dict:
+    """loads the model in one precision and measures it on the test set.
+
+    This runs in a fresh process per precision, so the memory numbers do not
+    include the other models.
+    """
+    torch.manual_seed(0)
+    model = load_model(modelpath, precision)
+    model.eval()  # type: ignore
+    model = apply_precision(model, precision)
+    inverted_dict = get_invert_mapping(mappath)
+    detector = AbbreviationDetector(inverted_dict.keys())
+    index = build_index(model, inverted_dict)
+    loaded = rss_mb()
+
+    data = pl.read_csv(testfile, sep="|")
+    samples = data["sample"].to_list()
+
+    def expand(batch: List[str]) -> List:
+        return disambiguate_batch(batch, inverted_dict, model, index, detector)
+
+    expand(samples[:batchsize])  # warmup
+    latencies = []
+    for sample in samples:
+        tic = time.perf_counter()
+        expand([sample])
+        latencies.append(time.perf_counter() - tic)
+
+    tic = time.perf_counter()
+    results = []
+    for start in range(0, len(samples), batchsize):
+        end = start + batchsize
+        results.extend(expand(samples[start:end]))
+    seconds = time.perf_counter() - tic
+
+    predictions: List[Optional[str]] = []
+    for acronym, result in zip(data["acronym"].to_list(), results):
+        chosen = [
+            o.expansion for o in result.abbreviations if o.abbreviation == acronym
+        ]
+        predictions.append(chosen[0] if chosen else None)
+    correct = [p == t for p, t in zip(predictions, data["expansion"].to_list())]
+
+    return {
+        "precision": precision,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p95_ms": percentile(latencies, 95) * 1e3,
+        "throughput": len(samples) / seconds,
+        "rss_mb": loaded,
+        "peak_rss_mb": peak_rss_mb(),
+        "accuracy": sum(correct) / len(correct),
+        "predictions": predictions,
+    }
+
+
+def bench_precision(
+    modelpath: Path,
+    mappath: Path,
+    testfile: Path,
+    precisions: Sequence[str],
+    batchsize: int,
+) -> List[Dict]:
+    """latency, throughput, memory and accuracy on the test set per precision,
+    with the accuracy difference and agreement relative to the first precision"""
+    # a bf16 that falls back to fp32 is not measured twice
+    precisions = list(dict.fromkeys(effective_precision(p) for p in precisions))
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for precision in precisions:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            future = pool.submit(
+                run_precision, modelpath, mappath, testfile, precision, batchsize
+            )
+            results.append(future.result())
+
+    baseline = results[0]
+    for result in results:
+        agree = [p == b for p, b in zip(result["predictions"], baseline["predictions"])]
+        result["accuracy_diff"] = result["accuracy"] - baseline["accuracy"]
+        result["agreement"] = sum(agree) / len(agree)
+        logger.info(
+            f"{result['precision']:>5}: p50 {result['p50_ms']:6.1f} ms, "
+            f"p95 {result['p95_ms']:6.1f} ms, {result['throughput']:7.1f} sentences/s, "
+            f"rss {result['rss_mb']:6.0f} MB (peak {result['peak_rss_mb']:6.0f} MB), "
+            f"accuracy {result['accuracy']:.3f} ({result['accuracy_diff']:+.3f}), "
+            f"agreement with {baseline['precision']} {result['agreement']:.3f}"
+        )
+    return results
+
+
+def standin_model(
+    directory: Path, hidden: int = 64, layers: int = 2, seed: int = 0
+) -> AbbrvtExpander:
+    """A small randomly initialized roberta in place of MedRoBERTa, it needs no
+    download. Its tokenizer has no merges, so every utf-8 byte is a token."""
+    torch.manual_seed(seed)
+    vocab = {"<s>": 0, "<pad>": 1, "</s>": 2, "<unk>": 3}
+    for char in bytes_to_unicode().values():
+        vocab[char] = len(vocab)
+    vocab["<mask>"] = len(vocab)
+    with open(directory / "vocab.json", "w") as f:
+        json.dump(vocab, f)
+    with open(directory / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+    config = RobertaConfig(
+        vocab_size=len(vocab),
+        hidden_size=hidden,
+        num_hidden_layers=layers,
+        num_attention_heads=max(hidden // 32, 1),
+        intermediate_size=4 * hidden,
+        max_position_embeddings=514,
+        pad_token_id=1,
+    )
+    RobertaModel(config).save_pretrained(directory)
+    settings = modelsettings.copy(
+        update={
+            "modelpath": str(directory),
+            "vectordim": hidden,
+            "hidden": hidden // 2,
+            "cache_dir": directory / "cache",
+        }
+    )
+    model = AbbrvtExpander(settings)
+    model.eval()
+    return model
+
+
+def random_mapping(acronyms: int, seed: int = 42) -> Dict[str, List[str]]:
+    """acronyms with one to four made up expansions each, like get_invert_mapping"""
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=8)) for _ in range(500)]
+    return {
+        abbr: [" ".join(rng.choices(words, k=3)) for _ in range(rng.randint(1, 4))]
+        for abbr in random_acronyms(acronyms, seed)
+    }
+
+
+def bench_latency(
+    model: AbbrvtExpander, sentences: Sequence[str], acronyms: int = 200
+) -> Dict:
+    """latency percentiles of expand_abbreviation, one sentence at a time"""
+    inverted_dict = random_mapping(acronyms)
+    detector = AbbreviationDetector(inverted_dict.keys())
+    index = build_index(model, inverted_dict)  # type: ignore
+    rng = random.Random(0)
+    texts = [f"{s} {rng.choice(list(inverted_dict))} 20 /min" for s in sentences]
+    model_: Type[AbbrvtExpander] = model  # type: ignore
+    expand_abbreviation(texts[0], inverted_dict, model_, index, detector)  # warmup
+    latencies = []
+    for text in texts:
+        tic = time.perf_counter()
+        expand_abbreviation(text, inverted_dict, model_, index, detector)
+        latencies.append(time.perf_counter() - tic)
+    result = {
+        "sentences": len(texts),
+        "mean_ms": sum(latencies) / len(latencies) * 1e3,
+        "p50_ms": percentile(latencies, 50) * 1e3,
+        "p90_ms": percentile(latencies, 90) * 1e3,
+        "p99_ms": percentile(latencies, 99) * 1e3,
+    }
+    logger.info(
+        f"expand_abbreviation: p50 {result['p50_ms']:.2f} ms, "
+        f"p90 {result['p90_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms"
+    )
+    return result
+
+
+def bench_vectorize(
+    model: AbbrvtExpander,
+    batchsizes: Sequence[int],
+    lengths: Sequence[int],
+    repeat: int = 3,
+) -> List[Dict]:
+    """sentences per second of vectorize, per batch size and tokens per sentence.
+    With the byte-level tokenizer of standin_model, a sentence of n - 2 ascii
+    characters has n tokens."""
+    rng = random.Random(0)
+    results = []
+    for length in lengths:
+        for batchsize in batchsizes:
+            batch = tuple(
+                "".join(rng.choices(string.ascii_lowercase + " ", k=length - 2))
+                for _ in range(batchsize)
+            )
+
+            def vectorize() -> None:
+                with torch.no_grad():
+                    model.vectorize(batch)
+
+            vectorize()  # warmup
+            seconds = timeit(vectorize, repeat)
+            result = {
+                "tokens": length,
+                "batchsize": batchsize,
+                "ms_per_batch": seconds * 1e3,
+                "sentences_per_sec": batchsize / seconds,
+            }
+            logger.info(
+                f"vectorize {length:>4} tokens x {batchsize:>3}: "
+                f"{result['ms_per_batch']:8.2f} ms/batch, "
+                f"{result['sentences_per_sec']:8.1f} sentences/s"
+            )
+            results.append(result)
+    return results
+
+
+def row_id(row: object, i: int) -> str:
+    """identifies a row of results by its configuration, eg tokens=16,batchsize=1,
+    so runs with other configurations can still be compared"""
+    if not isinstance(row, dict):
+        return str(i)
+    config = [f"{key}={row[key]}" for key in CONFIG if key in row]
+    return ",".join(config) if config else str(i)
+
+
+def flatten(results: object, prefix: str = "") -> Dict[str, float]:
+    """the numbers in nested results, by their path, eg vectorize[3].ms_per_batch"""
+    if isinstance(results, dict):
+        items = [(f"{prefix}.{k}" if prefix else str(k), v) for k, v in results.items()]
+    elif isinstance(results, list):
+        items = [(f"{prefix}[{row_id(v, i)}]", v) for i, v in enumerate(results)]
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix: float(results)}
+    else:
+        return {}
+    flat: Dict[str, float] = {}
+    for key, value in items:
+        flat.update(flatten(value, key))
+    return flat
+
+
+def compare(results: Dict, baseline: Dict) -> Dict[str, float]:
+    """the relative change of every number that is also in the baseline"""
+    current, previous = flatten(results), flatten(baseline)
+    changes = {}
+    for key, value in current.items():
+        if key in previous and previous[key] != 0 and value != previous[key]:
+            changes[key] = value / previous[key] - 1
+            logger.info(
+                f"{key}: {previous[key]:.4g} -> {value:.4g} ({changes[key]:+.1%})"
+            )
+    return changes
+
+
+def run_suite(
+    corpus: Path,
+    output: Path,
+    baseline: Optional[Path] = None,
+    sizes: Sequence[int] = (10, 100, 1000, 10000, 50000),
+    batchsizes: Sequence[int] = (1, 8, 32, 64),
+    lengths: Sequence[int] = (16, 64, 256),
+    repeat: int = 3,
+) -> Dict:
+    """runs the offline benchmarks and writes the results as json"""
+    sentences = load_sentences(corpus)
+    with tempfile.TemporaryDirectory() as tmp:
+        model = standin_model(Path(tmp))
+        results = {
+            "latency": bench_latency(model, sentences),
+            "vectorize": bench_vectorize(model, batchsizes, lengths, repeat),
+            "detection": bench_detection(sentences, sizes, repeat),
+        }
+    report = {
+        "suite": "api",
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.success(f"Wrote the results to {output}")
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            compare(results, json.load(f)["results"])
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    detection = subparsers.add_parser(
+        "detection", help="abbreviation detection against the linear scan"
+    )
+    detection.add_argument("--corpus", type=Path, default=Path("assets/raw/corpus.txt"))
+    detection.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 50000]
+    )
+    detection.add_argument("--repeat", type=int, default=3)
+
+    precision = subparsers.add_parser(
+        "precision", help="latency, memory and accuracy of the inference precisions"
+    )
+    precision.add_argument("--model", type=Path, required=True)
+    precision.add_argument("--mapping", type=Path, default=None)
+    precision.add_argument(
+        "--testfile", type=Path, default=Path("assets/raw/test_set.csv")
+    )
+    precision.add_argument(
+        "--precisions", nargs="+", choices=PRECISIONS, default=PRECISIONS
+    )
+    precision.add_argument("--batchsize", type=int, default=32)
+
+    suite = subparsers.add_parser(
+        "suite", help="the offline benchmarks with a stand-in model, as json"
+    )
+    suite.add_argument("--corpus", type=Path, default=Path("assets/raw/corpus.txt"))
+    suite.add_argument("--output", type=Path, default=Path("benchmark-api.json"))
+    suite.add_argument("--baseline", type=Path, default=None)
+    suite.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 50000]
+    )
+    suite.add_argument("--batchsizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    suite.add_argument("--lengths", type=int, nargs="+", default=[16, 64, 256])
+    suite.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.benchmark == "detection":
+        bench_detection(load_sentences(args.corpus), args.sizes, args.repeat)
+    if args.benchmark == "precision":
+        mappath = args.mapping
+        if mappath is None:
+            mappath = FileHandler(filesettings).latest_mapping()
+        bench_precision(
+            args.model, mappath, args.testfile, args.precisions, args.batchsize
+        )
+
+    if args.benchmark == "suite":
+        run_suite(
+            args.corpus,
+            args.output,
+            args.baseline,
+            args.sizes,
+            args.batchsizes,
+            args.lengths,
+            args.repeat,
+        )
+
+
+if __name__ == "__main__":
+    main()
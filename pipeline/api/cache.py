@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Generic, Hashable, Optional, Sequence, Tuple, TypeVar
+
+from detector import Match
+
+Value = TypeVar("Value")
+# the chosen expansion and its score, per abbreviation
+Decisions = Dict[str, Tuple[str, float]]
+
+
+class LRUCache(Generic[Value]):
+    """A thread-safe, size-bounded cache that evicts the least recently used entry.
+
+    Args:
+        maxsize (int): the maximum amount of entries
+        ttl (float, optional): seconds an entry stays valid. None means forever.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"LRUCache(maxsize={self.maxsize}, ttl={self.ttl}, size={len(self)})"
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Value]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Value) -> None:
+        if self.maxsize <= 0:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitrate": self.hits / total if total > 0 else 0.0,
+        }
+
+
+def normalize(sentence: str) -> str:
+    return " ".join(sentence.split())
+
+
+class ExpansionCache:
+    """Caches the expansion decisions for a sentence, so a repeated sentence does
+    not need the encoder.
+
+    The first tier is keyed by the normalized sentence. The optional second tier
+    is keyed by an abbreviation with the `window` words around it, so sentences
+    that only differ further away from the abbreviations also skip the encoder.
+    The second tier reuses a decision that was made with the full sentence as
+    context, so it trades some accuracy for speed and is off by default.
+
+    Both tiers include the model and mapping version in the key, so a reload never
+    serves decisions from the previous version. Offsets are never cached, the
+    caller applies the decisions to the matches in the exact sentence.
+
+    Args:
+        maxsize (int): maximum amount of sentences
+        ttl (float, optional): seconds an entry stays valid
+        window (int): words on each side of an abbreviation in the second tier key
+        window_maxsize (int): maximum amount of entries in the second tier,
+            0 disables it
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        window: int = 5,
+        window_maxsize: int = 0,
+    ) -> None:
+        self.sentences: LRUCache[Decisions] = LRUCache(maxsize, ttl)
+        self.window = window
+        self.contexts: Optional[LRUCache[Tuple[str, float]]] = None
+        if window_maxsize > 0:
+            self.contexts = LRUCache(window_maxsize, ttl)
+
+    def __repr__(self) -> str:
+        return f"ExpansionCache(sentences={self.sentences}, contexts={self.contexts})"
+
+    def _windows(self, sentence: str, matches: Sequence[Match]) -> Dict[str, str]:
+        """the context window around the first occurrence of every abbreviation"""
+        windows: Dict[str, str] = {}
+        for match in matches:
+            if match.abbreviation in windows:
+                continue
+            start, end, size = match.start, match.end, self.window
+            left = sentence[:start].split()[-size:] if size > 0 else []
+            right = sentence[end:].split()[:size]
+            windows[match.abbreviation] = " ".join(left + [match.abbreviation] + right)
+        return windows
+
+    def lookup(
+        self, version: str, sentence: str, matches: Sequence[Match]
+    ) -> Optional[Decisions]:
+        decisions = self.sentences.get((version, normalize(sentence)))
+        if decisions is not None or self.contexts is None:
+            return decisions
+
+        decisions = {}
+        for abbr, window in self._windows(sentence, matches).items():
+            decision = self.contexts.get((version, abbr, window))
+            if decision is None:
+                return None
+            decisions[abbr] = decision
+        return decisions
+
+    def store(
+        self,
+        version: str,
+        sentence: str,
+        matches: Sequence[Match],
+        decisions: Decisions,
+    ) -> None:
+        self.sentences.put((version, normalize(sentence)), decisions)
+        if self.contexts is None:
+            return
+        for abbr, window in self._windows(sentence, matches).items():
+            if abbr in decisions:
+                self.contexts.put((version, abbr, window), decisions[abbr])
+
+    def clear(self) -> None:
+        self.sentences.clear()
+        if self.contexts is not None:
+            self.contexts.clear()
+
+    def stats(self) -> Dict[str, Dict]:
+        stats = {"sentences": self.sentences.stats()}
+        if self.contexts is not None:
+            stats["contexts"] = self.contexts.stats()
+        return stats
@@ -0,0 +1,30 @@
+import json
+from pathlib import Path
+
+import pytest
+from layers import AbbrvtExpander
+from settings import modelsettings
+from transformers import RobertaConfig, RobertaModel, RobertaTokenizer
+
+
+@pytest.fixture
+def tiny_model(tmp_path: Path) -> AbbrvtExpander:
+    """an expander with a small random encoder, nothing is downloaded"""
+    tokens = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"] + list("abcdefgh ")
+    vocab = {token: i for i, token in enumerate(tokens)}
+    (tmp_path / "vocab.json").write_text(json.dumps(vocab))
+    (tmp_path / "merges.txt").write_text("#version: 0.2\n")
+    tokenizer = RobertaTokenizer(
+        str(tmp_path / "vocab.json"), str(tmp_path / "merges.txt")
+    )
+    config = RobertaConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        max_position_embeddings=64,
+        pad_token_id=vocab["<pad>"],
+    )
+    settings = modelsettings.copy(update={"modelpath": "tiny", "vectordim": 32})
+    return AbbrvtExpander(settings, roberta=RobertaModel(config), tokenizer=tokenizer)
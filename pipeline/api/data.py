@@ -1,6 +1,6 @@
 import json
 from pathlib import Path
-from typing import Dict, Iterator, Tuple
+from typing import Dict, Iterator
 
 from settings import FileSettings
 
@@ -34,15 +34,12 @@ class FileHandler:
     def __repr__(self) -> str:
         return f"FileHandler(bucket='{self.bucket}', data_dir='{self.data_dir}')"
 
-    def _get_latest(self) -> Tuple[Path, Path]:
+    def latest_mapping(self) -> Path:
+        """the newest mapping in the processed data, the api needs no train data"""
         files = [*walk_dir(self.processed)]
-        maps = [
+        return [
             f for f in sorted(files, reverse=True) if f.suffix == self.mappingsuffix
         ][0]
-        train = [f for f in sorted(files, reverse=True) if f.suffix == self.datasuffix][
-            0
-        ]
-        return maps, train
 
     def load_mapping(self, filepath: Path) -> Dict:
         """This is a mapping from expansions to possible abbreviations.
@@ -0,0 +1,125 @@
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple
+
+
+class Match(NamedTuple):
+    start: int
+    end: int
+    abbreviation: str
+
+
+def is_wordchar(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class AbbreviationDetector:
+    """Finds all known abbreviations in a text in a single pass.
+
+    The abbreviations are compiled into an Aho-Corasick automaton once. Searching
+    walks the text character by character, independent of the number of
+    abbreviations. Only occurrences on word boundaries are reported, so "AF" is
+    found in "AF 20 /min" but not in "AFdeling". Overlapping occurrences are
+    resolved leftmost-longest.
+
+    Args:
+        abbreviations (Iterable[str]): the keys of the inverted mapping
+    """
+
+    def __init__(self, abbreviations: Iterable[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # the pattern that ends in a node, and the nearest node on the fail chain
+        # where another pattern ends
+        self.output: List[str] = [""]
+        self.dict_link: List[int] = [0]
+        self.size = 0
+        for abbr in abbreviations:
+            self._add(abbr)
+        self._link()
+
+    def __repr__(self) -> str:
+        return (
+            f"AbbreviationDetector(abbreviations={self.size}, states={len(self.goto)})"
+        )
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _add(self, abbr: str) -> None:
+        if len(abbr) == 0:
+            return
+        node = 0
+        for char in abbr:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append("")
+                self.dict_link.append(0)
+            node = nxt
+        if self.output[node] == "":
+            self.size += 1
+        self.output[node] = abbr
+
+    def _link(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                link = self.fail[child]
+                self.dict_link[child] = (
+                    link if self.output[link] else self.dict_link[link]
+                )
+                queue.append(child)
+
+    def find(self, text: str) -> List[Match]:
+        """all word-boundary occurrences, with character offsets into text
+
+        Args:
+            text (str): the sentence to search
+
+        Returns:
+            List[Match]: non-overlapping matches, ordered by start
+        """
+        goto, fail, output, dict_link = (
+            self.goto,
+            self.fail,
+            self.output,
+            self.dict_link,
+        )
+        candidates = []
+        node = 0
+        last = len(text) - 1
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if node == 0 or (i < last and is_wordchar(text[i + 1])):
+                continue
+            state = node if output[node] else dict_link[node]
+            while state:
+                abbr = output[state]
+                start = i - len(abbr) + 1
+                if start == 0 or not is_wordchar(text[start - 1]):
+                    candidates.append(Match(start, i + 1, abbr))
+                state = dict_link[state]
+
+        # leftmost-longest, dropping matches that overlap an earlier one
+        candidates.sort(key=lambda m: (m.start, -m.end))
+        matches: List[Match] = []
+        for match in candidates:
+            if not matches or match.start >= matches[-1].end:
+                matches.append(match)
+        return matches
+
+    def abbreviations(self, text: str) -> List[str]:
+        """the distinct abbreviations in text, in order of first occurrence"""
+        return list(dict.fromkeys(m.abbreviation for m in self.find(text)))
@@ -0,0 +1,171 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple, Type
+
+import torch
+import torch.nn.functional as F  # noqa N812
+from layers import AbbrvtExpander
+from loguru import logger
+
+# bump when the way vectors are computed changes, so old cached indices are rebuilt
+INDEX_FORMAT = 2
+# expansions per vectorize call while building the index
+INDEX_BATCH_SIZE = 64
+
+
+def cache_key(modelpath: Path, mappath: Path, precision: str = "fp32") -> str:
+    """Identifies a (model version, precision, mapping) combination.
+
+    The model is identified by its filename, size and modification time, which is
+    cheap to compute for files of hundreds of MB. The mapping is small, so its
+    content is hashed.
+
+    Args:
+        modelpath (Path): the pytorch model that is served
+        mappath (Path): the processed map.json the expansions are read from
+        precision (str): the precision the encoder runs in, see precision.py
+
+    Returns:
+        str: a hexdigest that changes when either of the files changes
+    """
+    stat = modelpath.stat()
+    digest = hashlib.sha256()
+    digest.update(f"{modelpath.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(f"{precision}:{INDEX_FORMAT}".encode())
+    digest.update(Path(mappath).read_bytes())
+    return digest.hexdigest()
+
+
+class ExpansionIndex:
+    """Holds the reduced vector of every expansion in the mapping.
+
+    All vectors are L2-normalised and stored in one tensor. The expansions for
+    an abbreviation occupy a contiguous slice of that tensor, so scoring a
+    context against the candidates of an abbreviation is a single matmul
+    and does not need the encoder.
+    """
+
+    def __init__(
+        self,
+        vectors: torch.Tensor,
+        expansions: List[str],
+        spans: Dict[str, Tuple[int, int]],
+        key: str = "",
+    ) -> None:
+        self.vectors = vectors
+        self.expansions = expansions
+        self.spans = spans
+        self.key = key
+
+    def __repr__(self) -> str:
+        return (
+            f"ExpansionIndex(abbreviations={len(self.spans)}, "
+            f"expansions={len(self.expansions)})"
+        )
+
+    def __contains__(self, abbr: str) -> bool:
+        return abbr in self.spans
+
+    def candidates(self, abbr: str) -> List[str]:
+        start, end = self.spans[abbr]
+        return self.expansions[start:end]
+
+    def score(self, abbr: str, context: torch.Tensor) -> torch.Tensor:
+        """cosine similarity between the context and all expansions of abbr
+
+        Args:
+            abbr (str): the abbreviation
+            context (torch.Tensor): reduced context vector(s), shape (hidden,)
+                or (batch, hidden)
+
+        Returns:
+            torch.Tensor: shape (batch, candidates)
+        """
+        start, end = self.spans[abbr]
+        context = F.normalize(context.reshape(-1, self.vectors.shape[-1]), dim=-1)
+        return context @ self.vectors[start:end].T
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            "vectors": self.vectors,
+            "expansions": self.expansions,
+            "spans": self.spans,
+            "key": self.key,
+        }
+        # write to a temporary file first, so a crash never leaves a partial index,
+        # one per process, so processes that build the same index do not mix
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(state, tmp)
+        tmp.replace(path)
+        logger.info(f"Saved expansion index to {path}")
+
+
+def build_index(
+    model: Type[AbbrvtExpander], inverted_dict: Dict, key: str = ""
+) -> ExpansionIndex:
+    """encodes every expansion in the mapping once.
+
+    vectorize masks the padding, so the vector of an expansion does not depend on
+    the batch it is in. The expansions are encoded in fixed size batches,
+    regardless of the abbreviation they belong to.
+    """
+    model.eval()  # type: ignore
+    expansions: List[str] = []
+    spans: Dict[str, Tuple[int, int]] = {}
+    for abbr, candidates in inverted_dict.items():
+        spans[abbr] = (len(expansions), len(expansions) + len(candidates))
+        expansions.extend(candidates)
+    if len(expansions) == 0:
+        # eg a batch without abbreviations, there is nothing to encode
+        empty = torch.empty(0, model.hidden)  # type: ignore
+        return ExpansionIndex(empty, expansions, spans, key)
+    vectors = []
+    with torch.no_grad():
+        for start in range(0, len(expansions), INDEX_BATCH_SIZE):
+            end = start + INDEX_BATCH_SIZE
+            batch = tuple(expansions[start:end])
+            vector = model.vectorize(batch)  # type: ignore
+            vectors.append(vector.reshape(len(batch), -1))
+    return ExpansionIndex(
+        F.normalize(torch.cat(vectors), dim=-1), expansions, spans, key
+    )
+
+
+def index_path(
+    modelpath: Path, mappath: Path, cachedir: Path, precision: str = "fp32"
+) -> Tuple[Path, str]:
+    """where the index of a model, mapping and precision is cached, and its key"""
+    key = cache_key(Path(modelpath), Path(mappath), precision)
+    return Path(cachedir) / f"{Path(modelpath).stem}_{key[:16]}.idx", key
+
+
+def load_or_build_index(
+    model: Type[AbbrvtExpander],
+    inverted_dict: Dict,
+    modelpath: Path,
+    mappath: Path,
+    cachedir: Path,
+    precision: str = "fp32",
+) -> ExpansionIndex:
+    """loads the index from cachedir, or builds and stores it when the model
+    version or the mapping changed since it was cached.
+    """
+    path, key = index_path(modelpath, mappath, cachedir, precision)
+    if path.exists():
+        try:
+            state = torch.load(path)
+            if state["key"] == key:
+                logger.info(f"Loaded expansion index from {path}")
+                return ExpansionIndex(**state)
+        except (IOError, RuntimeError, KeyError) as e:
+            logger.warning(f"Could not read expansion index {path}: {e}")
+
+    logger.info(f"Building expansion index for {modelpath}")
+    index = build_index(model, inverted_dict, key)
+    try:
+        index.save(path)
+    except IOError as e:
+        logger.warning(f"Could not write expansion index to {path}: {e}")
+    return index
@@ -1,13 +1,26 @@
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, Type
+from typing import Dict, List, Optional, Type
 
 import api_config as cfg
 import torch
+from cache import Decisions, ExpansionCache
 from data import FileHandler, walk_dir
+from detector import AbbreviationDetector, Match
+from embeddings import ExpansionIndex, build_index
 from layers import AbbrvtExpander
 from loguru import logger
+from pydantic import BaseModel
 from settings import filesettings, filetypes
+from timing import count, stage
+
+
+def latest_model(modeldir: Path) -> Optional[Path]:
+    files = walk_dir(modeldir)
+    models = [p for p in files if p.suffix == filetypes.PYTORCHMODEL]
+    if len(models) == 0:
+        return None
+    return sorted(models, reverse=True)[0]
 
 
 def check_model(modelpath: Path) -> Path:
@@ -18,12 +31,11 @@ def check_model(modelpath: Path) -> Path:
         logger.info(
             "Obtain the model, or change the modelversion in the api_config.py file"
         )
-        files = walk_dir(Path(cfg.MODELDIR))
-        models = [p for p in files if p.suffix == filetypes.PYTORCHMODEL]
-        if len(models) == 0:
+        latest = latest_model(Path(cfg.MODELDIR))
+        if latest is None:
             logger.error(f"There are no other models in {cfg.MODELDIR}")
         else:
-            modelpath = sorted(models, reverse=True)[0]
+            modelpath = latest
             logger.warning(f"Found latest model {modelpath}, using that")
     else:
         logger.info(f"Found model {modelpath}")
@@ -31,9 +43,10 @@ def check_model(modelpath: Path) -> Path:
     return modelpath
 
 
-def get_invert_mapping() -> Dict:
+def get_invert_mapping(mappath: Optional[Path] = None) -> Dict:
     filehandler = FileHandler(filesettings)
-    mappath, _ = filehandler._get_latest()
+    if mappath is None:
+        mappath = filehandler.latest_mapping()
     mapping = filehandler.load_mapping(mappath)
     inverted_dict = defaultdict(list)
     for key, value in mapping.items():
@@ -41,20 +54,168 @@ def get_invert_mapping() -> Dict:
     return inverted_dict
 
 
+class Occurrence(BaseModel):
+    start: int
+    end: int
+    abbreviation: str
+    expansion: str
+    score: float
+
+
+class ExpandedSentence(BaseModel):
+    expanded_sentence: str
+    abbreviations: List[Occurrence]
+    # the model version that served it, see versions.py
+    version: str = ""
+
+
+def decide(
+    matches: List[Match], context: torch.Tensor, index: ExpansionIndex
+) -> Decisions:
+    """Picks an expansion for every abbreviation in matches from one context vector.
+
+    Args:
+        matches (List[Match]): occurrences in a sentence
+        context (torch.Tensor): the reduced vector of the original sentence
+        index (ExpansionIndex): precomputed vectors of the candidates
+
+    Returns:
+        Decisions: the expansion and its cosine score, per abbreviation
+    """
+    # every occurrence of an abbreviation shares the same context
+    decisions: Decisions = {}
+    for abbr in dict.fromkeys(m.abbreviation for m in matches):
+        if abbr not in index:
+            continue
+        scores = index.score(abbr, context)[0]
+        idx = int(torch.argmax(scores))
+        decisions[abbr] = (index.candidates(abbr)[idx], float(scores[idx]))
+    return decisions
+
+
+def rebuild(
+    sentence: str, matches: List[Match], decisions: Decisions
+) -> ExpandedSentence:
+    """Replaces every match by its expansion in a single pass by offset.
+
+    Args:
+        sentence (str): the original sentence
+        matches (List[Match]): non-overlapping occurrences, ordered by start
+        decisions (Decisions): the expansion and score per abbreviation
+
+    Returns:
+        ExpandedSentence: the expanded sentence, with a span and score for
+            every occurrence that was expanded
+    """
+    pieces = []
+    occurrences = []
+    cursor = 0
+    for match in matches:
+        if match.abbreviation not in decisions:
+            continue
+        expansion, score = decisions[match.abbreviation]
+        start, end = match.start, match.end
+        pieces.append(sentence[cursor:start])
+        pieces.append(expansion)
+        cursor = end
+        occurrences.append(
+            Occurrence(
+                start=start,
+                end=end,
+                abbreviation=match.abbreviation,
+                expansion=expansion,
+                score=score,
+            )
+        )
+    pieces.append(sentence[cursor:])
+    return ExpandedSentence(
+        expanded_sentence="".join(pieces), abbreviations=occurrences
+    )
+
+
+def disambiguate_batch(
+    sentences: List[str],
+    inverted_dict: Dict,
+    model: Type[AbbrvtExpander],  # type: ignore
+    index: Optional[ExpansionIndex] = None,
+    detector: Optional[AbbreviationDetector] = None,
+    cache: Optional[ExpansionCache] = None,
+    version: str = "",
+) -> List[ExpandedSentence]:
+    """Resolves all abbreviations in a batch of sentences with a single padded
+    vectorize call over the original sentences.
+
+    Sentences without abbreviations, or with decisions in the cache, are not
+    encoded at all. Without an index, the candidates of the detected abbreviations
+    are encoded on the fly.
+    """
+    count(len(sentences))
+    if detector is None:
+        detector = AbbreviationDetector(inverted_dict.keys())
+    with stage("detect"):
+        found = [detector.find(sentence) for sentence in sentences]
+    if index is None:
+        abbreviations = {m.abbreviation for matches in found for m in matches}
+        with stage("index"):
+            index = build_index(
+                model, {abbr: inverted_dict[abbr] for abbr in abbreviations}
+            )
+
+    decisions: List[Optional[Decisions]] = []
+    with stage("cache"):
+        for sentence, matches in zip(sentences, found):
+            if len(matches) == 0:
+                decisions.append({})
+            elif cache is not None:
+                decisions.append(cache.lookup(version, sentence, matches))
+            else:
+                decisions.append(None)
+
+    todo = [i for i, decision in enumerate(decisions) if decision is None]
+    if len(todo) > 0:
+        with stage("vectorize"), torch.no_grad():
+            vectors = model.vectorize(tuple(sentences[i] for i in todo))  # type: ignore
+        with stage("decide"):
+            for i, context in zip(todo, vectors.reshape(len(todo), -1)):
+                decision = decide(found[i], context, index)
+                if cache is not None:
+                    cache.store(version, sentences[i], found[i], decision)
+                decisions[i] = decision
+
+    with stage("rebuild"):
+        return [
+            rebuild(sentence, matches, decision)  # type: ignore
+            for sentence, matches, decision in zip(sentences, found, decisions)
+        ]
+
+
+def disambiguate(
+    sentence: str,
+    inverted_dict: Dict,
+    model: Type[AbbrvtExpander],  # type: ignore
+    index: Optional[ExpansionIndex] = None,
+    detector: Optional[AbbreviationDetector] = None,
+) -> ExpandedSentence:
+    return disambiguate_batch([sentence], inverted_dict, model, index, detector)[0]
+
+
 def expand_abbreviation(
-    sentence: str, inverted_dict: Dict, model: Type[AbbrvtExpander]  # type: ignore
+    sentence: str,
+    inverted_dict: Dict,
+    model: Type[AbbrvtExpander],  # type: ignore
+    index: Optional[ExpansionIndex] = None,
+    detector: Optional[AbbreviationDetector] = None,
 ) -> str:
-    abbreviations = [key for key in inverted_dict.keys() if key in sentence]
-    for abbr in abbreviations:
-        candidates = inverted_dict[abbr]
-        print(candidates)
-        candidates = [tuple(candidates)]
-        s = (
-            sentence,
-            sentence,
-        )  # this avoids pytorch collapsing the singleton dimension
-        yhat = model(s, candidates)  # type: ignore
-        idx = torch.argmax(yhat, dim=1)[0]  # type: ignore
-        expansion = candidates[0][idx]
-        sentence = sentence.replace(abbr, expansion)
-    return sentence
+    result = disambiguate(sentence, inverted_dict, model, index, detector)
+    return result.expanded_sentence
+
+
+def expand_batch(
+    sentences: List[str],
+    inverted_dict: Dict,
+    model: Type[AbbrvtExpander],  # type: ignore
+    index: Optional[ExpansionIndex] = None,
+    detector: Optional[AbbreviationDetector] = None,
+) -> List[str]:
+    results = disambiguate_batch(sentences, inverted_dict, model, index, detector)
+    return [result.expanded_sentence for result in results]
@@ -0,0 +1,434 @@
+"""Load tests the expansion service, to size the api replicas.
+
+Requests are sent open-loop: the send times follow a poisson process with the
+given rate, whatever the server does, and at most `concurrency` requests are in
+flight. A request that has to wait for a free connection keeps its scheduled
+send time, so the latencies include the queueing a real client would see.
+
+The server is started here, with uvicorn in a subprocess (--workers, --threads)
+or in this process (--inprocess), or an already running server is used (--url).
+The resident memory of the server and its workers is sampled during the run.
+
+The ramp mode raises the rate step by step until the server saturates: the
+throughput stays below the offered rate, the p99 latency exceeds the slo or
+requests fail.
+
+Run from the root of the repository, eg:
+    python pipeline/api/loadtest.py run --rate 50 --concurrency 16 --duration 30
+    python pipeline/api/loadtest.py ramp --workers 2 --threads 4 --slo 500
+    python pipeline/api/loadtest.py run --url http://localhost:8000 --rate 20
+"""
+
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import polars as pl
+import uvicorn
+from loguru import logger
+
+# put in the queue of the senders when all requests are scheduled
+_DONE = (-1, 0.0)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    if len(values) == 0:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def load_sentences(corpus: Optional[Path], testfile: Optional[Path]) -> List[str]:
+    """the lines of the corpus and the samples of the test set"""
+    sentences: List[str] = []
+    if corpus is not None:
+        with open(corpus, "r") as f:
+            sentences.extend(line.strip() for line in f if line.strip())
+    if testfile is not None:
+        sentences.extend(pl.read_csv(testfile, sep="|")["sample"].to_list())
+    assert len(sentences) > 0, "There are no sentences to send"
+    return sentences
+
+
+def rss_mb(pid: int) -> float:
+    """resident memory of a process and all its children, eg uvicorn workers"""
+    total = 0.0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/statm", "r") as f:
+                total += int(f.read().split()[1]) * resource.getpagesize() / 2**20
+            for task in Path(f"/proc/{current}/task").iterdir():
+                pids.extend(int(c) for c in (task / "children").read_text().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    """Runs serve.py on localhost while the load test runs.
+
+    Args:
+        workers (int): uvicorn worker processes
+        threads (int): torch threads per worker, 0 keeps the default
+        inprocess (bool): run uvicorn in a thread of this process instead, the
+            load generator then shares the GIL with the server
+        startup (float): seconds to wait for the model to load
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        threads: int = 0,
+        inprocess: bool = False,
+        startup: float = 600.0,
+    ) -> None:
+        self.workers = workers
+        self.threads = threads
+        self.inprocess = inprocess
+        self.startup = startup
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.pid = os.getpid()
+        self._process: Optional[subprocess.Popen] = None
+        self._server: Optional[uvicorn.Server] = None
+
+    def __repr__(self) -> str:
+        mode = "inprocess" if self.inprocess else f"workers={self.workers}"
+        return f"LocalServer({mode}, threads={self.threads}, url='{self.url}')"
+
+    def __enter__(self) -> "LocalServer":
+        if self.inprocess:
+            self._start_thread()
+        else:
+            self._start_process()
+        self._wait()
+        logger.info(f"Started {self}")
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        if self._server is not None:
+            self._server.should_exit = True
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait(timeout=60)
+
+    def _start_thread(self) -> None:
+        # importing serve builds the model registry, only needed in this mode
+        import serve
+        import torch
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+        config = uvicorn.Config(serve.app, port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        threading.Thread(target=self._server.run, daemon=True).start()
+
+    def _start_process(self) -> None:
+        env = dict(os.environ)
+        if self.threads > 0:
+            env["OMP_NUM_THREADS"] = str(self.threads)
+            env["MKL_NUM_THREADS"] = str(self.threads)
+        command = [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "serve:app",
+            "--app-dir",
+            str(Path(__file__).parent),
+            "--port",
+            str(self.port),
+            "--workers",
+            str(self.workers),
+            "--log-level",
+            "warning",
+        ]
+        self._process = subprocess.Popen(command, env=env)
+        self.pid = self._process.pid
+
+    def _wait(self) -> None:
+        """until the model is loaded and /model answers"""
+        deadline = time.monotonic() + self.startup
+        while time.monotonic() < deadline:
+            if self._process is not None and self._process.poll() is not None:
+                raise RuntimeError(
+                    f"The server stopped with {self._process.returncode}"
+                )
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, 5)
+                connection.request("GET", "/model")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise TimeoutError(f"The server did not start within {self.startup} s")
+
+
+class LoadGenerator:
+    """Sends open-loop requests to the service.
+
+    Args:
+        url (str): eg http://localhost:8000
+        sentences (Sequence[str]): replayed in a random order
+        batchsize (int): 0 sends one sentence per GET /expand_sentence, otherwise
+            batchsize sentences per POST /expand_batch
+        unique (bool): append the request number to every sentence, so the cache
+            of the server never answers
+        timeout (float): seconds before a request counts as an error
+    """
+
+    def __init__(
+        self,
+        url: str,
+        sentences: Sequence[str],
+        batchsize: int = 0,
+        unique: bool = True,
+        timeout: float = 30.0,
+        seed: int = 42,
+    ) -> None:
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.sentences = list(sentences)
+        self.batchsize = batchsize
+        self.unique = unique
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+
+    def _request(self, i: int) -> Tuple[str, str, Optional[bytes]]:
+        size = max(self.batchsize, 1)
+        sentences = self.rng.sample(self.sentences, min(size, len(self.sentences)))
+        if self.unique:
+            sentences = [f"{s} #{i}-{j}" for j, s in enumerate(sentences)]
+        if self.batchsize == 0:
+            query = urlencode({"sentence": sentences[0]})
+            return "GET", f"/expand_sentence?{query}", None
+        body = json.dumps({"sentences": sentences}).encode()
+        return "POST", "/expand_batch", body
+
+    def run(
+        self,
+        rate: float,
+        concurrency: int,
+        duration: float,
+        pid: Optional[int] = None,
+    ) -> Dict:
+        """sends rate requests per second for duration seconds
+
+        Args:
+            pid (int, optional): the server process, to sample its memory
+        """
+        amount = max(int(rate * duration), 1)
+        requests = [self._request(i) for i in range(amount)]
+        pending: queue.Queue = queue.Queue()
+        # per request: scheduled send time, start, end and http status (0 = error)
+        timings: List[Tuple[float, float, float, int]] = []
+        lock = threading.Lock()
+        stop = threading.Event()
+        peak_rss = [0.0]
+
+        def send() -> None:
+            connection = http.client.HTTPConnection(self.host, self.port, self.timeout)
+            headers = {"Content-Type": "application/json"}
+            while True:
+                i, scheduled = pending.get()
+                if i < 0:
+                    return
+                method, path, body = requests[i]
+                start = time.perf_counter()
+                try:
+                    connection.request(method, path, body, headers)
+                    response = connection.getresponse()
+                    response.read()
+                    status = response.status
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    connection = http.client.HTTPConnection(
+                        self.host, self.port, self.timeout
+                    )
+                    status = 0
+                with lock:
+                    timings.append((scheduled, start, time.perf_counter(), status))
+
+        def sample() -> None:
+            while not stop.wait(0.25):
+                peak_rss[0] = max(peak_rss[0], rss_mb(pid))  # type: ignore
+
+        senders = [
+            threading.Thread(target=send, daemon=True) for _ in range(concurrency)
+        ]
+        for sender in senders:
+            sender.start()
+        if pid is not None:
+            threading.Thread(target=sample, daemon=True).start()
+
+        tic = time.perf_counter()
+        scheduled = tic
+        for i in range(amount):
+            scheduled += self.rng.expovariate(rate)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pending.put((i, scheduled))
+        # the poisson arrivals make the sent rate differ a bit from the rate asked
+        offered = amount / (scheduled - tic)
+        for _ in senders:
+            pending.put(_DONE)
+        for sender in senders:
+            sender.join(timeout=self.timeout + duration)
+        elapsed = time.perf_counter() - tic
+        stop.set()
+
+        with lock:
+            done = list(timings)
+        ok = [t for t in done if t[3] == 200]
+        latencies = [end - scheduled for scheduled, _, end, _ in ok]
+        service = [end - start for _, start, end, _ in ok]
+        errors = amount - len(ok)
+        result = {
+            "rate": rate,
+            "offered": offered,
+            "concurrency": concurrency,
+            "sentences_per_request": max(self.batchsize, 1),
+            "requests": amount,
+            "errors": errors,
+            "error_rate": errors / amount,
+            "throughput": len(ok) / elapsed,
+            "mean_ms": sum(latencies) / max(len(latencies), 1) * 1e3,
+            "p50_ms": percentile(latencies, 50) * 1e3,
+            "p95_ms": percentile(latencies, 95) * 1e3,
+            "p99_ms": percentile(latencies, 99) * 1e3,
+            "service_p50_ms": percentile(service, 50) * 1e3,
+            "rss_mb": peak_rss[0] if pid is not None else None,
+        }
+        rss = f"{result['rss_mb']:.0f} MB" if pid is not None else "unknown"
+        logger.info(
+            f"{offered:7.1f} req/s offered: {result['throughput']:7.1f} req/s, "
+            f"p50 {result['p50_ms']:7.1f} ms, p95 {result['p95_ms']:7.1f} ms, "
+            f"p99 {result['p99_ms']:7.1f} ms, errors {result['error_rate']:.1%}, "
+            f"server rss {rss}"
+        )
+        return result
+
+
+def saturated(result: Dict, slo: float) -> bool:
+    """the server did not keep up with the offered rate"""
+    return (
+        result["throughput"] < 0.9 * result["offered"]
+        or result["p99_ms"] > slo
+        or result["error_rate"] > 0.01
+    )
+
+
+def ramp(
+    generator: LoadGenerator,
+    concurrency: int,
+    duration: float,
+    start: float,
+    factor: float,
+    limit: float,
+    slo: float,
+    pid: Optional[int] = None,
+) -> Dict:
+    """raises the rate by factor, from start up to limit, until the server
+    saturates. The saturation point is the highest rate it kept up with."""
+    steps = []
+    rate = start
+    best: Optional[float] = None
+    while rate <= limit:
+        result = generator.run(rate, concurrency, duration, pid)
+        steps.append(result)
+        if saturated(result, slo):
+            break
+        best = rate
+        rate *= factor
+    if best is None:
+        logger.warning(f"The server is saturated at the first rate of {start} req/s")
+    else:
+        logger.success(f"The server keeps up with {best:.1f} req/s (p99 < {slo} ms)")
+    return {"saturation_rate": best, "slo_ms": slo, "steps": steps}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    run = subparsers.add_parser("run", help="one rate for a fixed duration")
+    run.add_argument("--rate", type=float, default=20.0)
+    ramping = subparsers.add_parser("ramp", help="find the saturation point")
+    ramping.add_argument("--start", type=float, default=5.0)
+    ramping.add_argument("--factor", type=float, default=1.5)
+    ramping.add_argument("--limit", type=float, default=5000.0)
+    ramping.add_argument("--slo", type=float, default=1000.0, help="p99 in ms")
+    for sub in [run, ramping]:
+        sub.add_argument("--url", type=str, default=None)
+        sub.add_argument("--workers", type=int, default=1)
+        sub.add_argument("--threads", type=int, default=0)
+        sub.add_argument("--inprocess", action="store_true")
+        sub.add_argument("--concurrency", type=int, default=16)
+        sub.add_argument("--duration", type=float, default=20.0)
+        sub.add_argument("--batchsize", type=int, default=0)
+        sub.add_argument("--cache-hits", action="store_true")
+        sub.add_argument("--corpus", type=Path, default=Path("assets/raw/corpus.txt"))
+        sub.add_argument(
+            "--testfile", type=Path, default=Path("assets/raw/test_set.csv")
+        )
+        sub.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args()
+
+    sentences = load_sentences(args.corpus, args.testfile)
+
+    def measure(url: str, pid: Optional[int]) -> Dict:
+        generator = LoadGenerator(
+            url, sentences, args.batchsize, unique=not args.cache_hits
+        )
+        if args.mode == "run":
+            return generator.run(args.rate, args.concurrency, args.duration, pid)
+        return ramp(
+            generator,
+            args.concurrency,
+            args.duration,
+            args.start,
+            args.factor,
+            args.limit,
+            args.slo,
+            pid,
+        )
+
+    if args.url is not None:
+        report = measure(args.url, None)
+    else:
+        with LocalServer(args.workers, args.threads, args.inprocess) as server:
+            report = measure(server.url, server.pid)
+        report["server"] = {
+            "workers": 1 if args.inprocess else args.workers,
+            "threads": args.threads,
+            "inprocess": args.inprocess,
+        }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.success(f"Wrote the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Metrics of the api in the Prometheus text format, served on /metrics.
+
+Small thread-safe counters, gauges and histograms, so the api needs no client
+library. An observation is a dict lookup, a bisect and two adds under a lock,
+cheap enough for every request and every stage of the model.
+
+Every uvicorn worker keeps its own metrics, so with several workers a scrape
+sees the worker that answered. Run one worker per container to scrape them all.
+"""
+
+import resource
+import threading
+import time
+from bisect import bisect_left
+from typing import Awaitable, Callable, Dict, List, MutableMapping, Sequence, Tuple
+
+from timing import StageTimer
+
+Labels = Tuple[str, ...]
+Scope = MutableMapping[str, object]
+Message = MutableMapping[str, object]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+# seconds, for requests and for the stages of the model
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+STAGE_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """A metric with a value per combination of labels.
+
+    Args:
+        name (str): eg expander_requests_total
+        documentation (str): the HELP line
+        labelnames (Sequence[str]): the labels, their values are passed in this
+            order when the metric is updated
+    """
+
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(name='{self.name}', labels={self.labelnames})"
+
+    def replace(self, values: Dict[Labels, float]) -> None:
+        """sets all values at once and drops the other labels, for values that
+        are kept elsewhere, eg the hits of the cache or the loaded model"""
+        with self._lock:
+            self._values = dict(values)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(
+                    f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+                )
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Counts the observations per bucket, a bucket holds the values up to and
+    including its upper bound.
+
+    Args:
+        buckets (Sequence[float]): the upper bounds in increasing order, +Inf is
+            added
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = list(buckets)
+        # per labels: the count per bucket (the last one is +Inf) and the sum
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            counts[index] += 1
+            self._sums[labels] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        names = self.labelnames + ("le",)
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        with self._lock:
+            for labels, counts in self._counts.items():
+                total = 0
+                for bound, amount in zip(bounds, counts):
+                    total += amount
+                    tags = format_labels(names, labels + (bound,))
+                    lines.append(f"{self.name}_bucket{tags} {total}")
+                tags = format_labels(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{tags} {self._sums[labels]}")
+                lines.append(f"{self.name}_count{tags} {total}")
+        return lines
+
+
+class MetricsRegistry:
+    """Creates the metrics and renders them all for a scrape"""
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def __repr__(self) -> str:
+        return f"MetricsRegistry(metrics={[m.name for m in self.metrics]})"
+
+    def counter(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ) -> Gauge:
+        metric = Gauge(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+class MonitoredTimer(StageTimer):
+    """A StageTimer that also observes every stage in a histogram, labeled with
+    the stage. The histogram is not cleared by reset."""
+
+    def __init__(self, histogram: Histogram, record: bool = False) -> None:
+        super().__init__(record)
+        self.histogram = histogram
+
+    def add(self, name: str, seconds: float) -> None:
+        super().add(name, seconds)
+        self.histogram.observe(seconds, name)
+
+
+class MetricsMiddleware:
+    """Observes the latency of every request, labeled with the endpoint, and
+    counts the requests per endpoint and status code. The latency runs until the
+    last byte of the response is sent, for a stream that is the whole stream.
+
+    Args:
+        app: the asgi app
+        latency (Histogram): with the labels endpoint
+        requests (Counter): with the labels endpoint and status
+        paths (Sequence[str]): the endpoints, other paths are labeled "other" so
+            random urls do not add labels
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        latency: Histogram,
+        requests: Counter,
+        paths: Sequence[str],
+    ) -> None:
+        self.app = app
+        self.latency = latency
+        self.requests = requests
+        self.paths = set(paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = str(scope["path"])
+        endpoint = path if path in self.paths else "other"
+        status = ["500"]
+        tic = time.perf_counter()
+
+        async def send_status(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.latency.observe(time.perf_counter() - tic, endpoint)
+            self.requests.inc(endpoint, status[0])
+
+
+def process_memory() -> Dict[str, float]:
+    """the resident and virtual memory of this process in bytes, and the peak
+    resident memory"""
+    pagesize = resource.getpagesize()
+    try:
+        with open("/proc/self/statm", "r") as f:
+            virtual, resident = f.read().split()[:2]
+    except FileNotFoundError:
+        # not on linux, only the peak is known
+        virtual = resident = "0"
+    # ru_maxrss is in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "resident": int(resident) * pagesize,
+        "virtual": int(virtual) * pagesize,
+        "peak_resident": peak,
+    }
@@ -0,0 +1,78 @@
+import threading
+from pathlib import Path
+from typing import Type
+
+import torch
+from layers import AbbrvtExpander
+from loguru import logger
+from torch import nn
+
+PRECISIONS = ["fp32", "int8", "bf16"]
+
+_lock = threading.Lock()
+
+
+def supports_bf16() -> bool:
+    """True if the cpu has native bf16 instructions (avx512_bf16 or amx).
+
+    Without them, torch emulates bf16 matmuls and they are slower than fp32.
+    """
+    cpuinfo = Path("/proc/cpuinfo")
+    if not cpuinfo.exists():
+        return False
+    flags = cpuinfo.read_text()
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def effective_precision(precision: str) -> str:
+    """the precision the encoder will actually run in, bf16 falls back to fp32
+    on cpus without native bf16 support. Use this for anything that reports or
+    is keyed by the precision, eg the index cache and the metrics."""
+    assert precision in PRECISIONS, f"precision should be one of {PRECISIONS}"
+    if precision == "bf16" and not supports_bf16():
+        logger.warning("This cpu has no native bf16 support, using fp32")
+        return "fp32"
+    return precision
+
+
+def apply_precision(
+    model: Type[AbbrvtExpander], precision: str
+) -> Type[AbbrvtExpander]:
+    """Converts the frozen encoder of a loaded model for cpu inference.
+
+    Only the roberta encoder is converted, the small reducer stays in fp32.
+        - fp32: the model is returned unchanged
+        - int8: the linear layers of the encoder are dynamically quantized, weights
+            are stored in int8 and activations are quantized on the fly
+        - bf16: the encoder weights are cast to bfloat16 and its forward runs under
+            cpu autocast. On cpus without native bf16 support this falls back to
+            fp32, see effective_precision.
+
+    This overrides the precision the model was trained with.
+
+    Args:
+        model (AbbrvtExpander): a model in eval mode, it is changed in place. A
+            shared encoder is converted once.
+        precision (str): one of PRECISIONS
+
+    Returns:
+        AbbrvtExpander: the same model
+    """
+    precision = effective_precision(precision)
+    model.precision = "fp32"  # type: ignore
+    if precision == "int8":
+        with _lock:
+            # an encoder shared with a model that was converted before (see
+            # artifacts.load_encoder) is already quantized
+            encoder = model.roberta  # type: ignore
+            if any(isinstance(m, nn.Linear) for m in encoder.modules()):
+                model.roberta = torch.quantization.quantize_dynamic(  # type: ignore
+                    encoder,
+                    {nn.Linear},
+                    dtype=torch.qint8,
+                    inplace=True,
+                )
+    elif precision == "bf16":
+        model.roberta.to(torch.bfloat16)  # type: ignore
+        model.precision = "bf16"  # type: ignore
+    return model
@@ -0,0 +1,248 @@
+import random
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type
+
+from artifacts import load_model
+from data import FileHandler
+from detector import AbbreviationDetector
+from embeddings import ExpansionIndex, load_or_build_index
+from inference import check_model, disambiguate_batch, get_invert_mapping, latest_model
+from layers import AbbrvtExpander
+from loguru import logger
+from precision import apply_precision, effective_precision
+from settings import filesettings
+
+Fingerprint = Tuple[Tuple[str, int, int], ...]
+MODELSUFFIX = "trainedmodel.pt"
+
+
+class Deployment:
+    """Everything a request needs: a model with the mapping it was loaded for.
+
+    A deployment is never changed after it is built. Requests take a reference to
+    the current deployment once, so a reload never changes the model or mapping
+    halfway through a request.
+    """
+
+    def __init__(
+        self,
+        modelpath: Path,
+        mappath: Path,
+        model: Type[AbbrvtExpander],
+        inverted_dict: Dict,
+        detector: AbbreviationDetector,
+        index: ExpansionIndex,
+    ) -> None:
+        self.modelpath = modelpath
+        self.mappath = mappath
+        self.model = model
+        self.inverted_dict = inverted_dict
+        self.detector = detector
+        self.index = index
+        # changes when either the model file or the content of the mapping changes
+        self.version = index.key[:16]
+
+    @property
+    def name(self) -> str:
+        """the timestamp of the model, like api_config.MODELVERSION"""
+        return self.modelpath.name[: -len(MODELSUFFIX)]
+
+    def __repr__(self) -> str:
+        return (
+            f"Deployment(model='{self.modelpath.name}', "
+            f"mapping='{self.mappath.name}', version='{self.version}')"
+        )
+
+    def warmup(self) -> None:
+        """runs one request through the model, so the first user does not pay for
+        lazy initialisation in torch"""
+        abbr = next(iter(self.inverted_dict), "")
+        disambiguate_batch(
+            [f"warmup {abbr}"],
+            self.inverted_dict,
+            self.model,
+            self.index,
+            self.detector,
+        )
+
+
+def load_deployment(
+    modelpath: Path, mappath: Path, cachedir: Path, precision: str = "fp32"
+) -> Deployment:
+    logger.info(f"Loading model {modelpath} ({precision}) with mapping {mappath}")
+    model = load_model(modelpath, precision)
+    model.eval()  # type: ignore
+    model = apply_precision(model, precision)
+    inverted_dict = get_invert_mapping(mappath)
+    detector = AbbreviationDetector(inverted_dict.keys())
+    index = load_or_build_index(
+        model, inverted_dict, modelpath, mappath, cachedir, precision
+    )
+    deployment = Deployment(modelpath, mappath, model, inverted_dict, detector, index)
+    deployment.warmup()
+    return deployment
+
+
+class ModelRegistry:
+    """Loads the configured models at startup and swaps in new ones when the
+    model directory or the processed mappings change.
+
+    Next to the primary model, more versions can be live, eg for an A/B test or
+    a gradual rollout. Every version gets a share of the requests that do not ask
+    for a version, the primary one gets what the others leave. Versions saved as
+    artifacts with the same encoder share it (see artifacts.py), so an extra
+    version only costs its head and its expansion index.
+
+    A background thread polls both directories. When a new model file or mapping
+    shows up, the new deployment is built and warmed up in that thread, and only
+    then replaces the current one. If building fails, the old deployment keeps
+    serving.
+
+    Args:
+        modeldir (Path): the mlflow directory with the trained models
+        modelversion (str): timestamp of the preferred model. If it does not exist,
+            the latest model in modeldir is used
+        cachedir (Path): where the expansion indices are stored
+        interval (float): seconds between two checks for changes
+        precision (str): the precision the encoder runs in, see precision.py
+        versions (Dict[str, float], optional): more model timestamps in modeldir,
+            with their share of the requests
+    """
+
+    def __init__(
+        self,
+        modeldir: Path,
+        modelversion: str,
+        cachedir: Path,
+        interval: float,
+        precision: str = "fp32",
+        versions: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.modeldir = Path(modeldir)
+        self.modelpath = self.modeldir / f"{modelversion}{MODELSUFFIX}"
+        self.cachedir = Path(cachedir)
+        self.interval = interval
+        # what the encoder runs in, for the model and index caches and the metrics
+        self.precision = effective_precision(precision)
+        self.versions = dict(versions or {})
+        self.filehandler = FileHandler(filesettings)
+        # per version, the primary one first
+        self._deployments: Dict[str, Deployment] = {}
+        self._fingerprint: Fingerprint = ()
+        # the files of the last reload that failed
+        self._failed: Fingerprint = ()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"ModelRegistry(modeldir='{self.modeldir}', "
+            f"versions={list(self._deployments)})"
+        )
+
+    @property
+    def deployments(self) -> Dict[str, Deployment]:
+        """the live versions, the primary one first. A reload replaces the whole
+        dict, so a caller that keeps it sees one consistent set"""
+        if len(self._deployments) == 0:
+            self.load()
+        return self._deployments
+
+    @property
+    def current(self) -> Deployment:
+        """the primary version"""
+        return next(iter(self.deployments.values()))
+
+    def weights(self) -> Dict[str, float]:
+        """the share of the requests without a version, per live version"""
+        names = list(self.deployments)
+        weights = {name: self.versions.get(name, 0.0) for name in names[1:]}
+        return {names[0]: max(0.0, 1.0 - sum(weights.values())), **weights}
+
+    def choose(self, version: Optional[str] = None) -> str:
+        """the version that serves a request: the one asked for, or one drawn by
+        the weights. Raises a KeyError when the version asked for is not live."""
+        if version is not None:
+            if version not in self.deployments:
+                raise KeyError(version)
+            return version
+        weights = self.weights()
+        if sum(weights.values()) <= 0:
+            return next(iter(weights))
+        return random.choices(list(weights), list(weights.values()))[0]
+
+    def _version_paths(self) -> List[Path]:
+        """the extra versions that exist in modeldir"""
+        paths = [self.modeldir / f"{v}{MODELSUFFIX}" for v in self.versions]
+        return [path for path in paths if path.exists()]
+
+    def _paths(self) -> List[Optional[Path]]:
+        modelpath: Optional[Path] = self.modelpath
+        if not self.modelpath.exists():
+            modelpath = latest_model(self.modeldir)
+        mappath = self.filehandler.latest_mapping()
+        return [modelpath, *self._version_paths(), mappath]
+
+    def fingerprint(self) -> Fingerprint:
+        """the files that would be loaded now, with their size and mtime"""
+        stats = []
+        for path in self._paths():
+            if path is None:
+                continue
+            stat = path.stat()
+            stats.append((str(path), stat.st_mtime_ns, stat.st_size))
+        return tuple(stats)
+
+    def load(self) -> Deployment:
+        """builds the deployments from the current files and swaps them in,
+        returns the primary one"""
+        with self._lock:
+            fingerprint = self.fingerprint()
+            modelpath = check_model(self.modelpath)
+            mappath = self.filehandler.latest_mapping()
+            missing = set(self.versions) - {
+                path.name[: -len(MODELSUFFIX)] for path in self._version_paths()
+            }
+            if len(missing) > 0:
+                logger.warning(f"Versions {sorted(missing)} are not in {self.modeldir}")
+            deployments: Dict[str, Deployment] = {}
+            for path in dict.fromkeys([modelpath, *self._version_paths()]):
+                deployment = load_deployment(
+                    path, mappath, self.cachedir, self.precision
+                )
+                deployments[deployment.name] = deployment
+            self._deployments = deployments
+            self._fingerprint = fingerprint
+        for deployment in deployments.values():
+            logger.success(f"Serving {deployment}")
+        return self.current
+
+    def start(self) -> None:
+        if self._watcher is None:
+            self._stop.clear()
+            self._watcher = threading.Thread(
+                target=self._watch, name="model-registry", daemon=True
+            )
+            self._watcher.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            fingerprint: Optional[Fingerprint] = None
+            try:
+                fingerprint = self.fingerprint()
+                # files that failed to load are only tried again once they change
+                if fingerprint not in (self._fingerprint, self._failed):
+                    logger.info("Detected a new model or mapping, reloading")
+                    self.load()
+            except Exception:
+                logger.exception("Reloading failed, keeping the current deployment")
+                if fingerprint is not None:
+                    self._failed = fingerprint
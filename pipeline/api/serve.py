@@ -1,29 +1,292 @@
+from functools import partial
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 import api_config as cfg
-import torch
-from fastapi import FastAPI
-from inference import check_model, expand_abbreviation, get_invert_mapping
-from loguru import logger
+from batching import MicroBatcher
+from cache import ExpansionCache
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from inference import ExpandedSentence
+from monitoring import (
+    STAGE_BUCKETS,
+    MetricsMiddleware,
+    MetricsRegistry,
+    MonitoredTimer,
+    process_memory,
+)
+from pydantic import BaseModel
+from registry import ModelRegistry
+from streaming import DuplexStreamingResponse, expand_documents, read_documents
+from timing import set_timer
+from versions import ShadowStats, disambiguate_versions
 
 app = FastAPI()
 
-loaded_model = None
-inverted_dict = get_invert_mapping()
+registry = ModelRegistry(
+    modeldir=Path(cfg.MODELDIR),
+    modelversion=cfg.MODELVERSION,
+    cachedir=Path(cfg.CACHEDIR),
+    interval=cfg.RELOAD_INTERVAL,
+    precision=cfg.PRECISION,
+    versions=cfg.MODELVERSIONS,
+)
+
+cache = ExpansionCache(
+    maxsize=cfg.CACHE_SIZE,
+    ttl=cfg.CACHE_TTL,
+    window=cfg.CONTEXT_WINDOW,
+    window_maxsize=cfg.CONTEXT_CACHE_SIZE,
+)
+
+# how often the shadow versions agree with the served one, see versions.py
+shadow_stats = ShadowStats()
+
+# prometheus metrics on /metrics, see monitoring.py
+metrics = MetricsRegistry()
+request_latency = metrics.histogram(
+    "expander_request_seconds",
+    "Seconds from the request to the last byte of the response",
+    ["endpoint"],
+)
+request_count = metrics.counter(
+    "expander_requests_total",
+    "Requests per endpoint and status code",
+    ["endpoint", "status"],
+)
+stage_latency = metrics.histogram(
+    "expander_stage_seconds",
+    "Seconds per call of a stage, eg tokenize, roberta (the encoder) and score",
+    ["stage"],
+    STAGE_BUCKETS,
+)
+batch_size = metrics.histogram(
+    "expander_batch_size",
+    "Sentences per model call, after micro-batching",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128],
+)
+abbreviation_count = metrics.histogram(
+    "expander_abbreviations",
+    "Abbreviations detected per request",
+    ["endpoint"],
+    buckets=[0, 1, 2, 3, 5, 8, 13, 21, 34, 55],
+)
+queue_depth = metrics.gauge(
+    "expander_queue_depth", "Sentences waiting for the micro-batcher"
+)
+cache_entries = metrics.gauge("expander_cache_entries", "Cached entries", ["tier"])
+cache_hits = metrics.counter("expander_cache_hits_total", "Cache hits", ["tier"])
+cache_misses = metrics.counter("expander_cache_misses_total", "Cache misses", ["tier"])
+model_info = metrics.gauge(
+    "expander_model_info",
+    "The live versions, always 1",
+    ["name", "model", "mapping", "version", "precision"],
+)
+version_weight = metrics.gauge(
+    "expander_version_weight", "Share of the requests per version", ["version"]
+)
+version_sentences = metrics.counter(
+    "expander_version_sentences_total", "Sentences served per version", ["version"]
+)
+shadow_decided = metrics.counter(
+    "expander_shadow_abbreviations_total",
+    "Abbreviations decided by both the served and a shadow version",
+    ["served", "shadow"],
+)
+shadow_agreed = metrics.counter(
+    "expander_shadow_agreed_total",
+    "Abbreviations a shadow version expanded like the served version",
+    ["served", "shadow"],
+)
+resident_memory = metrics.gauge(
+    "process_resident_memory_bytes", "Resident memory of this worker"
+)
+virtual_memory = metrics.gauge(
+    "process_virtual_memory_bytes", "Virtual memory of this worker"
+)
+peak_memory = metrics.gauge(
+    "process_peak_resident_memory_bytes", "Peak resident memory of this worker"
+)
+
+# wall time per stage of the requests, see timing.py, also kept in stage_latency
+timer = MonitoredTimer(stage_latency)
+set_timer(timer)
+
+
+class BatchRequest(BaseModel):
+    sentences: List[str]
+    # a live version, see /versions. None picks one by the traffic weights
+    version: Optional[str] = None
+
+
+def expand(items: List[Tuple[str, str]]) -> List[ExpandedSentence]:
+    """expands (sentence, version) pairs"""
+    # a reload swaps registry.deployments, this batch keeps the ones it started with
+    deployments = registry.deployments
+    batch_size.observe(len(items))
+    return disambiguate_versions(
+        [sentence for sentence, _ in items],
+        [version for _, version in items],
+        deployments,
+        cache,
+        cfg.SHADOW,
+        shadow_stats,
+    )
+
+
+def choose(version: Optional[str]) -> str:
+    try:
+        name = registry.choose(version)
+    except KeyError:
+        raise HTTPException(
+            404, f"Version {version} is not live, see /versions"
+        ) from None
+    return name
+
+
+async def submit_many(sentences: List[str], version: str) -> List[ExpandedSentence]:
+    version_sentences.inc(version, amount=len(sentences))
+    return await batcher.submit_many([(sentence, version) for sentence in sentences])
+
+
+batcher = MicroBatcher(
+    expand, max_batch_size=cfg.MAX_BATCH_SIZE, window=cfg.BATCH_WINDOW_MS / 1000
+)
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    registry.load()
+    registry.start()
+    batcher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await batcher.stop()
+    registry.stop()
+
+
+@app.get("/model")
+async def model() -> Dict:
+    deployment = registry.current
+    return {
+        "model": deployment.modelpath.name,
+        "mapping": deployment.mappath.name,
+        "version": deployment.version,
+        "precision": registry.precision,
+    }
+
+
+@app.get("/versions")
+async def versions() -> Dict:
+    """the live versions with their share of the requests, and how often the
+    shadow versions agree with the served one"""
+    weights = registry.weights()
+    return {
+        "versions": [
+            {
+                "name": name,
+                "model": deployment.modelpath.name,
+                "version": deployment.version,
+                "weight": weights[name],
+            }
+            for name, deployment in registry.deployments.items()
+        ],
+        "shadow": cfg.SHADOW,
+        "agreement": shadow_stats.summary(),
+    }
+
+
+@app.get("/cache")
+async def cache_stats() -> Dict:
+    return cache.stats()
+
+
+@app.get("/timing")
+async def timing(reset: bool = False) -> Dict:
+    """the seconds per stage of the sentences expanded since the start, or since
+    the last call with reset=true"""
+    stats = {
+        "sentences": timer.examples,
+        "sentences_per_sec": timer.throughput(),
+        "stages": timer.summary(),
+    }
+    if reset:
+        timer.reset()
+    return stats
+
+
+@app.get("/metrics")
+async def prometheus() -> PlainTextResponse:
+    """all metrics of this worker in the Prometheus text format"""
+    weights = registry.weights()
+    model_info.replace(
+        {
+            (
+                name,
+                deployment.modelpath.name,
+                deployment.mappath.name,
+                deployment.version,
+                registry.precision,
+            ): 1
+            for name, deployment in registry.deployments.items()
+        }
+    )
+    version_weight.replace({(name,): weight for name, weight in weights.items()})
+    pairs = [(s["served"], s["shadow"], s) for s in shadow_stats.summary()]
+    shadow_decided.replace({(a, b): s["abbreviations"] for a, b, s in pairs})
+    shadow_agreed.replace({(a, b): s["agreed"] for a, b, s in pairs})
+    stats = cache.stats()
+    cache_entries.replace({(tier,): s["size"] for tier, s in stats.items()})
+    cache_hits.replace({(tier,): s["hits"] for tier, s in stats.items()})
+    cache_misses.replace({(tier,): s["misses"] for tier, s in stats.items()})
+    queue_depth.set(batcher.queue.qsize() if batcher.queue is not None else 0)
+    memory = process_memory()
+    resident_memory.set(memory["resident"])
+    virtual_memory.set(memory["virtual"])
+    peak_memory.set(memory["peak_resident"])
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/expand_sentence")
-async def expand_sentence(sentence: str) -> Dict:
-    global loaded_model
-    modelpath = f"{cfg.MODELDIR}/{cfg.MODELVERSION}trainedmodel.pt"
+async def expand_sentence(sentence: str, version: Optional[str] = None) -> Dict:
+    (result,) = await submit_many([sentence], choose(version))
+    abbreviation_count.observe(len(result.abbreviations), "/expand_sentence")
+    return result.dict()
+
+
+@app.post("/expand_batch")
+async def expand_sentences(request: BatchRequest) -> Dict:
+    version = choose(request.version)
+    results = await submit_many(request.sentences, version)
+    found = sum(len(result.abbreviations) for result in results)
+    abbreviation_count.observe(found, "/expand_batch")
+    return {
+        "expanded_sentences": [result.expanded_sentence for result in results],
+        "abbreviations": [result.abbreviations for result in results],
+        "version": version,
+    }
+
 
-    modelpath = str(check_model(Path(modelpath)))
-    logger.info(f"using {modelpath}")
+@app.post("/expand_stream")
+async def expand_stream(
+    request: Request, version: Optional[str] = None
+) -> DuplexStreamingResponse:
+    """Expands documents sent as ndjson ({"id": ..., "text": ...} per line) or as
+    plain text with one document per line, and streams back one json line per
+    document while the body is still uploading. One version serves the stream."""
+    ndjson = "json" in request.headers.get("content-type", "")
+    documents = read_documents(request.stream(), ndjson, cfg.MAX_DOCUMENT_BYTES)
+    submit = partial(submit_many, version=choose(version))
+    lines = expand_documents(documents, submit, cfg.STREAM_MAX_PENDING)
+    return DuplexStreamingResponse(lines, media_type="application/x-ndjson")
 
-    if loaded_model is None:
-        # lazy loading the model
-        loaded_model = torch.load(modelpath, map_location=torch.device("cpu"))
-    expanded_sentence = expand_abbreviation(sentence, inverted_dict, loaded_model)
 
-    return {"expanded_sentence": expanded_sentence}
+# after the routes, so the middleware knows the endpoints
+app.add_middleware(
+    MetricsMiddleware,
+    latency=request_latency,
+    requests=request_count,
+    paths=[route.path for route in app.routes],  # type: ignore
+)
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import List
 
 from pydantic import BaseModel
 
@@ -9,6 +10,11 @@ class Settings(BaseModel):
     hidden: int
     aggtype: str
     nonlinear: str
+    # upper bounds of the token length buckets that are encoded together
+    buckets: List[int] = [16, 32, 64, 128, 256, 512]
+    # "fp32", or "bf16" to run the roberta forward under cpu autocast. Serving
+    # converts the encoder to api_config.PRECISION instead, see precision.py
+    precision: str = "fp32"
     epochs: int
     train_steps: int
     eval_steps: int
@@ -48,7 +54,7 @@ filesettings = FileSettings(
     datadir=Path("assets"),
     processed=Path("assets/processed/"),
     mappingsuffix=".json",
-    datasuffix=".csv",
+    datasuffix=".parq",
     sep="|",
 )
 
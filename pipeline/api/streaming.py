@@ -0,0 +1,203 @@
+import asyncio
+import json
+import re
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from inference import ExpandedSentence
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# a sentence ends at a newline, or at . ! ? followed by whitespace
+SENTENCE_END = re.compile(r"\n+|(?<=[.!?])\s+")
+
+
+class Document(NamedTuple):
+    id: Union[int, str]
+    text: str
+    error: Optional[str] = None
+
+
+class Pending(NamedTuple):
+    document: Document
+    spans: List[Tuple[int, int]]
+    task: asyncio.Future
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """A StreamingResponse that can be sent while the request body is still read.
+
+    StreamingResponse listens for a disconnect on receive() while it streams, which
+    would swallow the request body. Here the body reader is the only consumer of
+    receive(), and it notices a disconnect itself.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def iter_lines(
+    chunks: AsyncIterator[bytes], max_length: int
+) -> AsyncIterator[Optional[bytes]]:
+    """splits a byte stream into lines without holding more than one line.
+
+    Yields None instead of a line that is longer than max_length, the rest of
+    that line is skipped.
+    """
+    buffer = b""
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        while b"\n" in buffer:
+            line, _, buffer = buffer.partition(b"\n")
+            if skipping:
+                skipping = False
+            elif len(line) > max_length:
+                # a whole line can arrive in one chunk, the buffer never saw it
+                yield None
+            else:
+                yield line
+        if len(buffer) > max_length:
+            if not skipping:
+                yield None
+                skipping = True
+            buffer = b""
+    if buffer and not skipping:
+        yield buffer
+
+
+async def read_documents(
+    chunks: AsyncIterator[bytes], ndjson: bool, max_length: int
+) -> AsyncIterator[Document]:
+    """parses the request body into documents.
+
+    With ndjson, every line is a json object with a "text" and an optional "id",
+    or a json string. Otherwise every line is a document, with the line number
+    as id. Lines that can not be parsed become a Document with an error.
+    """
+    number = 0
+    async for line in iter_lines(chunks, max_length):
+        number += 1
+        if line is None:
+            yield Document(number, "", f"document longer than {max_length} bytes")
+            continue
+        if not line.strip():
+            continue
+        if not ndjson:
+            yield Document(number, line.decode("utf-8", errors="replace"))
+            continue
+        try:
+            item = json.loads(line)
+            if isinstance(item, str):
+                yield Document(number, item)
+            else:
+                yield Document(item.get("id", number), str(item["text"]))
+        except (ValueError, KeyError, AttributeError) as e:
+            yield Document(number, "", f"invalid document: {e!r}")
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """the (start, end) offsets of the sentences in text, whitespace excluded"""
+    spans = []
+    start = 0
+    for separator in SENTENCE_END.finditer(text):
+        if separator.start() > start:
+            spans.append((start, separator.start()))
+        start = separator.end()
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def merge(
+    document: Document, spans: List[Tuple[int, int]], results: List[ExpandedSentence]
+) -> Dict:
+    """puts the expanded sentences back into the document, keeping the text
+    between the sentences, and shifts the offsets to the document"""
+    text = document.text
+    pieces = []
+    abbreviations = []
+    cursor = 0
+    for (start, end), result in zip(spans, results):
+        pieces.append(text[cursor:start])
+        pieces.append(result.expanded_sentence)
+        cursor = end
+        for occurrence in result.abbreviations:
+            abbreviations.append(
+                occurrence.copy(
+                    update={
+                        "start": occurrence.start + start,
+                        "end": occurrence.end + start,
+                    }
+                ).dict()
+            )
+    pieces.append(text[cursor:])
+    return {
+        "id": document.id,
+        "expanded_text": "".join(pieces),
+        "abbreviations": abbreviations,
+    }
+
+
+def encode(record: Dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def expand_documents(
+    documents: AsyncIterator[Document],
+    submit_many: Callable[[List[str]], Awaitable[List[ExpandedSentence]]],
+    max_pending: int,
+) -> AsyncIterator[bytes]:
+    """Expands documents while they are read, and yields one ndjson line per
+    document, in input order.
+
+    Sentences are submitted as soon as a document is read, so they are batched
+    with each other and with concurrent requests. At most max_pending sentences are
+    in flight: after that, no more input is read until the oldest document is
+    done and written out. Because the response is only pulled as fast as the
+    client reads it, a slow reader also stops the input.
+    """
+    pending: Deque[Pending] = deque()
+    in_flight = 0
+    try:
+        async for document in documents:
+            spans = [] if document.error else split_sentences(document.text)
+            sentences = [document.text[start:end] for start, end in spans]
+            task = asyncio.ensure_future(submit_many(sentences))
+            pending.append(Pending(document, spans, task))
+            in_flight += len(spans)
+
+            while pending and (pending[0].task.done() or in_flight > max_pending):
+                item = pending.popleft()
+                in_flight -= len(item.spans)
+                yield await finish(item)
+
+        while pending:
+            yield await finish(pending.popleft())
+    finally:
+        # when the client went away, the remaining sentences do not need the model
+        for item in pending:
+            item.task.cancel()
+
+
+async def finish(item: Pending) -> bytes:
+    if item.document.error:
+        return encode({"id": item.document.id, "error": item.document.error})
+    try:
+        results = await item.task
+    except Exception as e:
+        return encode({"id": item.document.id, "error": repr(e)})
+    return encode(merge(item.document, item.spans, results))
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import artifacts
+import torch
+from artifacts import load_model, save_model
+from layers import AbbrvtExpander
+from precision import apply_precision
+from settings import modelsettings
+
+
+def test_two_artifacts_share_an_int8_encoder(
+    tiny_model: AbbrvtExpander, tmp_path: Path
+) -> None:
+    artifacts._encoders.clear()
+    modeldir = tmp_path / "mlflow"
+    modeldir.mkdir()
+    save_model(tiny_model, modeldir / "first.pt", modelsettings)
+    with torch.no_grad():
+        tiny_model.reducer[0].weight.mul_(2)
+    save_model(tiny_model, modeldir / "second.pt", modelsettings)
+
+    models = []
+    for name in ["first.pt", "second.pt"]:
+        model = load_model(modeldir / name, "int8")
+        model.eval()  # type: ignore
+        models.append(apply_precision(model, "int8"))
+    first, second = models
+
+    assert first.roberta is second.roberta  # type: ignore
+    expected = tiny_model.reducer.state_dict()
+    for name, tensor in second.reducer.state_dict().items():  # type: ignore
+        assert torch.equal(tensor, expected[name])
+    sentences = ("abc", "fed gh")
+    with torch.no_grad():
+        vectors = [model.vectorize(sentences) for model in models]  # type: ignore
+    assert not torch.allclose(vectors[0], vectors[1])
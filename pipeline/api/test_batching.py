@@ -0,0 +1,52 @@
+import asyncio
+from typing import List, Tuple
+
+import torch
+from batching import MicroBatcher
+from layers import AbbrvtExpander
+
+
+def test_a_failing_item_does_not_fail_its_batch() -> None:
+    def handler(items: List[str]) -> List[str]:
+        if "bad" in items:
+            raise ValueError("bad item")
+        return [item.upper() for item in items]
+
+    async def submit() -> Tuple:
+        batcher = MicroBatcher(handler, max_batch_size=8, window=0.05)
+        results = await asyncio.gather(
+            batcher.submit("good"), batcher.submit("bad"), return_exceptions=True
+        )
+        await batcher.stop()
+        return results
+
+    good, bad = asyncio.run(submit())
+    assert good == "GOOD"
+    assert isinstance(bad, ValueError)
+
+
+def test_an_overlong_sentence_next_to_a_normal_one(tiny_model: AbbrvtExpander) -> None:
+    tiny_model.eval()
+
+    def handler(items: List[str]) -> List[torch.Tensor]:
+        with torch.no_grad():
+            vectors = tiny_model.vectorize(tuple(items))
+        return list(vectors.reshape(len(items), -1))
+
+    limit = tiny_model.roberta.config.max_position_embeddings
+    overlong = " ".join(["abc"] * 4 * limit)
+    assert len(tiny_model.tokenizer(overlong)["input_ids"]) > limit
+
+    async def submit() -> Tuple:
+        batcher = MicroBatcher(handler, max_batch_size=8, window=0.05)
+        results = await asyncio.gather(
+            batcher.submit("fed gh"), batcher.submit(overlong)
+        )
+        await batcher.stop()
+        return results
+
+    good, long = asyncio.run(submit())
+    with torch.no_grad():
+        alone = tiny_model.vectorize(("fed gh",)).reshape(-1)
+    assert torch.allclose(good, alone, atol=1e-5)
+    assert long.shape == good.shape
@@ -0,0 +1,104 @@
+"""Wall time per stage of the hot paths.
+
+The stages are marked in the code with `with stage("roberta"):`, which does
+nothing until a StageTimer is activated with set_timer. Stages can be nested,
+eg "roberta" runs inside "context", so their times do not add up to the total.
+Stages that run in other threads, like "tokenize" in the Prefetcher, are counted
+as well, also when they overlap with the main thread.
+
+With record=True, every stage is also a torch.profiler range, so the stages show
+up by name in a profiler trace.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import torch
+
+
+class StageTimer:
+    """Accumulates the seconds and the calls per stage, and the examples seen.
+
+    Args:
+        record (bool): also mark the stages for torch.profiler
+    """
+
+    def __init__(self, record: bool = False) -> None:
+        self.record = record
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"StageTimer(stages={list(self.seconds)}, examples={self.examples})"
+
+    def reset(self) -> None:
+        with self._lock:
+            self.seconds: Dict[str, float] = {}
+            self.calls: Dict[str, int] = {}
+            self.examples = 0
+            self.started = time.perf_counter()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, examples: int) -> None:
+        with self._lock:
+            self.examples += examples
+
+    def throughput(self) -> float:
+        """examples per second since the last reset"""
+        return self.examples / max(time.perf_counter() - self.started, 1e-9)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """per stage: the total seconds, the calls and the mean milliseconds"""
+        with self._lock:
+            return {
+                name: {
+                    "seconds": seconds,
+                    "calls": self.calls[name],
+                    "mean_ms": seconds / self.calls[name] * 1e3,
+                }
+                for name, seconds in self.seconds.items()
+            }
+
+
+_timer: Optional[StageTimer] = None
+
+
+def set_timer(timer: Optional[StageTimer]) -> Optional[StageTimer]:
+    """activates timer for all stages in this process, returns the previous one"""
+    global _timer
+    previous, _timer = _timer, timer
+    return previous
+
+
+def get_timer() -> Optional[StageTimer]:
+    return _timer
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    timer = _timer
+    if timer is None:
+        yield
+        return
+    tic = time.perf_counter()
+    try:
+        if timer.record:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+    finally:
+        timer.add(name, time.perf_counter() - tic)
+
+
+def count(examples: int) -> None:
+    """adds examples to the active timer, for the examples per second"""
+    timer = _timer
+    if timer is not None:
+        timer.count(examples)
@@ -0,0 +1,176 @@
+"""Serves a batch with several live model versions, see ModelRegistry.
+
+Every sentence in a batch is served by the version it was routed to. With
+shadow scoring, the other live versions decide the same sentences as well,
+without changing the response, and ShadowStats counts how often they agree with
+the served version.
+
+Versions that share an encoder (see artifacts.py) share its forward pass: the
+sentences that any of them still has to decide are encoded once, and every
+version only runs its own reducer on the pooled vectors and scores them against
+its own expansion index. A shadow version costs a reducer pass and a few small
+matmuls, not an encoder pass. Versions with their own encoder, eg models that
+were pickled whole, get a pass of their own.
+"""
+
+import threading
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+from cache import Decisions, ExpansionCache
+from inference import ExpandedSentence, decide, rebuild
+from registry import Deployment
+from timing import count, stage
+
+
+class ShadowStats:
+    """Counts, per served and shadow version, the abbreviations both decided and
+    how many of them got the same expansion"""
+
+    def __init__(self) -> None:
+        self._counts: Dict[Tuple[str, str], List[int]] = defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"ShadowStats(pairs={len(self._counts)})"
+
+    def add(self, served: str, shadow: str, decided: int, agreed: int) -> None:
+        with self._lock:
+            counts = self._counts[(served, shadow)]
+            counts[0] += decided
+            counts[1] += agreed
+
+    def summary(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "served": served,
+                    "shadow": shadow,
+                    "abbreviations": decided,
+                    "agreed": agreed,
+                    "agreement": agreed / decided if decided > 0 else 0.0,
+                }
+                for (served, shadow), (decided, agreed) in self._counts.items()
+            ]
+
+
+def encoder_key(deployment: Deployment) -> Hashable:
+    """versions with the same key get the same pooled vectors from the encoder"""
+    model = deployment.model
+    return (
+        id(model.roberta),  # type: ignore
+        model.aggtype,  # type: ignore
+        model.precision,  # type: ignore
+        tuple(model.buckets),  # type: ignore
+    )
+
+
+def compare(
+    served: str,
+    decisions: Decisions,
+    shadows: Dict[str, Optional[Decisions]],
+    stats: ShadowStats,
+) -> None:
+    for shadow, other in shadows.items():
+        if other is None:
+            continue
+        both = [abbr for abbr in decisions if abbr in other]
+        agreed = sum(decisions[abbr][0] == other[abbr][0] for abbr in both)
+        stats.add(served, shadow, len(both), agreed)
+
+
+def disambiguate_versions(
+    sentences: Sequence[str],
+    served: Sequence[str],
+    deployments: Dict[str, Deployment],
+    cache: Optional[ExpansionCache] = None,
+    shadow: bool = False,
+    stats: Optional[ShadowStats] = None,
+) -> List[ExpandedSentence]:
+    """Resolves the abbreviations in a batch, every sentence with its own version.
+
+    Args:
+        sentences (Sequence[str]): the batch
+        served (Sequence[str]): per sentence, the version that serves it. A
+            version that is no longer live is served by the primary one.
+        deployments (Dict[str, Deployment]): the live versions, the primary first.
+            They share the mapping, so the abbreviations are detected once.
+        cache (ExpansionCache, optional): keyed by the version of a deployment
+        shadow (bool): let every live version decide every sentence
+        stats (ShadowStats, optional): counts the agreement of the shadow versions
+    """
+    count(len(sentences))
+    primary = next(iter(deployments))
+    served = [name if name in deployments else primary for name in served]
+    detector = deployments[primary].detector
+    with stage("detect"):
+        found = [detector.find(sentence) for sentence in sentences]
+
+    # per version, the decision per row it has to make, None until it is made
+    decisions: Dict[str, Dict[int, Optional[Decisions]]] = {}
+    with stage("cache"):
+        for name, deployment in deployments.items():
+            rows: Dict[int, Optional[Decisions]] = {}
+            for i, (sentence, matches) in enumerate(zip(sentences, found)):
+                if served[i] != name and not (shadow and len(matches) > 0):
+                    continue
+                if len(matches) == 0:
+                    rows[i] = {}
+                elif cache is not None:
+                    rows[i] = cache.lookup(deployment.version, sentence, matches)
+                else:
+                    rows[i] = None
+            decisions[name] = rows
+
+    groups: Dict[Hashable, List[str]] = defaultdict(list)
+    for name, deployment in deployments.items():
+        groups[encoder_key(deployment)].append(name)
+    for names in groups.values():
+        todo = {
+            name: [i for i, decision in decisions[name].items() if decision is None]
+            for name in names
+        }
+        # one encoder pass over the rows any version in the group still needs
+        needed = sorted({i for pending in todo.values() for i in pending})
+        if len(needed) == 0:
+            continue
+        position = {i: row for row, i in enumerate(needed)}
+        first = deployments[names[0]].model
+        with stage("vectorize"), torch.no_grad():
+            pooled = first.encode(tuple(sentences[i] for i in needed))  # type: ignore
+        for name in names:
+            pending = todo[name]
+            if len(pending) == 0:
+                continue
+            deployment = deployments[name]
+            # only the reducer of this version runs on the pooled vectors
+            selected = pooled[[position[i] for i in pending]]
+            with torch.no_grad():
+                vectors = deployment.model.vectorize(selected)  # type: ignore
+            with stage("decide"):
+                for i, context in zip(pending, vectors.reshape(len(pending), -1)):
+                    decision = decide(found[i], context, deployment.index)
+                    if cache is not None:
+                        cache.store(
+                            deployment.version, sentences[i], found[i], decision
+                        )
+                    decisions[name][i] = decision
+
+    if shadow and stats is not None and len(deployments) > 1:
+        with stage("shadow"):
+            for i, name in enumerate(served):
+                if len(found[i]) == 0:
+                    continue
+                shadows = {
+                    other: decisions[other][i] for other in deployments if other != name
+                }
+                compare(name, decisions[name][i], shadows, stats)  # type: ignore
+
+    with stage("rebuild"):
+        results = []
+        for i, (sentence, matches) in enumerate(zip(sentences, found)):
+            result = rebuild(sentence, matches, decisions[served[i]][i])  # type: ignore
+            result.version = served[i]
+            results.append(result)
+        return results
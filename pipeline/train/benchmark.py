@@ -0,0 +1,546 @@
+"""Benchmarks for the training hot paths.
+
+Run from the root of the repository, eg:
+    python pipeline/train/benchmark.py tokenize --corpus assets/raw/corpus.txt
+    python pipeline/train/benchmark.py precision --model mlflow/x.pt
+    python pipeline/train/benchmark.py ddp --ranks 1 2 4 8
+    python pipeline/train/benchmark.py suite --output bench.json --baseline old.json
+
+The suite runs offline on generated data, and writes its results to a json file
+that is compared with the results of an earlier run when given (see also the
+suite of pipeline/api/benchmark.py).
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import string
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import artifacts
+import distributed
+import polars as pl
+import torch
+from datatools import Datastreamer, FileHandler, LazyTxtDataset, TxtDataset
+from layers import AbbrvtExpander
+from loguru import logger
+from metrics import Accuracy
+from settings import DataSettings, datasettings, filesettings, modelsettings
+from tokenstore import build_tokenstore
+from transformers import RobertaTokenizer, RobertaTokenizerFast
+
+# the fields that identify a row of results, see row_id
+CONFIG = ["mode", "bucketsize", "batchsize", "method", "precision", "ranks"]
+
+
+def timeit(func: Callable, repeat: int) -> float:
+    """best wall time of repeat calls, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def load_sentences(path: Path, limit: Optional[int] = None) -> List[str]:
+    with open(path, "r") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+    return sentences[:limit]
+
+
+def bench_tokenize(
+    sentences: Sequence[str],
+    modelpath: str,
+    tokendir: Optional[Path] = None,
+    batchsize: int = 32,
+    repeat: int = 3,
+) -> List[Dict]:
+    """compares the slow and the fast tokenizer with lookups in the token store.
+
+    Every method turns all sentences, in batches, into the padded tensors the
+    encoder gets (AbbrvtExpander.tokenize). The store is built first, the time
+    that takes is reported separately.
+    """
+    slow = RobertaTokenizer.from_pretrained(
+        modelpath, cache_dir=modelsettings.cache_dir
+    )
+    fast = RobertaTokenizerFast.from_pretrained(
+        modelpath, cache_dir=modelsettings.cache_dir
+    )
+    model = AbbrvtExpander(modelsettings.copy(update={"modelpath": modelpath}))
+    batches = []
+    for start in range(0, len(sentences), batchsize):
+        end = start + batchsize
+        batches.append(tuple(sentences[start:end]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tic = time.perf_counter()
+        store = build_tokenstore(slow, sentences, tokendir or Path(tmp))
+        build = time.perf_counter() - tic
+
+        def tokenizer(tok: Callable) -> Callable:
+            def run() -> None:
+                model.tokenizer = tok
+                for batch in batches:
+                    model.tokenize(batch)
+
+            return run
+
+        def lookup() -> None:
+            model.tokenizer = slow
+            for batch in batches:
+                model.tokenize(store.lookup(batch))
+
+        methods = {
+            "slow": tokenizer(slow),
+            "fast": tokenizer(fast),
+            "store": lookup,
+        }
+        results: List[Dict] = []
+        for name, method in methods.items():
+            seconds = timeit(method, repeat)
+            results.append(
+                {
+                    "method": name,
+                    "seconds": seconds,
+                    "sentences_per_sec": len(sentences) / seconds,
+                }
+            )
+
+        # the ids of the store are those of the slow tokenizer
+        for batch in batches[:10]:
+            model.tokenizer = slow
+            expected = model.tokenize(batch)
+            found = model.tokenize(store.lookup(batch))
+            for e, f in zip(expected.buckets, found.buckets):
+                assert all(torch.equal(e[k], f[k]) for k in e), "store ids differ"
+
+    baseline = results[0]["seconds"]
+    logger.info(f"built the store for {len(sentences)} sentences in {build:.2f} s")
+    for result in results:
+        logger.info(
+            f"{result['method']:>5}: {result['seconds']:7.3f} s, "
+            f"{result['sentences_per_sec']:10.0f} sentences/s "
+            f"({baseline / result['seconds']:.1f}x)"
+        )
+    return results
+
+
+def load_testset(testfile: Path, batchsize: int) -> TxtDataset:
+    data = FileHandler(filesettings).load_data(testfile)
+    settings = DataSettings(
+        targetcol="expansion", txtcol="sample", trainfrac=1.0, batchsize=batchsize
+    )
+    return TxtDataset(data, settings)
+
+
+def train_steps(model: AbbrvtExpander, stream: Iterator, steps: int) -> List[float]:
+    """trains the reducer like trainloop.trainbatches, returns the seconds per step"""
+    loss_fn = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.reducer.parameters(), lr=1e-3)
+    model.train()
+    times = []
+    for _ in range(steps):
+        X, y_, y = next(stream)  # noqa N806
+        tic = time.perf_counter()
+        optimizer.zero_grad()
+        loss = loss_fn(model(X, y_), y)
+        loss.backward()
+        distributed.allreduce_gradients(model)
+        optimizer.step()
+        times.append(time.perf_counter() - tic)
+    return times
+
+
+def bench_precision(
+    model: AbbrvtExpander,
+    mapping: Dict[str, str],
+    testfile: Path,
+    precisions: Sequence[str],
+    batchsize: int = 32,
+    steps: int = 10,
+) -> List[Dict]:
+    """step time, test time and accuracy on the test set per encoder precision.
+
+    A step is a train step of the reducer (forward, backward and an Adam update)
+    on a batch of the test set. The reducer is reset after every precision, so
+    every precision is measured on the same weights.
+    """
+    dataset = load_testset(testfile, batchsize)
+    accuracy = Accuracy()
+    reducer = {k: v.clone() for k, v in model.reducer.state_dict().items()}
+
+    results = []
+    for precision in precisions:
+        model.precision = precision
+        stream = Datastreamer(dataset, batchsize, mapping, seed=0).stream()
+        # the first step is a warmup
+        times = train_steps(model, stream, steps + 1)
+        model.reducer.load_state_dict(reducer)
+
+        model.eval()
+        test = Datastreamer(dataset, len(dataset), mapping).stream()
+        X, y_, y = next(test)  # noqa N806
+        tic = time.perf_counter()
+        with torch.no_grad():
+            yhat = model(X, y_)
+        seconds = time.perf_counter() - tic
+        results.append(
+            {
+                "precision": precision,
+                "step_ms": sum(times[1:]) / steps * 1e3,
+                "test_s": seconds,
+                "accuracy": float(accuracy(y, yhat)),  # type: ignore
+            }
+        )
+
+    baseline: Dict = results[0]
+    for result in results:
+        logger.info(
+            f"{result['precision']:>5}: {result['step_ms']:8.1f} ms/step "
+            f"({baseline['step_ms'] / result['step_ms']:.2f}x), test set in "
+            f"{result['test_s']:6.2f} s, accuracy {result['accuracy']:.3f} "
+            f"({result['accuracy'] - baseline['accuracy']:+.3f})"
+        )
+    return results
+
+
+def ddp_worker(
+    rank: int,
+    world: int,
+    port: int,
+    modelpath: Optional[Path],
+    mapping: Dict[str, str],
+    testfile: Path,
+    batchsize: int,
+    steps: int,
+) -> Dict:
+    """one rank of bench_ddp, it runs in its own process"""
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        WORLD_SIZE=str(world),
+        LOCAL_WORLD_SIZE=str(world),
+    )
+    distributed.init()
+    torch.manual_seed(0)
+    model = load_model(modelpath)
+    distributed.broadcast_parameters(model)
+    dataset = load_testset(testfile, batchsize)
+    stream = Datastreamer(
+        dataset, batchsize, mapping, seed=0, rank=rank, world=world
+    ).stream()
+    train_steps(model, stream, 1)  # warmup
+    distributed.barrier()
+    tic = time.perf_counter()
+    train_steps(model, stream, steps)
+    distributed.barrier()
+    seconds = time.perf_counter() - tic
+
+    # all ranks should still have the same weights
+    weights = torch.cat([p.detach().reshape(-1) for p in model.reducer.parameters()])
+    reference = weights.clone()
+    if world > 1:
+        torch.distributed.broadcast(reference, src=0)
+    drift = distributed.allreduce_mean(
+        {"drift": float((weights - reference).abs().max())}
+    )["drift"]
+    distributed.cleanup()
+    return {"seconds": seconds, "drift": drift}
+
+
+def bench_ddp(
+    modelpath: Optional[Path],
+    mapping: Dict[str, str],
+    testfile: Path,
+    worlds: Sequence[int],
+    batchsize: int = 32,
+    steps: int = 10,
+) -> List[Dict]:
+    """throughput of data-parallel training for every amount of ranks.
+
+    Every rank runs in its own process and trains the reducer on its shard of the
+    test set, like train.py does with torchrun. The batch size is per rank, so a
+    step of w ranks processes w times more examples.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for world in worlds:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        with ProcessPoolExecutor(max_workers=world, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    ddp_worker,
+                    rank,
+                    world,
+                    port,
+                    modelpath,
+                    mapping,
+                    testfile,
+                    batchsize,
+                    steps,
+                )
+                for rank in range(world)
+            ]
+            ranks = [future.result() for future in futures]
+        seconds = max(r["seconds"] for r in ranks)
+        results.append(
+            {
+                "ranks": world,
+                "examples_per_sec": world * batchsize * steps / seconds,
+                "step_ms": seconds / steps * 1e3,
+                "drift": max(r["drift"] for r in ranks),
+            }
+        )
+
+    baseline: Dict = results[0]
+    for result in results:
+        speedup = result["examples_per_sec"] / baseline["examples_per_sec"]
+        logger.info(
+            f"{result['ranks']:>3} ranks: {result['examples_per_sec']:8.1f} "
+            f"examples/s ({speedup:.2f}x, efficiency "
+            f"{speedup * baseline['ranks'] / result['ranks']:.2f}), "
+            f"{result['step_ms']:7.1f} ms/step, weight drift {result['drift']:.1e}"
+        )
+    return results
+
+
+def load_model(modelpath: Optional[Path]) -> AbbrvtExpander:
+    """a trained model, or a new one with the modelsettings"""
+    if modelpath is None:
+        return AbbrvtExpander(modelsettings)
+    return artifacts.load_model(modelpath)  # type: ignore
+
+
+def random_data(
+    rows: int, expansions: int, seed: int = 42
+) -> Tuple[pl.DataFrame, Dict]:
+    """sentences of 5 to 60 words with a label, and a mapping of the labels to
+    acronyms that have 1 to 4 expansions each"""
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=6)) for _ in range(2000)]
+    labels = [" ".join(rng.choices(words, k=3)) for _ in range(expansions)]
+    mapping: Dict[str, str] = {}
+    acronym = 0
+    for label in labels:
+        if rng.random() < 0.4:
+            acronym += 1
+        mapping[label] = f"A{acronym}"
+    txt = [" ".join(rng.choices(words, k=rng.randint(5, 60))) for _ in range(rows)]
+    targets = rng.choices(labels, k=rows)
+    return pl.DataFrame({"txt": txt, "label": targets}), mapping
+
+
+def bench_datastreamer(
+    rows: int = 100_000,
+    expansions: int = 1000,
+    batchsize: int = 32,
+    batches: int = 1000,
+    window: int = 10_000,
+) -> List[Dict]:
+    """batches per second of Datastreamer.stream, for an in memory dataset with
+    and without bucketing and for a LazyTxtDataset on parquet shards. The time to
+    set up the streamer, which encodes the labels, is reported separately."""
+    data, mapping = random_data(rows, expansions)
+    settings = datasettings.copy(update={"batchsize": batchsize})
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        shards = []
+        for i, start in enumerate(range(0, rows, 4 * window)):
+            shards.append(Path(tmp) / f"shard-{i:05d}.parq")
+            data.slice(start, 4 * window).write_parquet(shards[-1])
+        lazy = LazyTxtDataset(shards, settings, FileHandler(filesettings), window)
+        setups = [
+            ("memory", TxtDataset(data, settings), 1),
+            ("memory", TxtDataset(data, settings), 16),
+            ("lazy", lazy, 1),
+            ("lazy", lazy, 16),
+        ]
+        for mode, dataset, bucketsize in setups:
+            tic = time.perf_counter()
+            streamer = Datastreamer(dataset, batchsize, mapping, bucketsize, seed=0)
+            setup = time.perf_counter() - tic
+            stream = streamer.stream()
+            tic = time.perf_counter()
+            for _ in range(batches):
+                next(stream)
+            seconds = time.perf_counter() - tic
+            result = {
+                "mode": mode,
+                "bucketsize": bucketsize,
+                "batchsize": batchsize,
+                "setup_s": setup,
+                "batches_per_sec": batches / seconds,
+            }
+            logger.info(
+                f"Datastreamer {mode:>6}, bucketsize {bucketsize:>2}: "
+                f"{result['batches_per_sec']:8.1f} batches/s, setup {setup:.2f} s"
+            )
+            results.append(result)
+    return results
+
+
+def row_id(row: object, i: int) -> str:
+    """identifies a row of results by its configuration, eg mode=lazy,bucketsize=1,
+    so runs with other configurations can still be compared"""
+    if not isinstance(row, dict):
+        return str(i)
+    config = [f"{key}={row[key]}" for key in CONFIG if key in row]
+    return ",".join(config) if config else str(i)
+
+
+def flatten(results: object, prefix: str = "") -> Dict[str, float]:
+    """the numbers in nested results, by their path"""
+    if isinstance(results, dict):
+        items = [(f"{prefix}.{k}" if prefix else str(k), v) for k, v in results.items()]
+    elif isinstance(results, list):
+        items = [(f"{prefix}[{row_id(v, i)}]", v) for i, v in enumerate(results)]
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        return {prefix: float(results)}
+    else:
+        return {}
+    flat: Dict[str, float] = {}
+    for key, value in items:
+        flat.update(flatten(value, key))
+    return flat
+
+
+def compare(results: Dict, baseline: Dict) -> Dict[str, float]:
+    """the relative change of every number that is also in the baseline"""
+    current, previous = flatten(results), flatten(baseline)
+    changes = {}
+    for key, value in current.items():
+        if key in previous and previous[key] != 0 and value != previous[key]:
+            changes[key] = value / previous[key] - 1
+            logger.info(
+                f"{key}: {previous[key]:.4g} -> {value:.4g} ({changes[key]:+.1%})"
+            )
+    return changes
+
+
+def run_suite(
+    output: Path,
+    baseline: Optional[Path] = None,
+    rows: int = 100_000,
+    batchsize: int = 32,
+    batches: int = 1000,
+) -> Dict:
+    """runs the offline benchmarks and writes the results as json"""
+    results = {
+        "datastreamer": bench_datastreamer(rows, batchsize=batchsize, batches=batches)
+    }
+    report = {
+        "suite": "train",
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.success(f"Wrote the results to {output}")
+    if baseline is not None:
+        with open(baseline, "r") as f:
+            compare(results, json.load(f)["results"])
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    tokenize = subparsers.add_parser(
+        "tokenize", help="the token store against the slow and fast tokenizers"
+    )
+    tokenize.add_argument("--corpus", type=Path, default=Path("assets/raw/corpus.txt"))
+    tokenize.add_argument("--limit", type=int, default=None)
+    tokenize.add_argument("--model", type=str, default=modelsettings.modelpath)
+    tokenize.add_argument("--tokendir", type=Path, default=None)
+    tokenize.add_argument("--batchsize", type=int, default=32)
+    tokenize.add_argument("--repeat", type=int, default=3)
+
+    precision = subparsers.add_parser(
+        "precision", help="step time and test accuracy per encoder precision"
+    )
+    precision.add_argument("--model", type=Path, default=None)
+    precision.add_argument("--mapping", type=Path, default=None)
+    precision.add_argument(
+        "--testfile", type=Path, default=Path("assets/raw/test_set.csv")
+    )
+    precision.add_argument(
+        "--precisions", nargs="+", choices=["fp32", "bf16"], default=["fp32", "bf16"]
+    )
+    precision.add_argument("--batchsize", type=int, default=32)
+    precision.add_argument("--steps", type=int, default=10)
+
+    ddp = subparsers.add_parser(
+        "ddp", help="throughput of data-parallel training per amount of ranks"
+    )
+    ddp.add_argument("--model", type=Path, default=None)
+    ddp.add_argument("--mapping", type=Path, default=None)
+    ddp.add_argument("--testfile", type=Path, default=Path("assets/raw/test_set.csv"))
+    ddp.add_argument("--ranks", type=int, nargs="+", default=[1, 2, 4])
+    ddp.add_argument("--batchsize", type=int, default=32)
+    ddp.add_argument("--steps", type=int, default=10)
+
+    suite = subparsers.add_parser(
+        "suite", help="the offline benchmarks on generated data, as json"
+    )
+    suite.add_argument("--output", type=Path, default=Path("benchmark-train.json"))
+    suite.add_argument("--baseline", type=Path, default=None)
+    suite.add_argument("--rows", type=int, default=100_000)
+    suite.add_argument("--batchsize", type=int, default=32)
+    suite.add_argument("--batches", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.benchmark == "tokenize":
+        sentences = load_sentences(args.corpus, args.limit)
+        bench_tokenize(
+            sentences, args.model, args.tokendir, args.batchsize, args.repeat
+        )
+
+    filehandler = FileHandler(filesettings)
+    if args.benchmark in ["precision", "ddp"] and args.mapping is None:
+        args.mapping, _ = filehandler._get_latest()
+    if args.benchmark == "precision":
+        bench_precision(
+            load_model(args.model),
+            filehandler.load_mapping(args.mapping),
+            args.testfile,
+            args.precisions,
+            args.batchsize,
+            args.steps,
+        )
+
+    if args.benchmark == "ddp":
+        bench_ddp(
+            args.model,
+            filehandler.load_mapping(args.mapping),
+            args.testfile,
+            args.ranks,
+            args.batchsize,
+            args.steps,
+        )
+
+    if args.benchmark == "suite":
+        run_suite(args.output, args.baseline, args.rows, args.batchsize, args.batches)
+
+
+if __name__ == "__main__":
+    main()
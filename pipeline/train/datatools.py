@@ -1,11 +1,12 @@
 import json
-from collections import defaultdict
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Iterator, List, Sequence, Tuple
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 import polars as pl
 import torch
+from layers import Candidates
 from loguru import logger
 from settings import DataSettings, FileSettings, filetypes
 
@@ -34,7 +35,7 @@ class FileHandler:
         self.data_dir = settings.datadir
         self.processed = settings.processed
         self.mappingsuffix = settings.mappingsuffix
-        self.datasuffix = settings.datasuffix
+        self.datasuffixes = settings.datasuffixes
         self.sep = settings.sep
 
     def __repr__(self) -> str:
@@ -45,9 +46,9 @@ class FileHandler:
         maps = [
             f for f in sorted(files, reverse=True) if f.suffix == self.mappingsuffix
         ][0]
-        train = [f for f in sorted(files, reverse=True) if f.suffix == self.datasuffix][
-            0
-        ]
+        train = [
+            f for f in sorted(files, reverse=True) if f.suffix in self.datasuffixes
+        ][0]
         return maps, train
 
     def load_mapping(self, filepath: Path) -> Dict:
@@ -80,9 +81,9 @@ class FileHandler:
     def load_data(self, filepath: Path) -> pl.DataFrame:
         logger.info(f"loading file from {filepath}")
         try:
-            if self.datasuffix == filetypes.PARQUET:
+            if filepath.suffix == filetypes.PARQUET:
                 data = pl.read_parquet(filepath)
-            elif self.datasuffix == filetypes.CSV:
+            elif filepath.suffix == filetypes.CSV:
                 data = pl.read_csv(filepath, sep=self.sep)
             else:
                 raise ValueError(
@@ -93,6 +94,31 @@ class FileHandler:
             raise IOError(f"Failed to load file {filepath}") from e
         return data
 
+    def get_shards(self, train: Path) -> List[Path]:
+        """all shards of the train data that train belongs to.
+
+        Shards are files with the same timestamp and a data suffix, eg
+        2023-01-01-000000_train-00000.parq, 2023-01-01-000000_train-00001.parq.
+        A single train file, eg the train.csv of the julia preprocessing, is its
+        own only shard.
+        """
+        prefix = train.name.split("_")[0]
+        return sorted(
+            f
+            for f in train.parent.iterdir()
+            if f.name.startswith(prefix) and f.suffix in self.datasuffixes
+        )
+
+    def scan_data(self, filepath: Path) -> pl.LazyFrame:
+        """like load_data, but nothing is read until the frame is collected"""
+        if filepath.suffix == filetypes.PARQUET:
+            return pl.scan_parquet(filepath)
+        elif filepath.suffix == filetypes.CSV:
+            return pl.scan_csv(filepath, sep=self.sep)
+        raise ValueError(
+            f"Expected fileformat of {filetypes.PARQUET} or {filetypes.CSV}"
+        )
+
 
 class BaseDataset:
     """The main responsibility of the Dataset class is to load the data from disk
@@ -122,12 +148,155 @@ class TxtDataset(BaseDataset):
         self.dataset = [*zip(X, y)]
 
 
+class LazyTxtDataset(BaseDataset):
+    """A TxtDataset that does not load the data in memory.
+
+    The shards are scanned lazily and read in windows of consecutive rows. Only
+    the windows that the current batches need are materialized, and at most
+    `cached` windows are kept, so memory does not grow with the size of the
+    corpus. Datastreamer shuffles a windowed dataset window by window (see
+    Datastreamer.reset_index), so every window is read once per epoch.
+
+    Parquet shards are read per row group. A window of a csv shard is found by
+    parsing the shard from the start, so for large corpora parquet is faster.
+
+    Args:
+        shards (Sequence[Path]): the files with the data, in order
+        settings (DataSettings): the txtcol and targetcol are used
+        filehandler (FileHandler): scans the shards
+        window (int): rows per window
+        cached (int): amount of windows kept in memory
+    """
+
+    def __init__(
+        self,
+        shards: Sequence[Path],
+        settings: DataSettings,
+        filehandler: FileHandler,
+        window: int = 100_000,
+        cached: int = 2,
+    ) -> None:
+        self.settings = settings
+        self.window = window
+        self.cached = cached
+        self.frames = [filehandler.scan_data(shard) for shard in shards]
+        shardsizes = [f.select(pl.count()).collect().item() for f in self.frames]
+        self.shardstarts = np.cumsum([0] + shardsizes)
+        # windows never cross a shard, so every window is one slice of one shard
+        self.windowstarts = np.concatenate(
+            [np.arange(start, end, window) for start, end in self._shardspans()]
+            + [np.array([self.shardstarts[-1]])]
+        ).astype(np.int64)
+        self.rows = np.arange(self.shardstarts[-1], dtype=np.int64)
+        self.size = len(self.rows)
+        self._windows: OrderedDict = OrderedDict()
+
+    def __repr__(self) -> str:
+        return (
+            f"LazyTxtDataset(shards={len(self.frames)}, rows={self.size}, "
+            f"window={self.window})"
+        )
+
+    def _shardspans(self) -> List[Tuple[int, int]]:
+        return [*zip(self.shardstarts[:-1], self.shardstarts[1:])]
+
+    def subset(self, rows: np.ndarray) -> "LazyTxtDataset":
+        """a view on some of the rows of the shards, eg for a train/test split"""
+        view = object.__new__(LazyTxtDataset)
+        view.__dict__.update(self.__dict__)
+        view.rows = np.sort(rows).astype(np.int64)
+        view.size = len(view.rows)
+        view._windows = OrderedDict()
+        return view
+
+    def split(
+        self, frac: float, seed: Optional[int] = None
+    ) -> Tuple["LazyTxtDataset", "LazyTxtDataset"]:
+        rng = np.random.RandomState(seed)
+        mask = rng.random_sample(self.size) < frac
+        return self.subset(self.rows[mask]), self.subset(self.rows[~mask])
+
+    def window_ids(self) -> np.ndarray:
+        """the window of every item"""
+        return np.searchsorted(self.windowstarts, self.rows, side="right") - 1
+
+    def _read(self, wid: int, column: str) -> pl.Series:
+        start, end = int(self.windowstarts[wid]), int(self.windowstarts[wid + 1])
+        shard = int(np.searchsorted(self.shardstarts, start, side="right")) - 1
+        offset = start - int(self.shardstarts[shard])
+        frame = self.frames[shard].slice(offset, end - start)
+        return frame.select(column).collect()[column]
+
+    def _load(self, wid: int, column: str) -> List[str]:
+        key = (wid, column)
+        if key in self._windows:
+            self._windows.move_to_end(key)
+            return self._windows[key]
+        values = self._read(wid, column).to_list()
+        self._windows[key] = values
+        while len(self._windows) > self.cached:
+            self._windows.popitem(last=False)
+        return values
+
+    def take(self, idx: np.ndarray, column: Optional[str] = None) -> List[str]:
+        """the values of column (default txtcol) for the items idx"""
+        column = column or self.settings.txtcol
+        rows = self.rows[idx]
+        wids = np.searchsorted(self.windowstarts, rows, side="right") - 1
+        result = []
+        for row, wid in zip(rows, wids):
+            values = self._load(wid, column)
+            result.append(values[row - self.windowstarts[wid]])
+        return result
+
+    def scan_column(self, column: str) -> Iterator[List[str]]:
+        """yields the values of column for all items, one window at a time, without
+        caching them"""
+        wids = self.window_ids()
+        bounds = np.searchsorted(wids, np.arange(len(self.windowstarts)))
+        for wid in range(len(self.windowstarts) - 1):
+            first, last = bounds[wid], bounds[wid + 1]
+            if first == last:
+                continue
+            local = self.rows[first:last] - self.windowstarts[wid]
+            yield self._read(wid, column).take(local).to_list()
+
+    def __getitem__(self, idx: int) -> Tuple:
+        text = self.take(np.array([idx]))[0]
+        label = self.take(np.array([idx]), self.settings.targetcol)[0]
+        return text, label
+
+
 class Datastreamer:
     """This datastreamer wil never stop
     The dataset should have a:
         __len__ method
         __getitem__ method
 
+    The dataset is read once and integer-encoded: every expansion gets an id, and
+    every abbreviation one candidate set with all its expansions. Per item, the
+    streamer keeps the id of its candidate set and the position of the label in
+    that set in numpy arrays, so a batch is a slice of the permutation and a few
+    fancy indexing operations. The candidates of a batch are Candidates (see
+    layers.py), so every expansion in a batch is encoded only once.
+
+    The order of the batches only depends on seed.
+
+    With bucketsize > 1, batches are assembled from items of similar length, so
+    the encoder pads less: every pool of bucketsize batches of the shuffled data
+    is sorted by length and cut into batches, and the order of the batches is
+    shuffled again.
+
+    A LazyTxtDataset is not read into memory. Only its labels are encoded up
+    front, the texts of a batch are taken from the dataset when the batch is
+    assembled. To keep reading window by window, the windows are visited in a
+    random order, with the items in a window shuffled, and bucketing only
+    shuffles the batches within a pool.
+
+    For data-parallel training (see distributed.py), every rank has a streamer
+    with the same seed and its own rank. The batches of the permutation are dealt
+    out over the ranks in turn, so the ranks see disjoint data and the same amount
+    of batches per epoch.
     """
 
     def __init__(
@@ -135,48 +304,176 @@ class Datastreamer:
         dataset: BaseDataset,
         batchsize: int,
         mapping: Dict,
+        bucketsize: int = 1,
+        seed: Optional[int] = None,
+        rank: int = 0,
+        world: int = 1,
     ) -> None:
         self.dataset = dataset
+        self.rng = np.random.RandomState(seed)
         self.batchsize = batchsize
+        self.bucketsize = bucketsize
+        self.rank = rank
+        self.world = world
         self.mapping = mapping
-        self.surject = self._surjection(mapping)
+        self._encode_mapping(mapping)
         self.size = len(self.dataset)
+        self.lazy = isinstance(dataset, LazyTxtDataset)
+        if self.lazy:
+            self._encode_lazy()
+        else:
+            self._encode_dataset()
         self.reset_index()
 
     def __len__(self) -> int:
-        return int(len(self.dataset) / self.batchsize)
+        return int(len(self.dataset) / self.batchsize / self.world)
+
+    def _encode_mapping(self, mapping: Dict) -> None:
+        """gives every expansion an id, and every abbreviation a candidate set with
+        the expansions that map to it, in mapping order"""
+        self.expansions: List[str] = list(mapping.keys())
+        self.expansion_ids = {key: i for i, key in enumerate(self.expansions)}
+        self.abbreviations: List[str] = list(dict.fromkeys(mapping.values()))
+        setid = {abbr: i for i, abbr in enumerate(self.abbreviations)}
+        sets: List[List[str]] = [[] for _ in self.abbreviations]
+        # per expansion id: its candidate set and its position in that set
+        self.expansion_set = np.empty(len(self.expansions), dtype=np.int64)
+        self.expansion_pos = np.empty(len(self.expansions), dtype=np.int64)
+        for i, (key, value) in enumerate(mapping.items()):
+            self.expansion_set[i] = setid[value]
+            self.expansion_pos[i] = len(sets[setid[value]])
+            sets[setid[value]].append(key)
+        self.candidate_sets: List[Tuple[str, ...]] = [tuple(s) for s in sets]
+        # per candidate set: its expansion ids, padded with -1
+        self.setsizes = np.array([len(s) for s in sets], dtype=np.int64)
+        self.setmatrix = np.full(
+            (len(sets), self.setsizes.max(initial=0)), -1, dtype=np.int64
+        )
+        for i, s in enumerate(sets):
+            self.setmatrix[i, : len(s)] = [self.expansion_ids[key] for key in s]
+
+    def _label_id(self, label: str, i: int) -> int:
+        if label not in self.expansion_ids:
+            raise KeyError(f"label '{label}' of item {i} is not in the mapping")
+        return self.expansion_ids[label]
+
+    def _encode_dataset(self) -> None:
+        texts = np.empty(self.size, dtype=object)
+        labels = np.empty(self.size, dtype=np.int64)
+        for i in range(self.size):
+            x, y = self.dataset[i]
+            texts[i] = x
+            labels[i] = self._label_id(y, i)
+        self.texts = texts
+        self._set_labels(labels)
+        if self.bucketsize > 1:
+            self.lengths = np.fromiter(
+                (len(x) for x in texts), dtype=np.int64, count=self.size
+            )
+
+    def _encode_lazy(self) -> None:
+        dataset: LazyTxtDataset = self.dataset  # type: ignore
+        labels = np.empty(self.size, dtype=np.int64)
+        i = 0
+        for window in dataset.scan_column(dataset.settings.targetcol):
+            for y in window:
+                labels[i] = self._label_id(y, i)
+                i += 1
+        self._set_labels(labels)
+        self.windows = dataset.window_ids()
+        if self.bucketsize > 1:
+            self.lengths = np.concatenate(
+                [
+                    np.array([len(x) for x in window], dtype=np.int64)
+                    for window in dataset.scan_column(dataset.settings.txtcol)
+                ]
+            )
+
+    def _set_labels(self, labels: np.ndarray) -> None:
+        self.labels = labels
+        self.setids = self.expansion_set[labels]
+        self.targets = self.expansion_pos[labels]
 
     def reset_index(self) -> None:
-        self.index_list = np.random.permutation(self.size)
+        self.index_list = self.rng.permutation(self.size)
+        if self.lazy:
+            # the windows in a random order, the items shuffled within a window
+            rank = self.rng.permutation(int(self.windows.max(initial=0)) + 1)
+            key = rank[self.windows[self.index_list]]
+            self.index_list = self.index_list[np.argsort(key, kind="stable")]
+        if self.bucketsize > 1:
+            self.index_list = self._bucketize(self.index_list)
+        if self.world > 1:
+            self.index_list = self._shard(self.index_list)
         self.index = 0
 
-    def _surjection(self, mapping: Dict) -> Dict:
-        inverted_dict = defaultdict(list)
-        for key, value in mapping.items():
-            inverted_dict[value].append(key)
-        surject = {k: tuple(inverted_dict[v]) for k, v in mapping.items()}
-        return surject
+    def _shard(self, permutation: np.ndarray) -> np.ndarray:
+        """the batches of this rank: batch i goes to rank i % world. Batches that
+        do not fill a turn of all ranks are dropped."""
+        rank, world = self.rank, self.world
+        turns = len(permutation) // (self.batchsize * world)
+        if turns == 0:
+            return permutation[rank::world]
+        size = turns * world * self.batchsize
+        batches = permutation[:size].reshape(turns, world, self.batchsize)
+        return batches[:, rank].reshape(-1)
+
+    def _bucketize(self, permutation: np.ndarray) -> np.ndarray:
+        poolsize = self.batchsize * self.bucketsize
+        batches = []
+        for start in range(0, len(permutation), poolsize):
+            end = start + poolsize
+            pool = permutation[start:end]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            # the last batch of the last pool can be short, it is dropped
+            poolbatches = []
+            for begin in range(0, len(pool) - self.batchsize + 1, self.batchsize):
+                stop = begin + self.batchsize
+                poolbatches.append(pool[begin:stop])
+            if self.lazy:
+                order = self.rng.permutation(len(poolbatches))
+                poolbatches = [poolbatches[i] for i in order]
+            batches.extend(poolbatches)
+        if len(batches) == 0:
+            return permutation
+        if self.lazy:
+            return np.concatenate(batches)
+        order = self.rng.permutation(len(batches))
+        return np.concatenate([batches[i] for i in order])
+
+    def _candidates(self, idx: np.ndarray) -> Candidates:
+        """the candidates of a batch, every expansion in the batch only once"""
+        sets = self.setids[idx]
+        width = self.setsizes[sets].max(initial=0)
+        ids = self.setmatrix[sets][:, :width]
+        valid = ids >= 0
+        unique, inverse = np.unique(ids[valid], return_inverse=True)
+        index = np.full(ids.shape, -1, dtype=np.int64)
+        index[valid] = inverse
+        expansions = tuple(self.expansions[i] for i in unique)
+        return Candidates(expansions, torch.from_numpy(index))
 
     def _preprocess(
-        self, batch: Sequence[Tuple]
-    ) -> Tuple[Tuple[str], List[Tuple[str]], torch.Tensor]:
-        X, y = zip(*batch)  # noqa N806
-        y_ = [self.surject[val] for val in y]
-        indices = torch.tensor([y_[i].index(y[i]) for i in range(len(y))])
+        self, idx: np.ndarray
+    ) -> Tuple[Tuple[str], Candidates, torch.Tensor]:
+        if self.lazy:
+            X = tuple(self.dataset.take(idx))  # type: ignore # noqa N806
+        else:
+            X = tuple(self.texts[idx])  # noqa N806
+        y_ = self._candidates(idx)
+        indices = torch.from_numpy(self.targets[idx])
         return X, y_, indices
 
-    def batchloop(self) -> Sequence[Tuple]:
-        batch = []
-        for _ in range(self.batchsize):
-            x, y = self.dataset[int(self.index_list[self.index])]
-            batch.append((x, y))
-            self.index += 1
-        return batch
+    def batchloop(self) -> np.ndarray:
+        start = self.index
+        self.index += self.batchsize
+        end = self.index
+        return self.index_list[start:end]
 
     def stream(self) -> Iterator:
         while True:
-            if self.index > (self.size - self.batchsize):
+            if self.index > (len(self.index_list) - self.batchsize):
                 self.reset_index()
-            batch = self.batchloop()
-            X, candidates, y = self._preprocess(batch)  # noqa N806
+            idx = self.batchloop()
+            X, candidates, y = self._preprocess(idx)  # noqa N806
             yield X, candidates, y
@@ -0,0 +1,122 @@
+"""Data-parallel training on the cpus of one machine, with the gloo backend.
+
+Start train.py with torchrun to train with several processes, eg:
+    torchrun --standalone --nproc_per_node 4 pipeline/train/train.py
+
+All ranks shuffle with the same seed, and every rank trains on its own share of
+the batches of that permutation (see Datastreamer). Only the reducer is trained,
+its gradients are averaged over the ranks after every backward pass, so all ranks
+keep the same weights. The cores of the machine are divided over the ranks.
+Rank 0 builds the data and the stores while the other ranks wait, and it is the
+only rank that writes to tensorboard and saves the model.
+
+Without torchrun there is no WORLD_SIZE in the environment, and every function
+here does nothing.
+"""
+
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+import torch
+import torch.distributed as dist
+from loguru import logger
+from torch import nn
+
+
+def init() -> None:
+    """joins the process group when started by torchrun"""
+    world = int(os.environ.get("WORLD_SIZE", 1))
+    if world == 1 or is_initialized():
+        return
+    dist.init_process_group(backend="gloo")
+    local = int(os.environ.get("LOCAL_WORLD_SIZE", world))
+    threads = max(1, (os.cpu_count() or 1) // local)
+    torch.set_num_threads(threads)
+    logger.info(f"Rank {rank()} of {world}, with {threads} threads")
+
+
+def is_initialized() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_initialized() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main() -> bool:
+    return rank() == 0
+
+
+def barrier() -> None:
+    if is_initialized():
+        dist.barrier()
+
+
+@contextmanager
+def main_first() -> Iterator[None]:
+    """rank 0 runs the block first, eg to write a store that the other ranks then
+    only have to read"""
+    if not is_main():
+        barrier()
+    yield
+    if is_main():
+        barrier()
+
+
+def broadcast_seed(seed: Optional[int]) -> Optional[int]:
+    """the seed of rank 0, drawn at random when it is None, so all ranks shuffle
+    the data the same way"""
+    if not is_initialized():
+        return seed
+    value = torch.tensor(
+        seed if seed is not None else int(torch.randint(2**31 - 1, (1,)))
+    )
+    dist.broadcast(value, src=0)
+    return int(value)
+
+
+def broadcast_parameters(module: nn.Module) -> None:
+    """copies the trainable parameters of rank 0 to the other ranks"""
+    if not is_initialized():
+        return
+    for param in module.parameters():
+        if param.requires_grad:
+            dist.broadcast(param.data, src=0)
+
+
+def allreduce_gradients(module: nn.Module) -> None:
+    """averages the gradients over the ranks, in a single all-reduce"""
+    if not is_initialized():
+        return
+    grads = [p.grad for p in module.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= world_size()
+    offset = 0
+    for grad in grads:
+        size = grad.numel()
+        end = offset + size
+        grad.copy_(flat[offset:end].view_as(grad))
+        offset = end
+
+
+def allreduce_mean(values: Dict[str, float]) -> Dict[str, float]:
+    """the mean of every value over the ranks, eg losses and metrics"""
+    if not is_initialized() or len(values) == 0:
+        return values
+    flat = torch.tensor([float(v) for v in values.values()], dtype=torch.float64)
+    dist.all_reduce(flat)
+    flat /= world_size()
+    return {key: float(v) for key, v in zip(values, flat)}
+
+
+def cleanup() -> None:
+    if is_initialized():
+        dist.destroy_process_group()
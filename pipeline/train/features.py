@@ -0,0 +1,179 @@
+"""Precomputes the pooled roberta states of every sentence and expansion once.
+
+The encoder is frozen, so its output for a text never changes during training.
+The pooled (not yet reduced) vectors are stored in a directory per base model,
+pooling type and encoder precision:
+    - vectors.npy: float32 array of shape (n, vectordim), opened memory-mapped
+    - keys.npy: the sha1 hexdigest of the text of every row
+    - meta.json: the base model, pooling and precision the vectors belong to
+
+When training from the store, an epoch only runs the reducer. Note that the
+encoder runs in eval mode here, so its dropout is not applied to the stored
+vectors.
+
+Run from the root of the repository to fill the store for the latest processed
+data, eg:
+    python pipeline/train/features.py
+"""
+
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Sequence, Type
+
+import numpy as np
+import torch
+from datatools import FileHandler
+from layers import AbbrvtExpander, Candidates
+from loguru import logger
+from settings import datasettings, filesettings, modelsettings
+from tqdm import tqdm
+
+KEYTYPE = "S40"
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest().encode()
+
+
+def store_dir(
+    featuredir: Path, modelid: str, aggtype: str, precision: str = "fp32"
+) -> Path:
+    """one directory per base model, pooling and encoder precision, eg
+    CLTL--MedRoBERTa.nl-mean or CLTL--MedRoBERTa.nl-mean-bf16"""
+    name = re.sub(r"[^\w.-]", "-", modelid.replace("/", "--"))
+    suffix = "" if precision == "fp32" else f"-{precision}"
+    return Path(featuredir) / f"{name}-{aggtype}{suffix}"
+
+
+class FeatureStore:
+    """Looks up the pooled encoder vectors of texts in a memory-mapped store.
+
+    Args:
+        directory (Path): a directory written by precompute
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(self.directory / "vectors.npy", mmap_mode="r")
+        keys = np.load(self.directory / "keys.npy")
+        self.rows: Dict[bytes, int] = {key: row for row, key in enumerate(keys)}
+
+    def __repr__(self) -> str:
+        return (
+            f"FeatureStore(model='{self.meta['modelid']}', "
+            f"aggtype='{self.meta['aggtype']}', size={len(self)})"
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, text: str) -> bool:
+        return text_key(text) in self.rows
+
+    def lookup(self, texts: Sequence[str]) -> torch.Tensor:
+        """the stored vectors of texts, shape (len(texts), vectordim)
+
+        Raises:
+            KeyError: when a text was not precomputed
+        """
+        rows = [self.rows[text_key(text)] for text in texts]
+        return torch.from_numpy(np.ascontiguousarray(self.vectors[rows]))
+
+    def stream(self, datastream: Iterator) -> Iterator:
+        """replaces the texts in the batches of a Datastreamer.stream() with their
+        vectors, the model then skips the encoder"""
+        for X, candidates, y in datastream:  # noqa N806
+            x = self.lookup(X)
+            cand = Candidates(self.lookup(candidates.expansions), candidates.rows)
+            yield x, cand, y
+
+
+def precompute(
+    model: Type[AbbrvtExpander],
+    texts: Iterable[str],
+    featuredir: Path,
+    batchsize: int = 64,
+) -> FeatureStore:
+    """Adds the texts that are not yet in the store of this model and returns it.
+
+    The new vectors are appended in a copy of the store that replaces the old one
+    when it is complete, so an interrupted run never leaves a broken store.
+    """
+    directory = store_dir(
+        featuredir, model.model_path, model.aggtype, model.precision  # type: ignore
+    )
+    vectors = np.zeros((0, model.vectordim), dtype=np.float32)  # type: ignore
+    keys = np.zeros((0,), dtype=KEYTYPE)
+    if (directory / "meta.json").exists():
+        store = FeatureStore(directory)
+        vectors, keys = store.vectors, np.load(directory / "keys.npy")
+    known = set(keys.tolist())
+
+    todo: List[str] = []
+    for text in texts:
+        key = text_key(text)
+        if key not in known:
+            known.add(key)
+            todo.append(text)
+    if len(todo) == 0:
+        logger.info(f"All texts are in {directory}")
+        return FeatureStore(directory)
+    logger.info(f"Encoding {len(todo)} new texts into {directory}")
+
+    tmp = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    size = len(keys) + len(todo)
+    out = np.lib.format.open_memmap(
+        tmp / "vectors.npy", mode="w+", dtype=np.float32, shape=(size, vectors.shape[1])
+    )
+    offset = len(keys)
+    out[:offset] = vectors
+    model.eval()  # type: ignore
+    with torch.no_grad():
+        for start in tqdm(range(0, len(todo), batchsize), colour="#1e4706"):
+            end = start + batchsize
+            batch = tuple(todo[start:end])
+            first, last = offset + start, offset + start + len(batch)
+            out[first:last] = model.encode(batch).numpy()  # type: ignore
+    out.flush()
+    del out
+    new = np.array([text_key(text) for text in todo], dtype=KEYTYPE)
+    np.save(tmp / "keys.npy", np.concatenate([keys, new]))
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(
+            {
+                "modelid": model.model_path,  # type: ignore
+                "aggtype": model.aggtype,  # type: ignore
+                "precision": model.precision,  # type: ignore
+                "vectordim": int(vectors.shape[1]),
+                "size": size,
+            },
+            f,
+        )
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp.rename(directory)
+    return FeatureStore(directory)
+
+
+def main() -> None:
+    filehandler = FileHandler(filesettings)
+    maps, train = filehandler._get_latest()
+    mapping = filehandler.load_mapping(maps)
+    texts: List[str] = []
+    for shard in filehandler.get_shards(train):
+        texts.extend(filehandler.load_data(shard)[datasettings.txtcol].to_list())
+    texts.extend(mapping.keys())
+    model = AbbrvtExpander(modelsettings)
+    assert modelsettings.featuredir is not None, "modelsettings has no featuredir"
+    store = precompute(model, texts, modelsettings.featuredir)  # type: ignore
+    logger.success(f"{store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,91 @@
-from typing import List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.nn.functional as F  # noqa N812
 from settings import Settings
+from timing import stage
 from torch import nn
 from transformers import RobertaModel, RobertaTokenizer
 
 
+class Tokens(NamedTuple):
+    """a tokenized batch, padded per length bucket (see AbbrvtExpander.tokenize)"""
+
+    buckets: List[Dict[str, torch.Tensor]]
+    # puts the rows of the concatenated buckets back in the order of the batch
+    order: torch.Tensor
+
+
+class TokenIds(NamedTuple):
+    """the token ids of a batch of sentences that were tokenized before, eg by
+    a TokenStore (see tokenstore.py)"""
+
+    ids: Sequence[Sequence[int]]
+
+
+# sentences, token ids, a tokenized batch or precomputed encoder vectors (see
+# features.py)
+Batch = Union[Tuple[str, ...], TokenIds, Tokens, torch.Tensor]
+
+
+class Candidates(NamedTuple):
+    """The candidates of a batch, with every expansion only once.
+
+    Row i of rows holds the positions in expansions of the candidates of example
+    i, padded with -1, so examples can have a different amount of candidates.
+    """
+
+    expansions: Batch
+    rows: torch.Tensor
+
+
+def deduplicate(candidates: Sequence[Sequence[str]]) -> Candidates:
+    """turns the candidate tuples of a batch into Candidates"""
+    positions: Dict[str, int] = {}
+    rows = torch.full(
+        (len(candidates), max((len(c) for c in candidates), default=0)), -1
+    )
+    for i, cands in enumerate(candidates):
+        for j, expansion in enumerate(cands):
+            rows[i, j] = positions.setdefault(expansion, len(positions))
+    return Candidates(tuple(positions), rows)
+
+
 class Vectorizer(nn.Module):
-    def __init__(self, modelsettings: Settings) -> None:
+    # class level defaults, for models that were pickled before these existed
+    buckets: List[int] = [16, 32, 64, 128, 256, 512]
+    precision: str = "fp32"
+
+    def __init__(
+        self,
+        modelsettings: Settings,
+        roberta: Optional[RobertaModel] = None,
+        tokenizer: Optional[RobertaTokenizer] = None,
+    ) -> None:
+        """the encoder and tokenizer of modelsettings.modelpath are downloaded,
+        unless they are passed in, eg a shared encoder (see artifacts.py)"""
         super().__init__()
         self.hidden: int = modelsettings.hidden
         self.model_path = modelsettings.modelpath
 
-        self.roberta = RobertaModel.from_pretrained(
-            self.model_path,
-            output_hidden_states=False,
-            cache_dir=modelsettings.cache_dir,
-        )
-        self.tokenizer = RobertaTokenizer.from_pretrained(
-            self.model_path, cache_dir=modelsettings.cache_dir
-        )
+        if roberta is None:
+            roberta = RobertaModel.from_pretrained(
+                self.model_path,
+                output_hidden_states=False,
+                cache_dir=modelsettings.cache_dir,
+            )
+        if tokenizer is None:
+            tokenizer = RobertaTokenizer.from_pretrained(
+                self.model_path, cache_dir=modelsettings.cache_dir
+            )
+        self.roberta = roberta
+        self.tokenizer = tokenizer
         self.vectordim = modelsettings.vectordim
         self.hidden = modelsettings.hidden
 
         self.aggtype = modelsettings.aggtype
+        self.buckets = modelsettings.buckets
+        self.precision = modelsettings.precision
         self.nonlinear = modelsettings.nonlinear
         self.reducer = nn.Sequential(
             nn.Linear(modelsettings.vectordim, 2 * self.hidden),
@@ -37,35 +98,108 @@ class Vectorizer(nn.Module):
             "sum",
             "none",
         ], "Aggregation type must be 'mean', 'sum' or 'none'"
+        assert self.precision in [
+            "fp32",
+            "bf16",
+        ], "Precision must be 'fp32' or 'bf16'"
 
         for param in self.roberta.parameters():
             param.requires_grad = False
 
-    def _agg(self, hidden_states: torch.Tensor) -> torch.Tensor:
+    def _agg(
+        self, hidden_states: torch.Tensor, mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        if mask is None:
+            mask = torch.ones(hidden_states.shape[:2], dtype=hidden_states.dtype)
+        # padding tokens do not count towards the mean
+        mask = mask.unsqueeze(-1).to(hidden_states.dtype)
         if self.aggtype == "mean":
-            return torch.mean(hidden_states, dim=1).squeeze()
+            return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
         if self.aggtype == "sum":
-            return torch.mean(hidden_states, dim=1).squeeze()
+            return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
         else:
             return hidden_states
 
+    def _bucketize(self, lengths: Sequence[int]) -> List[List[int]]:
+        """groups the indices of a batch by token length, so every group is padded
+        to at most the next bucket boundary instead of the longest sentence"""
+        if self.aggtype == "none":
+            # unpooled hidden states of different lengths can not be concatenated
+            return [list(range(len(lengths)))]
+        groups: List[List[int]] = []
+        bound = -1
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            if lengths[i] > bound:
+                bound = next((b for b in self.buckets if b >= lengths[i]), lengths[i])
+                groups.append([])
+            groups[-1].append(i)
+        return groups
+
 
 class AbbrvtExpander(Vectorizer):
-    def stacked_vectorize(self, y_: List[Tuple[str]]) -> torch.Tensor:
-        m = []
-        for val in y_:
-            m.append(self.vectorize(val))
-        return torch.stack(m)
-
-    def vectorize(self, batch: Tuple[str]) -> torch.Tensor:
-        inputs = self.tokenizer.batch_encode_plus(
-            batch,
-            return_tensors="pt",
-            padding=True,
-        )["input_ids"]
-        vector = self.roberta(inputs).last_hidden_state
-        vector = self._agg(vector)
-        vector = self.reducer(vector)
+    def tokenize(self, batch: Union[Tuple[str, ...], TokenIds]) -> Tokens:
+        """splits a batch of sentences into length buckets that are padded
+        separately. Has no parameters, so it can run ahead in another thread.
+
+        Sentences that were tokenized before only need the padding.
+        """
+        with stage("tokenize"):
+            if isinstance(batch, TokenIds):
+                input_ids = batch.ids
+            else:
+                # longer sentences do not fit the position embeddings of roberta
+                input_ids = self.tokenizer.batch_encode_plus(
+                    list(batch),
+                    truncation=True,
+                    max_length=self.roberta.config.max_position_embeddings - 2,
+                )["input_ids"]
+            buckets = []
+            order: List[int] = []
+            for group in self._bucketize([len(ids) for ids in input_ids]):
+                buckets.append(self._pad([input_ids[i] for i in group]))
+                order.extend(group)
+            return Tokens(buckets, torch.argsort(torch.tensor(order)))
+
+    def _pad(self, input_ids: Sequence[Sequence[int]]) -> Dict[str, torch.Tensor]:
+        """pads on the right, like tokenizer.pad"""
+        longest = max(len(ids) for ids in input_ids)
+        padded = torch.full((len(input_ids), longest), self.tokenizer.pad_token_id)
+        mask = torch.zeros((len(input_ids), longest), dtype=torch.long)
+        for i, ids in enumerate(input_ids):
+            padded[i, : len(ids)] = torch.tensor(ids)
+            mask[i, : len(ids)] = 1
+        return {"input_ids": padded, "attention_mask": mask}
+
+    def encode(self, batch: Union[Tuple[str, ...], TokenIds, Tokens]) -> torch.Tensor:
+        """pools the roberta hidden states of a batch of sentences.
+
+        The length buckets are encoded separately, with an attention mask, so a
+        sentence gets the same vector regardless of what else is in the batch.
+        """
+        tokens = batch if isinstance(batch, Tokens) else self.tokenize(batch)
+        pooled = []
+        for inputs in tokens.buckets:
+            # in bf16 only the roberta forward runs under autocast, its output is
+            # pooled in fp32
+            bf16 = self.precision == "bf16"
+            with stage("roberta"), torch.autocast("cpu", torch.bfloat16, bf16):
+                vector = self.roberta(
+                    inputs["input_ids"], attention_mask=inputs["attention_mask"]
+                ).last_hidden_state
+            with stage("agg"):
+                pooled.append(self._agg(vector.float(), inputs["attention_mask"]))
+        return torch.cat(pooled)[tokens.order]
+
+    def vectorize(self, batch: Batch) -> torch.Tensor:
+        # precomputed encoder vectors (see features.py) only need the reducer
+        if isinstance(batch, torch.Tensor):
+            vector = batch
+        else:
+            vector = self.encode(batch)
+        # the reducer and the cosine scoring are trained in fp32, also when the
+        # caller runs under autocast
+        with stage("reducer"), torch.autocast("cpu", enabled=False):
+            vector = self.reducer(vector.float())
         return vector
 
     def cosine_sim(
@@ -73,8 +207,27 @@ class AbbrvtExpander(Vectorizer):
     ) -> torch.Tensor:
         return F.cosine_similarity(context.unsqueeze(1), candidates, dim=-1)
 
-    def forward(self, X: Tuple[str], y_: List[Tuple[str]]) -> torch.Tensor:  # noqa N803
-        context = self.vectorize(X)
-        candidates = self.stacked_vectorize(y_)
-        yhat = self.cosine_sim(context, candidates)
-        return yhat
+    def forward(
+        self,
+        X: Batch,  # noqa N803
+        y_: Union[Sequence[Sequence[str]], Candidates],
+    ) -> torch.Tensor:
+        """scores every example against its own candidates.
+
+        Every expansion in the batch is vectorized once. Padded candidates get a
+        score of -inf, so a softmax or cross entropy over a row only covers the
+        candidates of that example.
+
+        Returns:
+            torch.Tensor: shape (batch, most candidates of an example)
+        """
+        if not isinstance(y_, Candidates):
+            y_ = deduplicate(y_)
+        with stage("context"):
+            context = self.vectorize(X)
+        with stage("candidates"):
+            expansions = self.vectorize(y_.expansions)
+        candidates = expansions[y_.rows.clamp(min=0)]
+        with stage("score"):
+            yhat = self.cosine_sim(context, candidates)
+        return yhat.masked_fill(y_.rows < 0, float("-inf"))
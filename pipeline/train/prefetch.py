@@ -0,0 +1,114 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Tuple, Type
+
+from layers import AbbrvtExpander, Candidates, Tokens
+from tokenstore import TokenStore
+
+# put in the queue when the stream is exhausted
+_DONE = object()
+
+
+class Prefetcher:
+    """Prepares the next batches of a stream in the background.
+
+    One producer thread pulls batches from the stream, in order, and hands them to
+    a pool of worker threads that apply transform (eg tokenization). At most depth
+    batches are ready or in preparation, so the producer blocks when the trainloop
+    falls behind. Because only the producer touches the stream, the order of the
+    batches does not depend on the amount of workers.
+
+    The torch ops of the train step release the GIL, so a worker thread prepares
+    the next batch while the step runs. The slow RobertaTokenizer is pure Python
+    and holds the GIL, so more than one worker only helps when the preparation
+    itself releases it, eg with a fast tokenizer.
+
+    Args:
+        stream (Iterator): eg Datastreamer.stream()
+        depth (int): amount of batches that are prepared ahead
+        transform (Callable, optional): applied to every batch in a worker thread
+        workers (int): amount of worker threads
+    """
+
+    def __init__(
+        self,
+        stream: Iterator,
+        depth: int = 2,
+        transform: Optional[Callable] = None,
+        workers: int = 1,
+    ) -> None:
+        self.stream = stream
+        self.depth = max(depth, 1)
+        self.transform = transform
+        self._queue: queue.Queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prep")
+        self._producer = threading.Thread(
+            target=self._produce, name="prefetch", daemon=True
+        )
+        self._producer.start()
+
+    def __repr__(self) -> str:
+        return f"Prefetcher(depth={self.depth}, ready={self._queue.qsize()})"
+
+    def __iter__(self) -> Iterator:
+        return self
+
+    def __next__(self) -> Tuple:
+        item = self._queue.get()
+        if item is _DONE:
+            self._queue.put(_DONE)
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item.result()
+
+    def _produce(self) -> None:
+        try:
+            for batch in self.stream:
+                if self._stop.is_set():
+                    return
+                if self.transform is None:
+                    future: Future = Future()
+                    future.set_result(batch)
+                else:
+                    future = self._pool.submit(self.transform, batch)
+                self._put(future)
+            self._put(_DONE)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item: object) -> None:
+        # a timeout, so close() can stop a producer that waits on a full queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self) -> None:
+        self._stop.set()
+        self._producer.join()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def tokenize_batch(
+    model: Type[AbbrvtExpander], store: Optional[TokenStore] = None
+) -> Callable:
+    """a transform that tokenizes the sentences and candidates of a batch from
+    Datastreamer.stream(), so the model only has to run the encoder. With a
+    store, the token ids are looked up instead of running the tokenizer."""
+
+    def tokenize(texts: Tuple[str, ...]) -> Tokens:
+        if store is not None:
+            return model.tokenize(store.lookup(texts))  # type: ignore
+        return model.tokenize(texts)  # type: ignore
+
+    def transform(batch: Tuple) -> Tuple:
+        X, candidates, y = batch  # noqa N806
+        expansions = tokenize(candidates.expansions)
+        return tokenize(X), Candidates(expansions, candidates.rows), y
+
+    return transform
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import List, Optional, Tuple
 
 from pydantic import BaseModel
 
@@ -9,12 +10,25 @@ class Settings(BaseModel):
     hidden: int
     aggtype: str
     nonlinear: str
+    # upper bounds of the token length buckets that are encoded together
+    buckets: List[int] = [16, 32, 64, 128, 256, 512]
+    # "fp32", or "bf16" to run the roberta forward under cpu autocast
+    precision: str = "fp32"
+    # (first, steps): trace these train steps with torch.profiler, see trainloop.py
+    profile: Optional[Tuple[int, int]] = None
     epochs: int
     train_steps: int
     eval_steps: int
     learning_rate: float
     modeldir: Path
     cache_dir: Path
+    # train from pooled encoder vectors stored here (see features.py), None
+    # runs the encoder on every step
+    featuredir: Optional[Path] = None
+    # read the token ids from a store here (see tokenstore.py) instead of running
+    # the tokenizer on every step, None tokenizes every step. Only used when
+    # featuredir is None, a feature store needs no tokens while training
+    tokendir: Optional[Path] = None
 
 
 class FileSettings(BaseModel):
@@ -22,7 +36,8 @@ class FileSettings(BaseModel):
     datadir: Path
     processed: Path
     mappingsuffix: str
-    datasuffix: str
+    # the parquet shards of trainset.py and the csv of the julia preprocessing
+    datasuffixes: List[str]
     sep: str
 
 
@@ -31,6 +46,15 @@ class DataSettings(BaseModel):
     txtcol: str
     trainfrac: float
     batchsize: int
+    # batches per pool that is sorted by length, 1 disables length bucketing
+    bucketsize: int = 1
+    # batches that are assembled and tokenized ahead of the train step
+    prefetch: int = 2
+    workers: int = 1
+    # rows per window of a LazyTxtDataset over all shards, 0 loads the data in memory
+    window: int = 0
+    # seeds the train/validation split, the batch order and torch
+    seed: Optional[int] = None
 
 
 class FileTypes(BaseModel):
@@ -47,7 +71,7 @@ filesettings = FileSettings(
     datadir=Path("assets"),
     processed=Path("assets/processed/"),
     mappingsuffix=".json",
-    datasuffix=".csv",
+    datasuffixes=[".parq", ".csv"],
     sep="|",
 )
 
@@ -63,6 +87,16 @@ modelsettings = Settings(
     learning_rate=1e-3,
     modeldir=Path("mlflow"),
     cache_dir=Path("assets/model"),
+    featuredir=Path("assets/features"),
 )
 
-datasettings = DataSettings(targetcol="label", txtcol="txt", trainfrac=0.8, batchsize=8)
+datasettings = DataSettings(
+    targetcol="label",
+    txtcol="txt",
+    trainfrac=0.8,
+    batchsize=8,
+    bucketsize=16,
+    prefetch=4,
+    workers=2,
+    seed=42,
+)
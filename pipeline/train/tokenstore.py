@@ -0,0 +1,180 @@
+"""Stores the token ids of every sentence and expansion once.
+
+The roberta tokenizer is pure python, and tokenizes the same strings in every
+epoch. The ids are stored ragged, in a directory per tokenizer:
+    - ids.npy: the token ids of all texts after each other, int32, memory-mapped
+    - offsets.npy: int64, the ids of text i are ids[offsets[i]:offsets[i + 1]]
+    - keys.npy: the sha1 hexdigest of the text of every row (see features.py)
+    - meta.json: the tokenizer the ids belong to
+
+Run from the root of the repository to fill the store for the latest processed
+data, the test set and the expansions, eg:
+    python pipeline/train/tokenstore.py
+"""
+
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+from datatools import FileHandler
+from features import KEYTYPE, text_key
+from layers import TokenIds
+from loguru import logger
+from settings import datasettings, filesettings, modelsettings
+from tqdm import tqdm
+from transformers import PreTrainedTokenizerBase, RobertaTokenizer
+
+
+def tokenizer_id(tokenizer: PreTrainedTokenizerBase) -> str:
+    """the name of the tokenizer with a digest of its vocabulary and special
+    tokens, so a retrained or differently configured tokenizer gets a new store"""
+    digest = hashlib.sha1()
+    vocab = sorted(tokenizer.get_vocab().items())
+    digest.update(json.dumps(vocab, ensure_ascii=False).encode())
+    digest.update(json.dumps(tokenizer.all_special_tokens).encode())
+    name = re.sub(r"[^\w.-]", "-", Path(str(tokenizer.name_or_path)).name)
+    return f"{name or 'tokenizer'}-{digest.hexdigest()[:12]}"
+
+
+class TokenStore:
+    """Looks up the token ids of texts in a memory-mapped ragged store.
+
+    Args:
+        directory (Path): a directory written by build_tokenstore
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+        with open(self.directory / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        self.ids = np.load(self.directory / "ids.npy", mmap_mode="r")
+        self.offsets = np.load(self.directory / "offsets.npy")
+        keys = np.load(self.directory / "keys.npy")
+        self.rows: Dict[bytes, int] = {key: row for row, key in enumerate(keys)}
+
+    def __repr__(self) -> str:
+        return (
+            f"TokenStore(tokenizer='{self.meta['tokenizer']}', texts={len(self)}, "
+            f"tokens={len(self.ids)})"
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, text: str) -> bool:
+        return text_key(text) in self.rows
+
+    def lookup(self, texts: Sequence[str]) -> TokenIds:
+        """the token ids of texts, as views on the memory-mapped array
+
+        Raises:
+            KeyError: when a text was not tokenized before
+        """
+        ids = []
+        for text in texts:
+            row = self.rows[text_key(text)]
+            start, end = self.offsets[row], self.offsets[row + 1]
+            ids.append(self.ids[start:end])
+        return TokenIds(ids)
+
+
+def build_tokenstore(
+    tokenizer: PreTrainedTokenizerBase,
+    texts: Iterable[str],
+    tokendir: Path,
+    batchsize: int = 1024,
+) -> TokenStore:
+    """Adds the texts that are not yet in the store of this tokenizer.
+
+    Like features.precompute, the store is extended in a copy that replaces the
+    old one when it is complete.
+    """
+    directory = Path(tokendir) / tokenizer_id(tokenizer)
+    ids = np.zeros((0,), dtype=np.int32)
+    offsets = np.zeros((1,), dtype=np.int64)
+    keys = np.zeros((0,), dtype=KEYTYPE)
+    if (directory / "meta.json").exists():
+        store = TokenStore(directory)
+        ids, offsets = store.ids, store.offsets
+        keys = np.load(directory / "keys.npy")
+    known = set(keys.tolist())
+
+    todo: List[str] = []
+    for text in texts:
+        key = text_key(text)
+        if key not in known:
+            known.add(key)
+            todo.append(text)
+    if len(todo) == 0:
+        logger.info(f"All texts are in {directory}")
+        return TokenStore(directory)
+    logger.info(f"Tokenizing {len(todo)} new texts into {directory}")
+
+    lengths: List[np.ndarray] = []
+    chunks: List[np.ndarray] = []
+    for start in tqdm(range(0, len(todo), batchsize), colour="#1e4706"):
+        end = start + batchsize
+        encoded = tokenizer(todo[start:end])["input_ids"]
+        lengths.append(np.array([len(e) for e in encoded], dtype=np.int64))
+        chunks.append(np.fromiter((i for e in encoded for i in e), dtype=np.int32))
+    new = np.concatenate(lengths)
+
+    tmp = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    size = len(ids) + int(new.sum())
+    out = np.lib.format.open_memmap(
+        tmp / "ids.npy", mode="w+", dtype=np.int32, shape=(size,)
+    )
+    cursor = len(ids)
+    out[:cursor] = ids
+    for chunk in chunks:
+        end = cursor + len(chunk)
+        out[cursor:end] = chunk
+        cursor = end
+    out.flush()
+    del out
+    np.save(
+        tmp / "offsets.npy", np.concatenate([offsets, offsets[-1] + np.cumsum(new)])
+    )
+    newkeys = np.array([text_key(text) for text in todo], dtype=KEYTYPE)
+    np.save(tmp / "keys.npy", np.concatenate([keys, newkeys]))
+    with open(tmp / "meta.json", "w") as f:
+        json.dump(
+            {
+                "tokenizer": tokenizer_id(tokenizer),
+                "name_or_path": str(tokenizer.name_or_path),
+                "texts": len(keys) + len(todo),
+                "tokens": size,
+            },
+            f,
+        )
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp.rename(directory)
+    return TokenStore(directory)
+
+
+def main() -> None:
+    filehandler = FileHandler(filesettings)
+    maps, train = filehandler._get_latest()
+    mapping = filehandler.load_mapping(maps)
+    testdata = filehandler.load_data(filesettings.datadir / "raw/test_set.csv")
+    texts: List[str] = []
+    for shard in filehandler.get_shards(train):
+        texts.extend(filehandler.load_data(shard)[datasettings.txtcol].to_list())
+    texts.extend(testdata["sample"].to_list())
+    texts.extend(mapping.keys())
+    tokenizer = RobertaTokenizer.from_pretrained(
+        modelsettings.modelpath, cache_dir=modelsettings.cache_dir
+    )
+    assert modelsettings.tokendir is not None, "modelsettings has no tokendir"
+    store = build_tokenstore(tokenizer, texts, modelsettings.tokendir)
+    logger.success(f"{store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,119 @@
 from datetime import datetime
+from itertools import chain
 from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
 
+import distributed
 import polars as pl
 import torch
 import torch.optim as optim
-from datatools import Datastreamer, FileHandler, TxtDataset
+from artifacts import save_model
+from datatools import BaseDataset, Datastreamer, FileHandler, LazyTxtDataset, TxtDataset
+from features import precompute
 from layers import AbbrvtExpander
 from loguru import logger
 from metrics import Accuracy
+from prefetch import Prefetcher, tokenize_batch
 from settings import DataSettings, datasettings, filesettings, modelsettings
+from tokenstore import build_tokenstore
 from trainloop import trainloop
+from trainset import build_trainset
 
 
 def train() -> None:
+    # with torchrun, this process is one of several ranks, see distributed.py
+    distributed.init()
+    rank, world = distributed.rank(), distributed.world_size()
+    seed = distributed.broadcast_seed(datasettings.seed)
+    if seed is not None:
+        torch.manual_seed(seed)
     # create datastreamers
     filehandler = FileHandler(filesettings)
-    maps, train = filehandler._get_latest()
+    with distributed.main_first():
+        try:
+            maps, train = filehandler._get_latest()
+        except IndexError:
+            logger.info(f"No processed data in {filehandler.processed}, building it")
+            raw = filesettings.datadir / "raw"
+            build_trainset(
+                raw / "corpus.txt", raw / "test_set.csv", filesettings.processed
+            )
+            maps, train = filehandler._get_latest()
 
     mapping = filehandler.load_mapping(maps)
-    data = filehandler.load_data(train)
-    data = data.with_columns(pl.Series(name="idx", values=[*range(len(data))]))
     logger.info(f"using datasettings {datasettings}")
-    logger.info(f"The loaded data has size {len(data)}")
+    traindataset: BaseDataset
+    valdataset: BaseDataset
+    texts: Iterator[str]
+    if datasettings.window > 0:
+        shards = filehandler.get_shards(train)
+        dataset = LazyTxtDataset(
+            shards, datasettings, filehandler, window=datasettings.window
+        )
+        logger.info(f"The scanned data has size {len(dataset)} in {shards}")
+        traindataset, valdataset = dataset.split(datasettings.trainfrac, seed)
+        texts = chain.from_iterable(dataset.scan_column(datasettings.txtcol))
+    else:
+        shards = filehandler.get_shards(train)
+        data = pl.concat([filehandler.load_data(shard) for shard in shards])
+        data = data.with_columns(pl.Series(name="idx", values=[*range(len(data))]))
+        logger.info(f"The loaded data has size {len(data)} in {len(shards)} shards")
 
-    traindata = data.sample(frac=datasettings.trainfrac)
-    valdata = data.join(traindata, on="idx", how="anti")
+        traindata = data.sample(frac=datasettings.trainfrac, seed=seed)
+        valdata = data.join(traindata, on="idx", how="anti")
 
-    traindataset = TxtDataset(traindata, settings=datasettings)
-    valdataset = TxtDataset(valdata, settings=datasettings)
+        traindataset = TxtDataset(traindata, settings=datasettings)
+        valdataset = TxtDataset(valdata, settings=datasettings)
+        texts = iter(data[datasettings.txtcol].to_list())
 
     trainstreamer = Datastreamer(
-        traindataset, batchsize=datasettings.batchsize, mapping=mapping
+        traindataset,
+        batchsize=datasettings.batchsize,
+        mapping=mapping,
+        bucketsize=datasettings.bucketsize,
+        seed=seed,
+        rank=rank,
+        world=world,
     )
 
     valstreamer = Datastreamer(
-        valdataset, batchsize=datasettings.batchsize, mapping=mapping
+        valdataset,
+        batchsize=datasettings.batchsize,
+        mapping=mapping,
+        seed=seed,
+        rank=rank,
+        world=world,
     )
 
     # trainloop
     logger.info(f"using modelsettings {modelsettings}")
     model = AbbrvtExpander(modelsettings)
+    distributed.broadcast_parameters(model)
     loss = torch.nn.CrossEntropyLoss()
     accuracy = Accuracy()
+    trainstream = trainstreamer.stream()
+    valstream = valstreamer.stream()
+    texts = chain(texts, mapping.keys())
+    transform: Optional[Callable] = tokenize_batch(model)  # type: ignore
+    if modelsettings.featuredir is not None:
+        # the encoder is frozen, so it only has to see every text once
+        with distributed.main_first():
+            store = precompute(model, texts, modelsettings.featuredir)  # type: ignore
+        logger.info(f"training from {store}")
+        trainstream = store.stream(trainstream)
+        valstream = store.stream(valstream)
+        transform = None
+    elif modelsettings.tokendir is not None:
+        with distributed.main_first():
+            tokens = build_tokenstore(model.tokenizer, texts, modelsettings.tokendir)
+        logger.info(f"tokens from {tokens}")
+        transform = tokenize_batch(model, tokens)  # type: ignore
+    trainprefetcher = Prefetcher(
+        trainstream, datasettings.prefetch, transform, datasettings.workers
+    )
+    valprefetcher = Prefetcher(
+        valstream, datasettings.prefetch, transform, datasettings.workers
+    )
     model, testloss = trainloop(  # type: ignore
         epochs=modelsettings.epochs,
         model=model,  # type: ignore
@@ -49,14 +121,26 @@ def train() -> None:
         learning_rate=modelsettings.learning_rate,
         loss_fn=loss,
         metrics=[accuracy],
-        train_dataloader=trainstreamer.stream(),
-        val_dataloader=valstreamer.stream(),
+        train_dataloader=trainprefetcher,
+        val_dataloader=valprefetcher,
         log_dir=Path("logs"),
         train_steps=10,
         eval_steps=10,
         tunewriter=["tensorboard"],
+        profile=modelsettings.profile,
     )
 
+    trainprefetcher.close()
+    valprefetcher.close()
+    if distributed.is_main():
+        test_and_save(model, filehandler, mapping)  # type: ignore
+    distributed.cleanup()
+
+
+def test_and_save(
+    model: AbbrvtExpander, filehandler: FileHandler, mapping: Dict
+) -> None:
+    accuracy = Accuracy()
     logger.info("Finished train and validation loop. Starting test.")
     # test accuracy
     testfile = filesettings.datadir / "raw/test_set.csv"
@@ -70,14 +154,17 @@ def train() -> None:
         test, batchsize=testsettings.batchsize, mapping=mapping
     ).stream()
     X, y_, y = next(teststream)  # noqa N806
-    yhat = model(X, y_)
+    model.eval()
+    with torch.no_grad():
+        yhat = model(X, y_)
     acc = accuracy(y, yhat)
-    logger.info(f"testaccuracy: {acc}")
+    logger.info(f"testaccuracy ({modelsettings.precision}): {acc}")
 
     timestamp = datetime.now().strftime("%Y%m%d-%H%M")
     modelpath = modelsettings.modeldir / (timestamp + "trainedmodel.pt")
     logger.success(f"saving model to {modelpath}")
-    torch.save(model, modelpath)
+    # only the head, the frozen encoder is shared between versions (artifacts.py)
+    save_model(model, modelpath, modelsettings)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,14 @@
+import time
 from pathlib import Path
-from typing import Callable, Dict, Iterator, List, Protocol, Tuple, Type
+from typing import Callable, Dict, Iterator, List, Optional, Protocol, Tuple, Type
 
 # import mlflow
+import distributed
 import torch
 from layers import AbbrvtExpander
 from loguru import logger
 from metrics import Metric
+from timing import StageTimer, count, set_timer, stage
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
@@ -25,19 +28,34 @@ def trainbatches(
     loss_fn: Callable,
     optimizer: torch.optim.Optimizer,
     train_steps: int,
-) -> float:
+    profiler: Optional[torch.profiler.profile] = None,
+) -> Tuple[float, float]:
+    """Returns the mean loss and the mean seconds a step waited for its batch"""
     model.train()  # type: ignore
     train_loss: float = 0.0
+    data_wait: float = 0.0
     for _ in tqdm(range(train_steps), colour="#1e4706"):
+        tic = time.perf_counter()
         x, cand, y = next(iter(traindatastreamer))
+        data_wait += time.perf_counter() - tic
         optimizer.zero_grad()
-        yhat = model(x, cand)  # type: ignore
-        loss = loss_fn(yhat, y)
-        loss.backward()
-        optimizer.step()
+        with stage("forward"):
+            yhat = model(x, cand)  # type: ignore
+            loss = loss_fn(yhat, y)
+        with stage("backward"):
+            loss.backward()
+        with stage("allreduce"):
+            # a no-op unless there are several ranks, see distributed.py
+            distributed.allreduce_gradients(model)  # type: ignore
+        with stage("optimizer"):
+            optimizer.step()
         train_loss += loss.detach().numpy()
+        count(len(y))
+        if profiler is not None:
+            profiler.step()
     train_loss /= train_steps
-    return train_loss
+    data_wait /= train_steps
+    return train_loss, data_wait
 
 
 def evalbatches(
@@ -52,13 +70,16 @@ def evalbatches(
     metric_dict: Dict[str, float] = {}
     for _ in range(eval_steps):
         x, cand, y = next(iter(valdatastreamer))
-        yhat = model(x, cand)  # type: ignore
-        test_loss += loss_fn(yhat, y).detach().numpy()
-        for m in metrics:
-            metric_dict[str(m)] = (
-                metric_dict.get(str(m), 0.0)
-                + m(y, yhat).detach().numpy()  # type:ignore
-            )
+        with stage("forward"):
+            yhat = model(x, cand)  # type: ignore
+            test_loss += loss_fn(yhat, y).detach().numpy()
+        with stage("metrics"):
+            for m in metrics:
+                metric_dict[str(m)] = (
+                    metric_dict.get(str(m), 0.0)
+                    + m(y, yhat).detach().numpy()  # type:ignore
+                )
+        count(len(y))
 
     test_loss /= eval_steps
     for key in metric_dict:
@@ -82,6 +103,7 @@ def trainloop(
     factor: float = 0.9,
     tunewriter: List[str] = ["tensorboard", "gin", "mlflow", "ray"],
     weight_decay: float = 1e-5,
+    profile: Optional[Tuple[int, int]] = None,
 ) -> Tuple[Type[AbbrvtExpander], float]:
     """
 
@@ -109,6 +131,9 @@ def trainloop(
                 "gin" simply writes the gin config to a file.
                 hyperparameters to pick.
                 "mlflow" uses the MLflow framework for logging.
+        profile (Tuple[int, int], optional): (first, steps), traces steps train
+            steps from step first on with torch.profiler, and exports a chrome
+            trace to log_dir.
 
     Returns:
         _type_: _description_
@@ -124,18 +149,47 @@ def trainloop(
         patience=patience,
     )
 
-    if "tensorboard" in tunewriter:
+    # the encoder runs in the precision of the model (see Settings.precision), the
+    # reducer, the scores and the loss stay in fp32
+    logger.info(f"Training with the encoder in {model.precision}")  # type: ignore
+
+    # only rank 0 logs, see distributed.py
+    is_main = distributed.is_main()
+    if "tensorboard" in tunewriter and is_main:
         # log_dir = data_tools.dir_add_timestamp(log_dir)
         writer = SummaryWriter(log_dir=log_dir)
 
+    # the stages of the hot path, see timing.py
+    timer = StageTimer(record=profile is not None)
+    previous = set_timer(timer)
+    profiler = None
+    if profile is not None and is_main:
+        profiler = start_profiler(profile, log_dir)
+
     for epoch in tqdm(range(epochs), colour="#1e4706"):
-        train_loss = trainbatches(
-            model, train_dataloader, loss_fn, optimizer_, train_steps
+        timer.reset()
+        tic = time.perf_counter()
+        train_loss, data_wait = trainbatches(
+            model, train_dataloader, loss_fn, optimizer_, train_steps, profiler
         )
+        train_time = time.perf_counter() - tic
+        step_time = train_time / train_steps
+        train_stages, train_examples = timer.summary(), timer.examples
 
+        timer.reset()
+        tic = time.perf_counter()
         metric_dict, test_loss = evalbatches(
             model, val_dataloader, loss_fn, metrics, eval_steps
         )
+        eval_time = time.perf_counter() - tic
+        eval_stages, eval_examples = timer.summary(), timer.examples
+
+        # the means over the ranks, so every rank steps the scheduler the same way
+        scores = distributed.allreduce_mean(
+            {"Loss/train": train_loss, "Loss/test": test_loss, **metric_dict}
+        )
+        train_loss, test_loss = scores.pop("Loss/train"), scores.pop("Loss/test")
+        metric_dict = scores
 
         scheduler.step(test_loss)
 
@@ -147,17 +201,61 @@ def trainloop(
         #     lr = [group["lr"] for group in optimizer_.param_groups][0]
         #     mlflow.log_metric("learning_rate", lr, step=epoch)
 
-        if "tensorboard" in tunewriter:
+        if "tensorboard" in tunewriter and is_main:
             writer.add_scalar("Loss/train", train_loss, epoch)
             writer.add_scalar("Loss/test", test_loss, epoch)
             for m in metric_dict:
                 writer.add_scalar(f"metric/{m}", metric_dict[m], epoch)
             lr = [group["lr"] for group in optimizer_.param_groups][0]
             writer.add_scalar("learning_rate", lr, epoch)
+            # seconds per train step, and the part of that spent waiting on data
+            writer.add_scalar("time/step", step_time, epoch)
+            writer.add_scalar("time/data_wait", data_wait, epoch)
+            # seconds per step in every stage, and the examples/sec of all ranks
+            for name, stats in train_stages.items():
+                seconds = stats["seconds"] / train_steps
+                writer.add_scalar(f"stage/train/{name}", seconds, epoch)
+            for name, stats in eval_stages.items():
+                seconds = stats["seconds"] / eval_steps
+                writer.add_scalar(f"stage/eval/{name}", seconds, epoch)
+            world = distributed.world_size()
+            writer.add_scalar(
+                "throughput/train", world * train_examples / train_time, epoch
+            )
+            writer.add_scalar(
+                "throughput/eval", world * eval_examples / eval_time, epoch
+            )
 
-        metric_scores = [f"{v:.4f}" for v in metric_dict.values()]
-        logger.info(
-            f"Epoch {epoch} train {train_loss:.4f} test {test_loss:.4f} metric {metric_scores}"  # noqa E501
-        )
+        if is_main:
+            metric_scores = [f"{v:.4f}" for v in metric_dict.values()]
+            logger.info(
+                f"Epoch {epoch} train {train_loss:.4f} test {test_loss:.4f} metric {metric_scores}"  # noqa E501
+            )
 
+    if profiler is not None:
+        profiler.stop()
+    set_timer(previous)
     return model, test_loss
+
+
+def start_profiler(profile: Tuple[int, int], log_dir: Path) -> torch.profiler.profile:
+    """traces steps train steps from step first (counting from 0) on, the step
+    before first is a warmup of the profiler"""
+    first, steps = profile
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    def export(profiler: torch.profiler.profile) -> None:
+        path = log_dir / f"trace-steps{first}-{first + steps - 1}.json"
+        profiler.export_chrome_trace(str(path))
+        logger.info(f"Wrote a chrome trace of {steps} train steps to {path}")
+
+    profiler = torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU],
+        schedule=torch.profiler.schedule(
+            wait=max(first - 1, 0), warmup=min(first, 1), active=steps, repeat=1
+        ),
+        on_trace_ready=export,
+        record_shapes=True,
+    )
+    profiler.start()
+    return profiler
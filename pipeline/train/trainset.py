@@ -0,0 +1,299 @@
+"""Builds the training set from the raw corpus, without the julia container.
+
+Does the same as preprocess/process.jl:
+    - the unique (expansion, acronym) pairs of the test set, in order, are
+        written to {timestamp}_map.json as [{expansion: acronym}, ...]
+    - for every line of the corpus, the pairs are tried in mapping order. When
+        an expansion occurs in the line, all its occurrences are replaced by the
+        acronym and the line, as it is at that point, is a row with the expansion
+        as label. Replacements accumulate, so a line yields one row per
+        expansion that occurs in it.
+
+Instead of testing every pair against every line, all expansions are found in
+one pass over the line. The corpus is read in chunks that are processed by a
+pool of worker processes, every chunk becomes a zstd compressed parquet shard
+{timestamp}_train-NNNNN.parq with the columns txt and label.
+
+Run from the root of the repository, eg:
+    python pipeline/train/trainset.py --corpus assets/raw/big_corpus.txt
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import polars as pl
+from loguru import logger
+from settings import filesettings, filetypes
+
+Pair = Tuple[str, str]
+# below this many pairs, testing every expansion with `in` is faster than the
+# automaton, whose inner loop runs in python
+SCAN_LIMIT = 16
+
+# every worker process builds the matcher once, in init_worker
+_matcher: Optional["ExpansionMatcher"] = None
+
+
+class ExpansionMatcher:
+    """Finds which expansions of the mapping occur in a text, in a single pass.
+
+    The expansions are compiled into an Aho-Corasick automaton. Like occursin in
+    julia, an expansion occurs anywhere in the text, also inside a word, and
+    overlapping occurrences all count. The transitions that follow fail links are
+    memoized while searching, so after a warm up every character costs one dict
+    lookup. For small mappings, every expansion is tested with `in` instead.
+
+    Args:
+        pairs (Sequence[Pair]): the (expansion, acronym) pairs, in mapping order
+    """
+
+    def __init__(self, pairs: Sequence[Pair]) -> None:
+        self.pairs = list(pairs)
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # the pair ids whose expansion ends in a node, and the nearest node on the
+        # fail chain where another expansion ends
+        self.output: List[List[int]] = [[]]
+        self.dict_link: List[int] = [0]
+        for i, (expansion, _) in enumerate(self.pairs):
+            self._add(expansion, i)
+        self._link()
+        # per node: the memoized transitions, and all pairs that end there
+        self.delta: List[Dict[str, int]] = [dict(g) for g in self.goto]
+        self.found: List[Tuple[int, ...]] = [
+            self._found(n) for n in range(len(self.goto))
+        ]
+
+    def __repr__(self) -> str:
+        return f"ExpansionMatcher(pairs={len(self.pairs)}, states={len(self.goto)})"
+
+    def _add(self, expansion: str, pair: int) -> None:
+        if len(expansion) == 0:
+            return
+        node = 0
+        for char in expansion:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.dict_link.append(0)
+            node = nxt
+        self.output[node].append(pair)
+
+    def _link(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                link = self.fail[child]
+                self.dict_link[child] = (
+                    link if self.output[link] else self.dict_link[link]
+                )
+                queue.append(child)
+
+    def _found(self, node: int) -> Tuple[int, ...]:
+        pairs: List[int] = []
+        state = node if self.output[node] else self.dict_link[node]
+        while state:
+            pairs.extend(self.output[state])
+            state = self.dict_link[state]
+        return tuple(pairs)
+
+    def _step(self, node: int, char: str) -> int:
+        while node and char not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(char, 0)
+
+    def occurring(self, text: str) -> Set[int]:
+        """the ids of the pairs whose expansion occurs in text"""
+        if len(self.pairs) < SCAN_LIMIT:
+            return {i for i, (e, _) in enumerate(self.pairs) if e and e in text}
+        delta, found = self.delta, self.found
+        result: Set[int] = set()
+        node = 0
+        for char in text:
+            nxt = delta[node].get(char)
+            if nxt is None:
+                nxt = self._step(node, char)
+                delta[node][char] = nxt
+            node = nxt
+            if found[node]:
+                result.update(found[node])
+        return result
+
+    def expand(self, line: str) -> List[Pair]:
+        """the (txt, label) rows for one corpus line, see the module docstring.
+
+        After a replacement the line is searched again, because replacing can
+        remove an expansion that occurred before, or create a new one.
+        """
+        rows: List[Pair] = []
+        last = -1
+        found = self.occurring(line)
+        while True:
+            pair = min((i for i in found if i > last), default=None)
+            if pair is None:
+                return rows
+            expansion, abbr = self.pairs[pair]
+            line = line.replace(expansion, abbr)
+            rows.append((line, expansion))
+            last = pair
+            found = self.occurring(line)
+
+
+def load_pairs(testfile: Path, sep: str = "|") -> List[Pair]:
+    """the unique (expansion, acronym) pairs of the test set, in order"""
+    data = pl.read_csv(testfile, sep=sep)
+    for column in ["acronym", "expansion"]:
+        assert column in data.columns, f"The csv should contain an `{column}` column"
+    pairs = zip(data["expansion"].to_list(), data["acronym"].to_list())
+    return list(dict.fromkeys(pairs))
+
+
+def write_mapping(pairs: Sequence[Pair], path: Path) -> None:
+    with open(path, "w") as f:
+        json.dump(
+            [{expansion: abbr} for expansion, abbr in pairs], f, ensure_ascii=False
+        )
+
+
+def read_chunks(corpus: Path, chunksize: int) -> Iterator[Tuple[int, List[str]]]:
+    with open(corpus, "r") as f:
+        chunk = 0
+        while True:
+            lines = list(islice(f, chunksize))
+            if len(lines) == 0:
+                return
+            # like julia's eachline, without the line ending
+            yield chunk, [line.rstrip("\n").removesuffix("\r") for line in lines]
+            chunk += 1
+
+
+def init_worker(pairs: List[Pair]) -> None:
+    global _matcher
+    _matcher = ExpansionMatcher(pairs)
+
+
+def expand_chunk(chunk: int, lines: List[str], path: Path) -> Tuple[int, int, int]:
+    """writes the rows of a chunk to a parquet shard, if there are any
+
+    Returns:
+        Tuple[int, int, int]: chunk number, lines, rows
+    """
+    matcher: ExpansionMatcher = _matcher  # type: ignore
+    rows = [row for line in lines for row in matcher.expand(line)]
+    if len(rows) > 0:
+        txt, label = zip(*rows)
+        frame = pl.DataFrame({"txt": list(txt), "label": list(label)})
+        frame.write_parquet(path, compression="zstd")
+    return chunk, len(lines), len(rows)
+
+
+def build_trainset(
+    corpus: Path,
+    testfile: Path,
+    processed: Path,
+    workers: int = os.cpu_count() or 1,
+    chunksize: int = 100_000,
+) -> Tuple[Path, List[Path]]:
+    """writes the mapping and the parquet shards of the training set
+
+    The shards are written with a .tmp suffix and renamed when all of them are
+    done, so FileHandler never picks up a training set that is incomplete.
+
+    Returns:
+        Tuple[Path, List[Path]]: the mapping and the shards
+    """
+    processed.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    pairs = load_pairs(testfile)
+    logger.info(f"Found {len(pairs)} mappings.")
+
+    tic = time.perf_counter()
+    lines, rows = 0, 0
+    shards: List[Path] = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(pairs,),
+    ) as pool:
+        pending: Set[Future] = set()
+
+        def collect(return_when: str) -> None:
+            nonlocal lines, rows
+            finished, rest = wait(pending, return_when=return_when)
+            pending.intersection_update(rest)
+            for future in finished:
+                chunk, n, m = future.result()
+                lines += n
+                rows += m
+                if m > 0:
+                    shards.append(shard(processed, timestamp, chunk))
+
+        for chunk, items in read_chunks(corpus, chunksize):
+            # keep at most two chunks per worker in memory
+            if len(pending) >= 2 * workers:
+                collect(FIRST_COMPLETED)
+            path = shard(processed, timestamp, chunk).with_suffix(".tmp")
+            pending.add(pool.submit(expand_chunk, chunk, items, path))
+        if pending:
+            collect(ALL_COMPLETED)
+
+    shards.sort()
+    for path in shards:
+        path.with_suffix(".tmp").replace(path)
+    mappath = processed / f"{timestamp}_map.json"
+    write_mapping(pairs, mappath)
+    logger.success(
+        f"Wrote {rows} rows from {lines} lines to {len(shards)} shards in "
+        f"{processed} ({lines / (time.perf_counter() - tic):.0f} lines/sec)"
+    )
+    return mappath, shards
+
+
+def shard(processed: Path, timestamp: str, chunk: int) -> Path:
+    return processed / f"{timestamp}_train-{chunk:05d}{filetypes.PARQUET}"
+
+
+def main() -> None:
+    raw = filesettings.datadir / "raw"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", type=Path, default=raw / "corpus.txt")
+    parser.add_argument("--testfile", type=Path, default=raw / "test_set.csv")
+    parser.add_argument("--processed", type=Path, default=filesettings.processed)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    args = parser.parse_args()
+    build_trainset(
+        args.corpus, args.testfile, args.processed, args.workers, args.chunksize
+    )
+
+
+if __name__ == "__main__":
+    main()